@@ -1,8 +1,48 @@
+from .pkcs11_certificate_record import (
+    PKCS11CertificateRecord as PKCS11CertificateRecord,
+)
 from .pkcs11_check_card_scan_thread import (
     PKCS11CheckCardScanThread as PKCS11CheckCardScanThread,
 )
 from .pkcs11_check_error import PKCS11CheckError as PKCS11CheckError
+from .pkcs11_check_event import PKCS11CheckEvent as PKCS11CheckEvent
+from .pkcs11_check_event import PKCS11ErrorEvent as PKCS11ErrorEvent
+from .pkcs11_check_event import PKCS11ScanEvent as PKCS11ScanEvent
+from .pkcs11_check_event import PKCS11ScanItemEvent as PKCS11ScanItemEvent
+from .pkcs11_check_event import PKCS11SlotChangeEvent as PKCS11SlotChangeEvent
+from .pkcs11_check_event import PKCS11SlotEvent as PKCS11SlotEvent
+from .pkcs11_check_monitor import PKCS11CheckMonitor as PKCS11CheckMonitor
 from .pkcs11_check_X509_scan_thread import (
     PKCS11CheckX509ScanThread as PKCS11CheckX509ScanThread,
 )
+from .pkcs11_coalescing_queue import (
+    PKCS11CoalescingQueue as PKCS11CoalescingQueue,
+)
+from .pkcs11_deadlines import PKCS11CallDeadlines as PKCS11CallDeadlines
+from .pkcs11_deadlines import PKCS11CallTimeout as PKCS11CallTimeout
+from .pkcs11_fleet_scanner import PKCS11FleetScanner as PKCS11FleetScanner
+from .pkcs11_fleet_scanner import PKCS11FleetTarget as PKCS11FleetTarget
+from .pkcs11_instrumentation import PKCS11CallStatistics as PKCS11CallStatistics
+from .pkcs11_library_event import PKCS11LibraryEvent as PKCS11LibraryEvent
+from .pkcs11_library_monitor import PKCS11LibraryMonitor as PKCS11LibraryMonitor
+from .pkcs11_library_pool import PKCS11LibraryPool as PKCS11LibraryPool
+from .pkcs11_query import PKCS11Query as PKCS11Query
 from .pkcs11_scan import PKCS11Scan as PKCS11Scan
+from .pkcs11_scan_cache import PKCS11ScanCache as PKCS11ScanCache
+from .pkcs11_scan_diff import PKCS11ScanChange as PKCS11ScanChange
+from .pkcs11_scan_diff import PKCS11ScanChangeTarget as PKCS11ScanChangeTarget
+from .pkcs11_scan_diff import PKCS11ScanDiff as PKCS11ScanDiff
+from .pkcs11_scan_history import (
+    PKCS11ScanHistoryWriter as PKCS11ScanHistoryWriter,
+)
+from .pkcs11_scan_history import gen_scan_history as gen_scan_history
+from .pkcs11_scan_records import PKCS11LibraryRecord as PKCS11LibraryRecord
+from .pkcs11_scan_stream import PKCS11ScanItem as PKCS11ScanItem
+from .pkcs11_scan_stream import PKCS11ScanItemType as PKCS11ScanItemType
+from .pkcs11_slot_change import PKCS11SlotChange as PKCS11SlotChange
+from .pkcs11_slot_change import PKCS11SlotChangeType as PKCS11SlotChangeType
+from .pkcs11_slot_health import PKCS11SlotHealth as PKCS11SlotHealth
+from .pkcs11_uri import PKCS11URI as PKCS11URI
+from .pkcs11_uri import PKCS11URIBuilder as PKCS11URIBuilder
+from .pkcs11_uri_resolver import PKCS11URIMatch as PKCS11URIMatch
+from .pkcs11_uri_resolver import PKCS11URIResolver as PKCS11URIResolver
@@ -1,21 +1,36 @@
-from pkcs11_cryptography_keys import (
-    MechanismProperties,
-    MultiCertificateContainer,
-    TokenProperties,
-)
+from concurrent.futures import Executor
+from typing import Any, AsyncIterator
+
+from cryptography.x509 import load_der_x509_certificate
+from pkcs11_cryptography_keys import CertificateProperties, TokenProperties
 from PyKCS11 import PyKCS11Lib
 
+from .pkcs11_base_scanner import PKCS11BaseScanner
+from .pkcs11_certificate_record import (
+    PKCS11CertificateRecord,
+    decode_certificates,
+    is_conformant_key_usage,
+    read_key_usage,
+)
+from .pkcs11_library_pool import PKCS11LibraryPool, load_library
+from .pkcs11_query import PKCS11Query
+from .pkcs11_scan_stream import PKCS11ScanItem, PKCS11ScanItemType
+
 
-class PKCS11X506Scanner(object):
+class PKCS11X506Scanner(PKCS11BaseScanner):
     def __init__(
         self,
         library: PyKCS11Lib,
         filter: dict | None = None,
         add_certificate: bool = False,
+        max_workers: int | None = None,
     ) -> None:
-        self._library = library
+        super().__init__(library, max_workers)
         self._filter = filter
         self._add_certificate = add_certificate
+        self._lazy_certificates = False
+        self._decode_executor: Executor | None = None
+        self._decode_min_certificates = 8
 
     @classmethod
     def from_library_path(
@@ -23,71 +38,103 @@ class PKCS11X506Scanner(object):
         library_path: str | None = None,
         filter: dict | None = None,
         add_certificate: bool = False,
+        max_workers: int | None = None,
+        pool: PKCS11LibraryPool | None = None,
     ):
-        library = PyKCS11Lib()
-        if library_path is not None:
-            library.load(library_path)
-        else:
-            library.load()
-        return cls(library, filter, add_certificate)
+        library = load_library(library_path, pool)
+        scanner = cls(library, filter, add_certificate, max_workers)
+        scanner._library_owner = pool
+        return scanner
 
-    async def scan_from_library(
-        self,
-        pin: str | None = None,
-    ) -> dict:
-        ret: dict = {}
-        ret["slots"] = list()
-        slots = self._library.getSlotList(tokenPresent=True)
-        for sl in slots:
-            tp = TokenProperties.read_from_slot(self._library, sl)
-            label = tp.get_label()
-            login_required = tp.is_login_required()
-            token_protected_path = tp.has_proteced_authentication_path()
-            certs = list()
-            if tp.is_initialized():
-                mcc = await MultiCertificateContainer.read_slot(
-                    self._library, sl, login_required, pin
+    def set_lazy_certificates(self, lazy: bool = True):
+        self._lazy_certificates = lazy
+
+    def set_decode_executor(
+        self, executor: Executor | None, min_certificates: int = 8
+    ):
+        # tokens with fewer certificates are decoded in place
+        self._decode_executor = executor
+        self._decode_min_certificates = min_certificates
+
+    def __is_conformant(self, der: bytes) -> bool:
+        if self._filter is None:
+            return True
+        key_usage = read_key_usage(der)
+        if key_usage is None:
+            key_usage = CertificateProperties(
+                load_der_x509_certificate(der)
+            ).get_X509_key_usages_from_certificate()
+        return is_conformant_key_usage(key_usage, self._filter)
+
+    async def __decode(self, ders: list[bytes]) -> list[Any]:
+        # lazy records are mappings that stand in for the certificate dict
+        if self._lazy_certificates:
+            return [
+                PKCS11CertificateRecord(der, self._add_certificate)
+                for der in ders
+            ]
+        executor = None
+        if len(ders) >= self._decode_min_certificates:
+            executor = self._decode_executor
+        return await decode_certificates(ders, self._add_certificate, executor)
+
+    async def _gen_slot(
+        self, sl: int, pin: str | None, query: PKCS11Query | None = None
+    ) -> AsyncIterator[PKCS11ScanItem]:
+        tp = TokenProperties.read_from_slot(self._library, sl)
+        found = False
+        if tp.is_initialized() and (query is None or query.matches_token(tp)):
+            values = await self._read_certificate_values(
+                sl, tp.is_login_required(), pin, query
+            )
+            # filtering needs only the key usage, not a decoded certificate
+            selected = [
+                (key_id, key_label, der)
+                for key_id, (key_label, der) in values.items()
+                if self.__is_conformant(der)
+            ]
+            records = await self.__decode([der for _, _, der in selected])
+            for (key_id, key_label, der), cert_data in zip(selected, records):
+                cert_data["key_id"] = key_id
+                cert_data["key_label"] = key_label
+                # the DER value identifies the certificate without decoding
+                cert_data["value"] = der
+                if not found:
+                    # tokens without certificates are not reported
+                    found = True
+                    for item in self.__gen_token(sl, tp):
+                        yield item
+                yield PKCS11ScanItem(
+                    PKCS11ScanItemType.object,
+                    cert_data,
+                    sl,
+                    "certificates",
                 )
-                if mcc is not None:
-                    async for (
-                        key_id,
-                        key_label,
-                        cert_props,
-                    ) in mcc.gen_certificates_for_token():
-                        if self._filter is not None:
-                            conformant = (
-                                await cert_props.has_conformant_key_usage(
-                                    self._filter
-                                )
-                            )
-                        else:
-                            conformant = True
-                        if conformant:
-                            cert_data = cert_props.get_certificate_data(
-                                self._add_certificate
-                            )
-                            if cert_data is not None:
-                                cert_data["key_id"] = key_id
-                                cert_data["key_label"] = key_label
-                                certs.append(cert_data)
+        if found and (query is None or query.has_mechanisms()):
+            yield PKCS11ScanItem(
+                PKCS11ScanItemType.mechanisms,
+                self._read_mechanisms(sl, tp),
+                sl,
+            )
+
+    def __gen_token(self, sl: int, tp: TokenProperties):
+        yield PKCS11ScanItem(PKCS11ScanItemType.slot, {}, sl)
+        yield PKCS11ScanItem(
+            PKCS11ScanItemType.token,
+            {
+                "label": tp.get_label(),
+                "token_login_required": tp.is_login_required(),
+                "token_protected_path": tp.has_proteced_authentication_path(),
+            },
+            sl,
+        )
+
+    def _get_cache_variant(self, pin: str | None) -> tuple:
+        return super()._get_cache_variant(pin) + (
+            repr(self._filter),
+            self._add_certificate,
+            self._lazy_certificates,
+        )
 
-            if len(certs) > 0:
-                slot = {
-                    "token": {
-                        "label": label,
-                        "token_login_required": login_required,
-                        "token_protected_path": token_protected_path,
-                        "certificates": certs,
-                    }
-                }
-                slot["token"]["mechanisms"] = {}
-                for mp in MechanismProperties.gen_mechanism_properties(
-                    self._library, sl
-                ):
-                    slot["token"]["mechanisms"][mp.get_mechanism_type()] = {}
-                    for tag, val in mp.gen_tags():
-                        slot["token"]["mechanisms"][mp.get_mechanism_type()][
-                            tag
-                        ] = val
-                ret["slots"].append(slot)
-        return ret
+    async def scan_library_info(self) -> dict:
+        return {}
@@ -0,0 +1,119 @@
+from typing import Any
+
+from pkcs11_cryptography_keys import KeyTypes, OperationTypes, PKCS11KeyUsage
+from PyKCS11 import (
+    CKA_COEFFICIENT,
+    CKA_DECRYPT,
+    CKA_DERIVE,
+    CKA_ENCRYPT,
+    CKA_EXPONENT_1,
+    CKA_EXPONENT_2,
+    CKA_ID,
+    CKA_KEY_TYPE,
+    CKA_LABEL,
+    CKA_PRIME_1,
+    CKA_PRIME_2,
+    CKA_PRIVATE_EXPONENT,
+    CKA_SIGN,
+    CKA_SIGN_RECOVER,
+    CKA_UNWRAP,
+    CKA_VALUE,
+    CKA_VERIFY,
+    CKA_VERIFY_RECOVER,
+    CKA_WRAP,
+    CKK_EC,
+    CKK_RSA,
+)
+
+PKCS11_key_type_translation: dict[int, KeyTypes] = {
+    CKK_EC: KeyTypes.EC,
+    CKK_RSA: KeyTypes.RSA,
+}
+
+# Attributes that are read for every object and classes that have a key type
+_base_attributes: list[int] = [CKA_LABEL, CKA_ID]
+_key_type_classes: list[str] = ["private", "public", "secret-key"]
+# Attributes a token can refuse for one object and return for another
+_sensitive_attributes: set[int] = {
+    CKA_VALUE,
+    CKA_PRIVATE_EXPONENT,
+    CKA_PRIME_1,
+    CKA_PRIME_2,
+    CKA_EXPONENT_1,
+    CKA_EXPONENT_2,
+    CKA_COEFFICIENT,
+}
+
+_key_usage_attributes: dict[str, dict[OperationTypes, int]] = {
+    "private": {
+        OperationTypes.CRYPT: CKA_DECRYPT,
+        OperationTypes.SIGN: CKA_SIGN,
+        OperationTypes.WRAP: CKA_UNWRAP,
+        OperationTypes.DERIVE: CKA_DERIVE,
+        OperationTypes.RECOVER: CKA_SIGN_RECOVER,
+    },
+    "public": {
+        OperationTypes.CRYPT: CKA_ENCRYPT,
+        OperationTypes.SIGN: CKA_VERIFY,
+        OperationTypes.WRAP: CKA_WRAP,
+        OperationTypes.RECOVER: CKA_VERIFY_RECOVER,
+    },
+}
+
+
+class PKCS11AttributeReader(object):
+    def __init__(self, session) -> None:
+        self._session = session
+        # attributes the token rejected, per object type
+        self._rejected: dict[str, set[int]] = {}
+        # attributes the token returned for an object, per object type
+        self._read: dict[str, set[int]] = {}
+
+    @staticmethod
+    def get_template(tp: str) -> list[int]:
+        template = list(_base_attributes)
+        if tp in _key_type_classes:
+            template.append(CKA_KEY_TYPE)
+        if tp in _key_usage_attributes:
+            template.extend(_key_usage_attributes[tp].values())
+        return template
+
+    def read_attributes(
+        self, key, tp: str, template: list[int] | None = None
+    ) -> dict[int, Any]:
+        if template is None:
+            template = self.get_template(tp)
+        rejected = self._rejected.setdefault(tp, set())
+        read = self._read.setdefault(tp, set())
+        batch = [attr for attr in template if attr not in rejected]
+        # PyKCS11 reads the attributes one by one when the token rejects the
+        # batch and returns None for the rejected ones
+        values = self._session.getAttributeValue(key, batch)
+        ret: dict[int, Any] = dict.fromkeys(template)
+        for attr, value in zip(batch, values):
+            if value is not None:
+                read.add(attr)
+                ret[attr] = value
+            elif attr not in _sensitive_attributes and attr not in read:
+                # None also stands for an attribute that is sensitive on
+                # this object only, those are asked for every object
+                rejected.add(attr)
+        return ret
+
+    def read_key_data(self, key, tp: str) -> dict:
+        attrs = self.read_attributes(key, tp)
+        key_data: dict = {}
+        key_id = attrs[CKA_ID]
+        key_data["label"] = attrs[CKA_LABEL]
+        key_data["id"] = bytes(key_id) if key_id is not None else None
+        key_data["type"] = tp
+        kt = attrs.get(CKA_KEY_TYPE, None)
+        if kt in PKCS11_key_type_translation:
+            key_data["key_type"] = PKCS11_key_type_translation[kt]
+        if tp in _key_usage_attributes:
+            usage = {
+                op.name: attrs[attr]
+                for op, attr in _key_usage_attributes[tp].items()
+            }
+            key_data["key_usage"] = PKCS11KeyUsage(**usage)
+        return key_data
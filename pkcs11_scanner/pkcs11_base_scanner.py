@@ -0,0 +1,437 @@
+from asyncio import AbstractEventLoop
+from asyncio import Queue as AsyncQueue
+from asyncio import gather, get_running_loop
+from asyncio import run as async_run
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, AsyncIterator
+
+from pkcs11_cryptography_keys import (
+    LibraryProperties,
+    MultiCertificateContainer,
+    TokenProperties,
+)
+from PyKCS11 import PyKCS11Lib
+
+from .pkcs11_certificate_reader import (
+    read_certificate_container,
+    read_certificate_values,
+)
+from .pkcs11_deadlines import (
+    PKCS11CallDeadlines,
+    PKCS11CallTimeout,
+    get_library_deadlines,
+    set_library_deadlines,
+)
+from .pkcs11_instrumentation import (
+    PKCS11CallStatistics,
+    get_library_statistics,
+    instrument_library,
+    uninstrument_library,
+)
+from .pkcs11_library_pool import PKCS11LibraryPool, close_session, open_session
+from .pkcs11_mechanism_cache import PKCS11MechanismCache, read_mechanisms
+from .pkcs11_query import PKCS11Query
+from .pkcs11_scan_cache import PKCS11ScanCache, read_token_fingerprint
+from .pkcs11_scan_stream import (
+    PKCS11ScanAssembler,
+    PKCS11ScanItem,
+    PKCS11ScanItemCallback,
+    PKCS11ScanItemType,
+    gen_slot_items,
+)
+from .pkcs11_slot_health import PKCS11SlotHealth
+
+
+class PKCS11BaseScanner(object):
+    _mechanism_cache: PKCS11MechanismCache | None = None
+
+    def __init__(
+        self, library: PyKCS11Lib, max_workers: int | None = None
+    ) -> None:
+        self._library = library
+        self._max_workers = max_workers
+        self._scan_cache: PKCS11ScanCache | None = None
+        self._library_pool: PKCS11LibraryPool | None = None
+        self._library_owner: PKCS11LibraryPool | None = None
+        self._slot_health: PKCS11SlotHealth | None = None
+
+    @classmethod
+    def set_mechanism_cache(cls, cache: PKCS11MechanismCache | None):
+        PKCS11BaseScanner._mechanism_cache = cache
+
+    @classmethod
+    def get_mechanism_cache(cls) -> PKCS11MechanismCache | None:
+        return PKCS11BaseScanner._mechanism_cache
+
+    def set_scan_cache(self, cache: PKCS11ScanCache | None):
+        self._scan_cache = cache
+
+    def get_scan_cache(self) -> PKCS11ScanCache | None:
+        return self._scan_cache
+
+    def get_library(self) -> PyKCS11Lib:
+        return self._library
+
+    def set_max_workers(self, max_workers: int | None):
+        # None scans the slots one after the other on the running loop
+        self._max_workers = max_workers
+
+    def get_max_workers(self) -> int | None:
+        return self._max_workers
+
+    def set_library_pool(self, pool: PKCS11LibraryPool | None):
+        self._library_pool = pool
+
+    def get_library_pool(self) -> PKCS11LibraryPool | None:
+        return self._library_pool
+
+    def close(self):
+        self._flush_caches()
+        if self._library_owner is not None:
+            self._library_owner.release_library(self._library)
+            self._library_owner = None
+
+    def _open_session(
+        self, slot: int, login_required: bool, pin: str | None
+    ) -> tuple[Any, bool]:
+        if self._library_pool is not None:
+            return self._library_pool.acquire_session(
+                self._library, slot, login_required, pin
+            )
+        return open_session(self._library, slot, login_required, pin)
+
+    def _close_session(self, session, logged_in: bool, valid: bool = True):
+        if self._library_pool is not None:
+            self._library_pool.release_session(session, logged_in, valid)
+        else:
+            close_session(session, logged_in)
+
+    def set_call_statistics(self, statistics: PKCS11CallStatistics | None):
+        if statistics is not None:
+            self._library = instrument_library(self._library, statistics)
+        else:
+            self._library = uninstrument_library(self._library)
+
+    def get_call_statistics(self) -> PKCS11CallStatistics | None:
+        return get_library_statistics(self._library)
+
+    def set_call_deadlines(self, deadlines: PKCS11CallDeadlines | None):
+        self._library = set_library_deadlines(self._library, deadlines)
+
+    def get_call_deadlines(self) -> PKCS11CallDeadlines | None:
+        return get_library_deadlines(self._library)
+
+    def set_slot_health(self, health: PKCS11SlotHealth | None):
+        self._slot_health = health
+
+    def get_slot_health(self) -> PKCS11SlotHealth | None:
+        return self._slot_health
+
+    def __run_slot_scan(
+        self,
+        slot: int,
+        pin: str | None,
+        query: PKCS11Query | None,
+        loop: AbstractEventLoop,
+        items: AsyncQueue,
+    ):
+        async def forward():
+            async for item in self.__gen_guarded_slot(slot, pin, query):
+                loop.call_soon_threadsafe(items.put_nowait, item)
+
+        try:
+            # worker threads have no event loop, each slot scan gets its own
+            async_run(forward())
+        finally:
+            loop.call_soon_threadsafe(items.put_nowait, None)
+
+    async def __gen_guarded_slot(
+        self, slot: int, pin: str | None, query: PKCS11Query | None
+    ) -> AsyncIterator[PKCS11ScanItem]:
+        health = self._slot_health
+        deadlines = self.get_call_deadlines()
+        if health is not None and health.is_skipped(slot):
+            # a degraded slot is left alone until its backoff ends
+            yield self.__make_degraded_item(slot, {}, health.get_degraded(slot))
+            return
+        if deadlines is None:
+            async for item in self.__gen_cached_slot(slot, pin, query):
+                yield item
+            return
+        slot_data: dict = {}
+        reason = None
+        deadlines.start_slot(slot)
+        try:
+            async for item in self.__gen_cached_slot(slot, pin, query):
+                if item.get_type() == PKCS11ScanItemType.slot:
+                    slot_data = item.get_data()
+                yield item
+        except PKCS11CallTimeout as ex:
+            reason = str(ex)
+        finally:
+            # timeouts swallowed on the way are still known to the deadlines
+            reason = deadlines.end_slot(slot) or reason
+        if reason is None:
+            if health is not None:
+                health.mark_healthy(slot)
+            return
+        if health is not None:
+            degraded = health.mark_degraded(slot, reason)
+        else:
+            degraded = {"reason": reason}
+        # replaces the records already yielded for the slot
+        yield self.__make_degraded_item(slot, slot_data, degraded)
+
+    def __make_degraded_item(
+        self, slot: int, slot_data: dict, degraded: dict | None
+    ) -> PKCS11ScanItem:
+        data = dict(slot_data)
+        data["degraded"] = degraded
+        return PKCS11ScanItem(PKCS11ScanItemType.slot, data, slot)
+
+    async def __gen_cached_slot(
+        self, slot: int, pin: str | None, query: PKCS11Query | None
+    ) -> AsyncIterator[PKCS11ScanItem]:
+        cache = self._scan_cache
+        key = None
+        if cache is not None and query is None:
+            tp = TokenProperties.read_from_slot(self._library, slot)
+            key = cache.get_key(self._library, tp, self._get_cache_variant(pin))
+        if cache is None or key is None:
+            async for item in self._gen_slot(slot, pin, query):
+                yield item
+            return
+        fingerprint = None
+        if cache.is_background_revalidation():
+            found, data = cache.lookup(key)
+            if found:
+                cache.revalidate(
+                    partial(self.__revalidate_slot, cache, key, slot, pin)
+                )
+        else:
+            fingerprint = read_token_fingerprint(
+                self._library, slot, tp, self._library_pool
+            )
+            found, data = cache.lookup(key, fingerprint)
+        if found:
+            if data is not None:
+                for item in gen_slot_items(slot, data):
+                    yield item
+            return
+        if fingerprint is None:
+            fingerprint = read_token_fingerprint(
+                self._library, slot, tp, self._library_pool
+            )
+        assembler = PKCS11ScanAssembler()
+        async for item in self._gen_slot(slot, pin):
+            assembler.add(item)
+            yield item
+        deadlines = self.get_call_deadlines()
+        if deadlines is None or not deadlines.has_timed_out(slot):
+            # a timeout swallowed on the way leaves the slot incomplete
+            cache.put(key, fingerprint, assembler.get_slot(slot))
+
+    def __revalidate_slot(
+        self, cache: PKCS11ScanCache, key: tuple, slot: int, pin: str | None
+    ):
+        tp = TokenProperties.read_from_slot(self._library, slot)
+        fingerprint = read_token_fingerprint(
+            self._library, slot, tp, self._library_pool
+        )
+        if cache.get_fingerprint(key) != fingerprint:
+            cache.put(key, fingerprint, async_run(self.__read_slot(slot, pin)))
+
+    async def __read_slot(self, slot: int, pin: str | None) -> dict | None:
+        assembler = PKCS11ScanAssembler()
+        async for item in self._gen_slot(slot, pin):
+            assembler.add(item)
+        return assembler.get_slot(slot)
+
+    def _get_cache_variant(self, pin: str | None) -> tuple:
+        # objects behind a login are only part of scans made with a pin
+        return (type(self).__name__, pin is not None)
+
+    async def scan_library_info(self) -> dict:
+        ret: dict = {}
+        lp = LibraryProperties.read_from_slot(self._library)
+        for tag, val in lp.gen_tags():
+            ret[tag] = val
+        return ret
+
+    async def gen_scan(
+        self, pin: str | None = None, query: PKCS11Query | None = None
+    ) -> AsyncIterator[PKCS11ScanItem]:
+        info = await self.scan_library_info()
+        slots = self._library.getSlotList(tokenPresent=True)
+        yield PKCS11ScanItem(PKCS11ScanItemType.library, info, slot_ids=slots)
+        async for item in self.gen_slots(slots, pin, query):
+            yield item
+
+    async def gen_slots(
+        self,
+        slots: list,
+        pin: str | None = None,
+        query: PKCS11Query | None = None,
+    ) -> AsyncIterator[PKCS11ScanItem]:
+        if self._max_workers is None:
+            for sl in slots:
+                async for item in self.__gen_guarded_slot(sl, pin, query):
+                    yield item
+        else:
+            loop = get_running_loop()
+            items: AsyncQueue = AsyncQueue()
+            with ThreadPoolExecutor(
+                max_workers=self._max_workers,
+                thread_name_prefix="PKCS11 slot scan",
+            ) as executor:
+                done = gather(
+                    *[
+                        loop.run_in_executor(
+                            executor,
+                            self.__run_slot_scan,
+                            sl,
+                            pin,
+                            query,
+                            loop,
+                            items,
+                        )
+                        for sl in slots
+                    ]
+                )
+                # items of different slots arrive interleaved
+                running = len(slots)
+                while running > 0:
+                    item = await items.get()
+                    if item is None:
+                        running -= 1
+                    else:
+                        yield item
+                await done
+
+    async def scan_slot(
+        self,
+        slot: int,
+        pin: str | None = None,
+        on_item: PKCS11ScanItemCallback | None = None,
+        query: PKCS11Query | None = None,
+    ) -> dict | None:
+        rez = await self.scan_slots([slot], pin, on_item, query)
+        return rez[0]
+
+    async def scan_slots(
+        self,
+        slots: list,
+        pin: str | None = None,
+        on_item: PKCS11ScanItemCallback | None = None,
+        query: PKCS11Query | None = None,
+    ) -> list[dict | None]:
+        assembler = PKCS11ScanAssembler()
+        async for item in self.gen_slots(slots, pin, query):
+            if on_item is not None:
+                on_item(item)
+            assembler.add(item)
+        self._flush_caches()
+        return [self._finish_slot(assembler.get_slot(sl)) for sl in slots]
+
+    async def scan_from_library(
+        self,
+        pin: str | None = None,
+        on_item: PKCS11ScanItemCallback | None = None,
+        query: PKCS11Query | None = None,
+    ) -> dict:
+        assembler = PKCS11ScanAssembler()
+        async for item in self.gen_scan(pin, query):
+            if on_item is not None:
+                on_item(item)
+            assembler.add(item)
+        self._flush_caches()
+        ret = assembler.get_scan()
+        rez = [self._finish_slot(slot) for slot in ret["slots"]]
+        ret["slots"] = [slot for slot in rez if slot is not None]
+        return ret
+
+    async def find(
+        self, query: PKCS11Query, pin: str | None = None
+    ) -> list[dict]:
+        ret = []
+        slots = self._library.getSlotList(tokenPresent=True)
+        async for item in self.gen_slots(slots, pin, query):
+            if item.get_type() == PKCS11ScanItemType.object:
+                ret.append(item.get_data())
+        self._flush_caches()
+        return ret
+
+    def _flush_caches(self):
+        # caches are written to their files once a scan is done, streamed
+        # scans are written on close
+        mechanism_cache = self.get_mechanism_cache()
+        if mechanism_cache is not None:
+            mechanism_cache.flush()
+        if self._scan_cache is not None:
+            self._scan_cache.flush()
+
+    async def _gen_slot(
+        self, slot: int, pin: str | None, query: PKCS11Query | None = None
+    ) -> AsyncIterator[PKCS11ScanItem]:
+        # scanners yield the records of one slot, the base has none
+        return
+        yield
+
+    def _finish_slot(self, slot: dict | None) -> dict | None:
+        return slot
+
+    async def _read_certificates(
+        self,
+        slot: int,
+        login_required: bool,
+        pin: str | None,
+        query: PKCS11Query | None = None,
+    ) -> MultiCertificateContainer | None:
+        if query is None and self._library_pool is None:
+            return await MultiCertificateContainer.read_slot(
+                self._library, slot, login_required, pin
+            )
+        if query is not None and not query.accepts_type("certificate"):
+            return None
+        return await read_certificate_container(
+            self._library,
+            slot,
+            login_required,
+            pin,
+            query.get_template("certificate") if query is not None else None,
+            self._library_pool,
+        )
+
+    async def _read_certificate_values(
+        self,
+        slot: int,
+        login_required: bool,
+        pin: str | None,
+        query: PKCS11Query | None = None,
+    ) -> dict[bytes, tuple[str, bytes]]:
+        if query is not None and not query.accepts_type("certificate"):
+            return {}
+        values = await read_certificate_values(
+            self._library,
+            slot,
+            login_required,
+            pin,
+            query.get_template("certificate") if query is not None else None,
+            self._library_pool,
+        )
+        if query is None:
+            return values
+        return {
+            key_id: (label, der)
+            for key_id, (label, der) in values.items()
+            if query.matches_object(key_id, label)
+        }
+
+    def _read_mechanisms(
+        self, slot: int, token_properties: TokenProperties | None = None
+    ) -> dict:
+        cache = self.get_mechanism_cache()
+        if cache is not None:
+            return cache.get_mechanisms(self._library, slot, token_properties)
+        return read_mechanisms(self._library, slot)
@@ -1,80 +1,71 @@
-from pkcs11_cryptography_keys import (
-    LibraryProperties,
-    MechanismProperties,
-    MultiCertificateContainer,
-    SlotProperties,
-    TokenProperties,
-)
+from typing import AsyncIterator
+
+from pkcs11_cryptography_keys import SlotProperties, TokenProperties
 from PyKCS11 import PyKCS11Lib
 
+from .pkcs11_base_scanner import PKCS11BaseScanner
+from .pkcs11_library_pool import PKCS11LibraryPool, load_library
+from .pkcs11_query import PKCS11Query
+from .pkcs11_scan_stream import PKCS11ScanItem, PKCS11ScanItemType
 
-class PKCS11CardScanner(object):
-    def __init__(self, library: PyKCS11Lib) -> None:
-        self._library = library
 
-    @classmethod
-    def from_library_path(cls, library_path: str | None = None):
-        library = PyKCS11Lib()
-        if library_path is not None:
-            library.load(library_path)
-        else:
-            library.load()
-        return cls(library)
+class PKCS11CardScanner(PKCS11BaseScanner):
+    def __init__(
+        self, library: PyKCS11Lib, max_workers: int | None = None
+    ) -> None:
+        super().__init__(library, max_workers)
 
-    async def scan_from_library(
-        self,
-        pin: str | None = None,
-    ) -> dict:
-        ret: dict = {}
-        login_required = False
+    @classmethod
+    def from_library_path(
+        cls,
+        library_path: str | None = None,
+        max_workers: int | None = None,
+        pool: PKCS11LibraryPool | None = None,
+    ):
+        scanner = cls(load_library(library_path, pool), max_workers)
+        scanner._library_owner = pool
+        return scanner
 
-        lp = LibraryProperties.read_from_slot(self._library)
-        for tag, val in lp.gen_tags():
-            ret[tag] = val
-        slots = self._library.getSlotList(tokenPresent=True)
-        ret["slots"] = []
-        for sl in slots:
+    async def _gen_slot(
+        self, sl: int, pin: str | None, query: PKCS11Query | None = None
+    ) -> AsyncIterator[PKCS11ScanItem]:
+        tp = TokenProperties.read_from_slot(self._library, sl)
+        if tp.is_initialized() and (query is None or query.matches_token(tp)):
             slot = {}
-            tp = TokenProperties.read_from_slot(self._library, sl)
-            if tp.is_login_required():
-                login_required = True
-            if tp.is_initialized():
-                sp = SlotProperties.read_from_slot(self._library, sl)
-                for tag, val in sp.gen_tags():
-                    slot[tag] = val
-                slot["token"] = {}
-                # slot["token"]["max_pin_length"] = tp.get_max_pin_length()
-                # slot["token"]["min_pin_length"] = tp.get_min_pin_length()
-                for tag, val in tp.gen_tags():
-                    slot["token"][tag] = val
-                slot["token"]["HW_slot"] = sp.is_hardware_slot()
-                slot["token"]["removable_slot"] = sp.is_removable()
-                certs = list()
-                mcc = await MultiCertificateContainer.read_slot(
-                    self._library, sl, login_required, pin
+            sp = SlotProperties.read_from_slot(self._library, sl)
+            for tag, val in sp.gen_tags():
+                slot[tag] = val
+            yield PKCS11ScanItem(PKCS11ScanItemType.slot, slot, sl)
+            token = {}
+            # token["max_pin_length"] = tp.get_max_pin_length()
+            # token["min_pin_length"] = tp.get_min_pin_length()
+            for tag, val in tp.gen_tags():
+                token[tag] = val
+            token["HW_slot"] = sp.is_hardware_slot()
+            token["removable_slot"] = sp.is_removable()
+            yield PKCS11ScanItem(PKCS11ScanItemType.token, token, sl)
+            mcc = await self._read_certificates(
+                sl, tp.is_login_required(), pin, query
+            )
+            if mcc is not None:
+                async for (
+                    key_id,
+                    key_label,
+                    cert_props,
+                ) in mcc.gen_certificates_for_token():
+                    cert_data = cert_props.get_certificate_data()
+                    if cert_data is not None:
+                        cert_data["key_id"] = key_id
+                        cert_data["key_label"] = key_label
+                        yield PKCS11ScanItem(
+                            PKCS11ScanItemType.object,
+                            cert_data,
+                            sl,
+                            "certificates",
+                        )
+            if query is None or query.has_mechanisms():
+                yield PKCS11ScanItem(
+                    PKCS11ScanItemType.mechanisms,
+                    self._read_mechanisms(sl, tp),
+                    sl,
                 )
-                if mcc is not None:
-                    async for (
-                        key_id,
-                        key_label,
-                        cert_props,
-                    ) in mcc.gen_certificates_for_token():
-                        cert_data = cert_props.get_certificate_data()
-                        if cert_data is not None:
-                            cert_data["key_id"] = key_id
-                            cert_data["key_label"] = key_label
-                            certs.append(cert_data)
-                    if len(certs) > 0:
-                        slot["token"]["certificates"] = certs
-                slot["token"]["mechanisms"] = {}
-                for mp in MechanismProperties.gen_mechanism_properties(
-                    self._library, sl
-                ):
-                    slot["token"]["mechanisms"][mp.get_mechanism_type()] = {}
-                    for tag, val in mp.gen_tags():
-                        slot["token"]["mechanisms"][mp.get_mechanism_type()][
-                            tag
-                        ] = val
-                ret["slots"].append(slot)
-
-        return ret
@@ -0,0 +1,71 @@
+from cryptography.x509 import load_der_x509_certificate
+from pkcs11_cryptography_keys import MultiCertificateContainer
+from PyKCS11 import (
+    CKA_CLASS,
+    CKA_ID,
+    CKA_LABEL,
+    CKA_VALUE,
+    CKO_CERTIFICATE,
+    PyKCS11Lib,
+)
+
+from .pkcs11_library_pool import PKCS11LibraryPool, close_session, open_session
+
+
+async def read_certificate_values(
+    library: PyKCS11Lib,
+    slot: int,
+    login_required: bool,
+    pin: str | None = None,
+    template: list[tuple] | None = None,
+    pool: PKCS11LibraryPool | None = None,
+) -> dict[bytes, tuple[str, bytes]]:
+    # label and DER value of every certificate by id, nothing is decoded
+    if template is None:
+        template = [(CKA_CLASS, CKO_CERTIFICATE)]
+    certificates: dict[bytes, tuple[str, bytes]] = dict()
+    if pool is not None:
+        session, logged_in = pool.acquire_session(
+            library, slot, login_required, pin
+        )
+    else:
+        session, logged_in = open_session(library, slot, login_required, pin)
+    valid = False
+    try:
+        for cert in session.findObjects(template):
+            attrs = session.getAttributeValue(
+                cert, [CKA_LABEL, CKA_ID, CKA_VALUE]
+            )
+            certificates[bytes(attrs[1])] = (attrs[0], bytes(attrs[2]))
+        valid = True
+    finally:
+        if pool is not None:
+            pool.release_session(session, logged_in, valid)
+        else:
+            close_session(session, logged_in)
+    return certificates
+
+
+async def read_certificate_container(
+    library: PyKCS11Lib,
+    slot: int,
+    login_required: bool,
+    pin: str | None = None,
+    template: list[tuple] | None = None,
+    pool: PKCS11LibraryPool | None = None,
+) -> MultiCertificateContainer | None:
+    # same as MultiCertificateContainer.read_slot, with a narrower template
+    values = await read_certificate_values(
+        library, slot, login_required, pin, template, pool
+    )
+    if len(values) > 0:
+        return MultiCertificateContainer(
+            {
+                key_id: {
+                    "label": label,
+                    "certificate": load_der_x509_certificate(der),
+                }
+                for key_id, (label, der) in values.items()
+            }
+        )
+    return None
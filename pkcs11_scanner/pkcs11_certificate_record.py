@@ -0,0 +1,302 @@
+from asyncio import gather, get_running_loop
+from collections.abc import MutableMapping
+from concurrent.futures import Executor
+from typing import Any, Iterator
+
+from cryptography.x509 import (
+    Certificate,
+    ObjectIdentifier,
+    load_der_x509_certificate,
+)
+from pkcs11_cryptography_keys import CertificateProperties
+
+# X.509 key usage bits in the order of the BIT STRING
+_key_usage_bits: list[str] = [
+    "digital_signature",
+    "content_commitment",
+    "key_encipherment",
+    "data_encipherment",
+    "key_agreement",
+    "key_cert_sign",
+    "crl_sign",
+    "encipher_only",
+    "decipher_only",
+]
+# same order as the key usage dict of CertificateProperties
+_key_usage_names: list[str] = [
+    "digital_signature",
+    "content_commitment",
+    "crl_sign",
+    "key_cert_sign",
+    "data_encipherment",
+    "key_agreement",
+    "key_encipherment",
+]
+_key_agreement_names: list[str] = ["encipher_only", "decipher_only"]
+_key_usage_oid = b"\x55\x1d\x0f"
+
+_basic_keys: tuple[str, ...] = (
+    "version",
+    "serial_number",
+    "singature_algorithm",
+    "not_valid_before",
+    "not_valid_after",
+)
+_lazy_keys: tuple[str, ...] = _basic_keys + (
+    "key_algorithm",
+    "subject",
+    "issuer",
+    "key_usage",
+)
+_decode_batch_size = 16
+
+
+def _read_tlv(der: bytes, pos: int) -> tuple[int, int, int]:
+    tag = der[pos]
+    length = der[pos + 1]
+    start = pos + 2
+    if length & 0x80:
+        size = length & 0x7F
+        if size == 0 or size > 4:
+            raise ValueError("Unsupported DER length")
+        length = int.from_bytes(der[start : start + size], "big")
+        start += size
+    end = start + length
+    if end > len(der):
+        raise ValueError("DER value out of range")
+    return tag, start, end
+
+
+def _find_key_usage(der: bytes) -> bytes | None:
+    _, start, _ = _read_tlv(der, 0)
+    tag, pos, end = _read_tlv(der, start)
+    if tag != 0x30:
+        raise ValueError("Not a certificate")
+    while pos < end:
+        tag, start, pos = _read_tlv(der, pos)
+        if tag != 0xA3:
+            continue
+        # extensions are explicitly tagged [3] in the TBS certificate
+        _, ext_pos, ext_end = _read_tlv(der, start)
+        while ext_pos < ext_end:
+            _, field, ext_pos = _read_tlv(der, ext_pos)
+            tag, oid_start, field = _read_tlv(der, field)
+            if tag != 0x06 or der[oid_start:field] != _key_usage_oid:
+                continue
+            tag, start, end = _read_tlv(der, field)
+            if tag == 0x01:
+                tag, start, end = _read_tlv(der, end)
+            if tag != 0x04:
+                raise ValueError("Extension value is not an OCTET STRING")
+            tag, start, end = _read_tlv(der, start)
+            if tag != 0x03 or start >= end:
+                raise ValueError("Key usage is not a BIT STRING")
+            # the first byte counts unused bits
+            return der[start + 1 : end]
+        return None
+    return None
+
+
+def read_key_usage(der: bytes) -> dict | None:
+    # walks the DER to the key usage extension without decoding the rest
+    # of the certificate, None when the certificate can not be pre-parsed
+    try:
+        bits = _find_key_usage(der)
+    except (IndexError, ValueError):
+        return None
+    if bits is None:
+        return {}
+    flags = {}
+    for i, name in enumerate(_key_usage_bits):
+        flags[name] = i // 8 < len(bits) and bool(
+            bits[i // 8] & (0x80 >> (i % 8))
+        )
+    ret = {name: flags[name] for name in _key_usage_names}
+    if ret["key_agreement"]:
+        for name in _key_agreement_names:
+            ret[name] = flags[name]
+    return ret
+
+
+def is_conformant_key_usage(key_usage: dict, filter: dict) -> bool:
+    # same rule as CertificateProperties.has_conformant_key_usage
+    ret = False
+    for f_nm, f_v in filter.items():
+        if f_nm in key_usage and f_v == key_usage[f_nm]:
+            ret = True
+        else:
+            return False
+    return ret
+
+
+def _decode_group(certificate: Certificate, key: str) -> dict:
+    cp = CertificateProperties(certificate)
+    if key in _basic_keys:
+        return cp.get_basic_data()
+    if key == "key_algorithm":
+        return {key: cp.get_key_type()}
+    if key == "subject":
+        subject = cp.get_subject_data_from_certificate()
+        alt_names = cp.get_subject_alt_names_from_certificate()
+        if alt_names is not None:
+            subject.update(alt_names)
+        return {key: subject}
+    if key == "issuer":
+        return {key: cp.get_issuer_data_from_certificate()}
+    key_usage = cp.get_X509_key_usages_from_certificate()
+    key_usage.update(cp.get_X509_extended_key_usages_from_certificate())
+    return {key: key_usage}
+
+
+def decode_certificate(der: bytes, add_certificate: bool = False) -> dict:
+    certificate = load_der_x509_certificate(der)
+    data = CertificateProperties(certificate).get_certificate_data(
+        add_certificate
+    )
+    return data
+
+
+def _decode_portable(ders: list[bytes]) -> list[dict]:
+    # runs in worker processes, object identifiers do not pickle
+    ret = []
+    for der in ders:
+        data = decode_certificate(der)
+        data["singature_algorithm"] = data["singature_algorithm"].dotted_string
+        ret.append(data)
+    return ret
+
+
+async def decode_certificates(
+    ders: list[bytes],
+    add_certificate: bool = False,
+    executor: Executor | None = None,
+) -> list[dict]:
+    if executor is None:
+        return [decode_certificate(der, add_certificate) for der in ders]
+    loop = get_running_loop()
+    batches = await gather(
+        *[
+            loop.run_in_executor(
+                executor,
+                _decode_portable,
+                ders[i : i + _decode_batch_size],
+            )
+            for i in range(0, len(ders), _decode_batch_size)
+        ]
+    )
+    ret = []
+    for batch in batches:
+        ret.extend(batch)
+    for data, der in zip(ret, ders):
+        data["singature_algorithm"] = ObjectIdentifier(
+            data["singature_algorithm"]
+        )
+        if add_certificate:
+            data["certificate_object"] = load_der_x509_certificate(der)
+    return ret
+
+
+def _restore_record(
+    der: bytes, add_certificate: bool, values: dict, removed: set
+) -> "PKCS11CertificateRecord":
+    record = PKCS11CertificateRecord(der, add_certificate)
+    record._values = values
+    record._removed = removed
+    return record
+
+
+class PKCS11CertificateRecord(MutableMapping):
+    def __init__(self, der: bytes, add_certificate: bool = False):
+        self._der = der
+        self._add_certificate = add_certificate
+        self._certificate: Certificate | None = None
+        self._key_usage: dict | None = None
+        self._decoded: dict[str, Any] = {}
+        self._values: dict[str, Any] = {}
+        self._removed: set[str] = set()
+
+    def get_der(self) -> bytes:
+        return self._der
+
+    def get_certificate(self) -> Certificate:
+        if self._certificate is None:
+            self._certificate = load_der_x509_certificate(self._der)
+        return self._certificate
+
+    def get_key_usage(self) -> dict:
+        if self._key_usage is None:
+            key_usage = read_key_usage(self._der)
+            if key_usage is None:
+                key_usage = CertificateProperties(
+                    self.get_certificate()
+                ).get_X509_key_usages_from_certificate()
+            self._key_usage = key_usage
+        return self._key_usage
+
+    def has_conformant_key_usage(self, filter: dict) -> bool:
+        return is_conformant_key_usage(self.get_key_usage(), filter)
+
+    def is_decoded(self) -> bool:
+        return len(self._decoded) > 0 or self._certificate is not None
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def __has_lazy(self, key: str) -> bool:
+        if key in self._removed:
+            return False
+        return key in _lazy_keys or (
+            key == "certificate_object" and self._add_certificate
+        )
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._values:
+            return self._values[key]
+        if not self.__has_lazy(key):
+            raise KeyError(key)
+        if key == "certificate_object":
+            return self.get_certificate()
+        if key not in self._decoded:
+            self._decoded.update(_decode_group(self.get_certificate(), key))
+        return self._decoded[key]
+
+    def __setitem__(self, key: str, value: Any):
+        self._removed.discard(key)
+        self._values[key] = value
+
+    def __delitem__(self, key: str):
+        if key in self._values:
+            del self._values[key]
+        elif not self.__has_lazy(key):
+            raise KeyError(key)
+        if key in _lazy_keys or key == "certificate_object":
+            self._removed.add(key)
+
+    def __iter__(self) -> Iterator[str]:
+        for key in _lazy_keys + ("certificate_object",):
+            if key in self._values or self.__has_lazy(key):
+                yield key
+        for key in self._values:
+            if key not in _lazy_keys and key != "certificate_object":
+                yield key
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __reduce__(self):
+        # decoded fields are not stored, they are decoded again on access
+        return _restore_record, (
+            self._der,
+            self._add_certificate,
+            self._values,
+            self._removed,
+        )
+
+    def __repr__(self):
+        return "PKCS11CertificateRecord({0})".format(
+            {
+                k: v
+                for k, v in self._values.items()
+                if k in ("key_id", "key_label")
+            }
+        )
@@ -1,9 +1,9 @@
+from concurrent.futures import Executor
 from queue import Queue
 
 from PyKCS11 import PyKCS11Lib
 
 from .pkcs11_check_thread import PKCS11CheckThread
-from .pkcs11_scan import PKCS11Scan
 from .pkcs11_X509_scanner import PKCS11X506Scanner
 
 
@@ -19,11 +19,19 @@ class PKCS11CheckX509ScanThread(PKCS11CheckThread):
         super().__init__(library_path, comm_queue, refresh_seconds)
         self._filter = token_filter
         self._add_certificate = add_certificate
+        self._lazy_certificates = False
+        self._decode_executor: Executor | None = None
 
-    async def _on_token_present(self, library: PyKCS11Lib):
+    def set_lazy_certificates(self, lazy: bool = True):
+        self._lazy_certificates = lazy
+
+    def set_decode_executor(self, executor: Executor | None):
+        self._decode_executor = executor
+
+    def _get_scanner(self, library: PyKCS11Lib) -> PKCS11X506Scanner:
         scanner = PKCS11X506Scanner(
             library, self._filter, self._add_certificate
         )
-        data = await scanner.scan_from_library()
-        ret = PKCS11Scan(data)
-        return ret
+        scanner.set_lazy_certificates(self._lazy_certificates)
+        scanner.set_decode_executor(self._decode_executor)
+        return scanner
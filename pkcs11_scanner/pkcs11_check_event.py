@@ -0,0 +1,84 @@
+from typing import Any
+
+from pkcs11_cryptography_keys import SlotProperties
+
+from .pkcs11_check_error import PKCS11CheckError
+from .pkcs11_scan import PKCS11Scan
+from .pkcs11_scan_stream import PKCS11ScanItem
+from .pkcs11_slot_change import PKCS11SlotChange
+
+
+class PKCS11CheckEvent(object):
+    def __init__(self, data: Any):
+        self._data = data
+
+    def get_data(self) -> Any:
+        return self._data
+
+    def __str__(self):
+        return str(self._data)
+
+
+class PKCS11SlotEvent(PKCS11CheckEvent):
+    def __init__(
+        self, slot_properties: SlotProperties, slot_id: int | None = None
+    ):
+        super().__init__(slot_properties)
+        # slot properties do not carry the id of their slot
+        self._slot_id = slot_id
+
+    def get_slot_properties(self) -> SlotProperties:
+        return self._data
+
+    def get_slot_id(self) -> int | None:
+        return self._slot_id
+
+
+class PKCS11ScanEvent(PKCS11CheckEvent):
+    def __init__(self, scan: PKCS11Scan):
+        super().__init__(scan)
+
+    def get_scan(self) -> PKCS11Scan:
+        return self._data
+
+
+class PKCS11SlotChangeEvent(PKCS11CheckEvent):
+    def __init__(self, slot_change: PKCS11SlotChange):
+        super().__init__(slot_change)
+
+    def get_slot_change(self) -> PKCS11SlotChange:
+        return self._data
+
+
+class PKCS11ScanItemEvent(PKCS11CheckEvent):
+    def __init__(self, scan_item: PKCS11ScanItem):
+        super().__init__(scan_item)
+
+    def get_scan_item(self) -> PKCS11ScanItem:
+        return self._data
+
+
+class PKCS11ErrorEvent(PKCS11CheckEvent):
+    def __init__(self, error: PKCS11CheckError):
+        super().__init__(error)
+
+    def get_error(self) -> PKCS11CheckError:
+        return self._data
+
+
+_event_types: list[tuple[type, type[PKCS11CheckEvent]]] = [
+    (SlotProperties, PKCS11SlotEvent),
+    (PKCS11Scan, PKCS11ScanEvent),
+    (PKCS11SlotChange, PKCS11SlotChangeEvent),
+    (PKCS11ScanItem, PKCS11ScanItemEvent),
+    (PKCS11CheckError, PKCS11ErrorEvent),
+]
+
+
+def make_check_event(data: Any, slot_id: int | None = None) -> PKCS11CheckEvent:
+    if isinstance(data, SlotProperties):
+        return PKCS11SlotEvent(data, slot_id)
+    for data_type, event_type in _event_types:
+        if isinstance(data, data_type):
+            return event_type(data)
+    return PKCS11CheckEvent(data)
@@ -0,0 +1,584 @@
+from asyncio import AbstractEventLoop
+from asyncio import Queue as AsyncQueue
+from asyncio import Task, get_running_loop
+from asyncio import sleep as async_sleep
+from concurrent.futures import Executor
+from threading import Event, Thread, get_ident
+from typing import Any, Awaitable, Callable
+
+from pkcs11_cryptography_keys import SlotProperties, TokenException
+from PyKCS11 import (
+    CKF_DONT_BLOCK,
+    CKR_FUNCTION_NOT_SUPPORTED,
+    CKR_NO_EVENT,
+    PyKCS11Error,
+    PyKCS11Lib,
+)
+
+from .pkcs11_base_scanner import PKCS11BaseScanner
+from .pkcs11_check_error import PKCS11CheckError
+from .pkcs11_check_event import (
+    PKCS11CheckEvent,
+    PKCS11SlotEvent,
+    make_check_event,
+)
+from .pkcs11_deadlines import (
+    PKCS11CallDeadlines,
+    PKCS11CallTimeout,
+    set_library_deadlines,
+)
+from .pkcs11_instrumentation import (
+    PKCS11CallStatistics,
+    get_library_statistics,
+    instrument_library,
+)
+from .pkcs11_library_pool import PKCS11LibraryPool
+from .pkcs11_scan import PKCS11Scan
+from .pkcs11_scan_records import PKCS11LibraryRecord
+from .pkcs11_scan_stream import PKCS11ScanItem
+from .pkcs11_slot_change import PKCS11SlotChange, PKCS11SlotChangeType
+from .pkcs11_slot_health import PKCS11SlotHealth
+
+PKCS11ScannerFactory = Callable[[PyKCS11Lib], PKCS11BaseScanner | None]
+PKCS11TokenPresentHandler = Callable[[PyKCS11Lib], Awaitable[Any]]
+PKCS11ErrorHandler = Callable[[str], None]
+PKCS11LibraryLoader = Callable[[str], PyKCS11Lib]
+
+# token fields that change while the token itself does not
+_volatile_token_fields = (
+    "ulSessionCount",
+    "ulRwSessionCount",
+    "ulFreePublicMemory",
+    "ulFreePrivateMemory",
+    "utcTime",
+)
+
+
+def _load_library(library_path: str) -> PyKCS11Lib:
+    library = PyKCS11Lib()
+    library.load(library_path)
+    return library
+
+
+def _get_stable_slot(slot: dict) -> dict:
+    token = slot.get("token", None)
+    if token is None:
+        return slot
+    ret = dict(slot)
+    ret["token"] = {
+        tag: val
+        for tag, val in token.items()
+        if tag not in _volatile_token_fields
+    }
+    return ret
+
+
+class PKCS11CheckMonitor(object):
+    def __init__(
+        self,
+        library_path: str,
+        refresh_seconds: int = 1,
+        scanner_factory: PKCS11ScannerFactory | None = None,
+        comm_queue: AsyncQueue | None = None,
+    ):
+        self._library_path = library_path
+        self._refresh_seconds = refresh_seconds
+        self._scanner_factory = scanner_factory
+        self._comm: AsyncQueue = (
+            comm_queue if comm_queue is not None else AsyncQueue()
+        )
+        self._sink: Callable[[Any], None] | None = None
+        self._token_present_handler: PKCS11TokenPresentHandler | None = None
+        self._error_handler: PKCS11ErrorHandler | None = None
+        self._slot_events = False
+        self._library: PyKCS11Lib | None = None
+        self._library_loader: PKCS11LibraryLoader | None = None
+        self._executor: Executor | None = None
+        self._loop: AbstractEventLoop | None = None
+        self._loop_thread: int | None = None
+        self._task: Task | None = None
+        self._stop_event = Event()
+        self._incremental = False
+        self._send_delta = False
+        self._library_info: dict | None = None
+        self._slot_scans: dict[int, dict] = {}
+        self._blocking_wait = False
+        self._wait_loop: AbstractEventLoop | None = None
+        self._wait_events: AsyncQueue | None = None
+        self._poll_min_seconds: float | None = None
+        self._poll_max_seconds: float = refresh_seconds
+        self._poll_factor: float = 2
+        self._poll_interval: float = refresh_seconds
+        self._suppress_unchanged = False
+        self._slot_states: dict[int, tuple] = {}
+        self._ticks = 0
+        self._events = 0
+        self._suppressed = 0
+        self._compact_results = False
+        self._progressive = False
+        self._call_statistics: PKCS11CallStatistics | None = None
+        self._scan_statistics: PKCS11CallStatistics | None = None
+        self._library_pool: PKCS11LibraryPool | None = None
+        self._pooled_library: PyKCS11Lib | None = None
+        self._call_deadlines: PKCS11CallDeadlines | None = None
+        self._slot_health: PKCS11SlotHealth | None = None
+
+    def get_library_path(self) -> str:
+        return self._library_path
+
+    def get_queue(self) -> AsyncQueue:
+        return self._comm
+
+    def set_sink(self, sink: Callable[[Any], None] | None):
+        self._sink = sink
+
+    def set_token_present_handler(
+        self, handler: PKCS11TokenPresentHandler | None
+    ):
+        # replaces the scan made when a token is present
+        self._token_present_handler = handler
+
+    def set_error_handler(self, handler: PKCS11ErrorHandler | None):
+        # receives errors the monitor goes on after, by default they are
+        # sent as PKCS11CheckError
+        self._error_handler = handler
+
+    def set_slot_events(self, slot_events: bool = True):
+        # the sink gets slot states as PKCS11SlotEvent with the slot id,
+        # instead of bare SlotProperties
+        self._slot_events = slot_events
+
+    def set_library_loader(self, loader: PKCS11LibraryLoader | None):
+        # loads the library from its path in open, instead of PyKCS11Lib
+        self._library_loader = loader
+
+    def set_executor(self, executor: Executor | None):
+        self._executor = executor
+
+    def set_stop_event(self):
+        self._stop_event.set()
+        if self._wait_loop is not None and self._wait_events is not None:
+            try:
+                self._wait_loop.call_soon_threadsafe(
+                    self._wait_events.put_nowait, None
+                )
+            except RuntimeError:
+                # loop already closed
+                pass
+
+    def clear_stop_event(self):
+        # a stopped monitor can be opened again
+        self._stop_event.clear()
+
+    def is_stopped(self) -> bool:
+        return self._stop_event.is_set()
+
+    def set_blocking_wait(self, blocking: bool = True):
+        self._blocking_wait = blocking
+
+    def set_incremental_scan(self, send_delta: bool = False):
+        self._incremental = True
+        self._send_delta = send_delta
+
+    def set_adaptive_polling(
+        self,
+        min_seconds: float = 0.1,
+        max_seconds: float = 5,
+        factor: float = 2,
+    ):
+        if not 0 < min_seconds <= max_seconds:
+            raise ValueError(
+                "Polling needs 0 < min_seconds <= max_seconds, got {0:g} "
+                "and {1:g}".format(min_seconds, max_seconds)
+            )
+        if not factor > 1:
+            raise ValueError(
+                "Polling backoff factor must be above 1, got {0:g}".format(
+                    factor
+                )
+            )
+        self._poll_min_seconds = min_seconds
+        self._poll_max_seconds = max_seconds
+        self._poll_factor = factor
+        self._poll_interval = min_seconds
+
+    def set_suppress_unchanged(self, suppress: bool = True):
+        self._suppress_unchanged = suppress
+
+    def set_compact_results(self, compact: bool = True):
+        self._compact_results = compact
+
+    def set_progressive_scan(self, progressive: bool = True):
+        self._progressive = progressive
+
+    def set_call_statistics(self, statistics: PKCS11CallStatistics | None):
+        self._call_statistics = statistics
+
+    def get_call_statistics(self) -> PKCS11CallStatistics | None:
+        return self._call_statistics
+
+    def set_library_pool(self, pool: PKCS11LibraryPool | None):
+        self._library_pool = pool
+
+    def get_library_pool(self) -> PKCS11LibraryPool | None:
+        return self._library_pool
+
+    def set_call_deadlines(self, deadlines: PKCS11CallDeadlines | None):
+        self._call_deadlines = deadlines
+
+    def get_call_deadlines(self) -> PKCS11CallDeadlines | None:
+        return self._call_deadlines
+
+    def set_slot_health(self, health: PKCS11SlotHealth | None):
+        self._slot_health = health
+
+    def get_slot_health(self) -> PKCS11SlotHealth | None:
+        return self._slot_health
+
+    def get_statistics(self) -> dict[str, int]:
+        return {
+            "ticks": self._ticks,
+            "events": self._events,
+            "suppressed": self._suppressed,
+        }
+
+    def __aiter__(self):
+        if self._task is None and self._loop is None:
+            self._task = get_running_loop().create_task(self.async_run())
+        return self
+
+    async def __anext__(self) -> PKCS11CheckEvent:
+        event = await self._comm.get()
+        if event is None:
+            task, self._task = self._task, None
+            if task is not None:
+                # errors of the run surface in the consumer
+                await task
+            raise StopAsyncIteration
+        return event
+
+    async def async_run(self):
+        try:
+            await self.open()
+            if self._blocking_wait:
+                await self._wait_run(self._get_library())
+            else:
+                await self._poll_run()
+        finally:
+            if self._sink is None:
+                # marks the end of the event stream
+                self._comm.put_nowait(None)
+            self.close()
+
+    async def open(self):
+        # loads the library for step, close releases it
+        self._loop = get_running_loop()
+        self._loop_thread = get_ident()
+        self._library = await self._load_library()
+
+    async def step(self) -> bool:
+        # checks for one slot event and sleeps until the next check,
+        # returns whether there was an event, errors the monitor does not
+        # go on after are raised
+        if self._stop_event.is_set():
+            return False
+        had_event = False
+        try:
+            await self._check_slot_event(self._get_library())
+            had_event = True
+        except PyKCS11Error as ne:
+            if ne.value != CKR_NO_EVENT:
+                self._on_error(str(ne))
+        except PKCS11CallTimeout as te:
+            # a hung call does not stop the monitor
+            self._on_error(str(te))
+        await self._poll_sleep(had_event)
+        return had_event
+
+    def close(self):
+        self._release_library()
+        self._library = None
+        self._loop = None
+        self._loop_thread = None
+
+    def _get_library(self) -> PyKCS11Lib:
+        if self._library is None:
+            raise RuntimeError(
+                "Monitor of {0} is not open".format(self._library_path)
+            )
+        return self._library
+
+    def _on_error(self, msg: str):
+        if self._error_handler is not None:
+            self._error_handler(msg)
+        else:
+            self._put(PKCS11CheckError(msg))
+
+    async def _load_library(self) -> PyKCS11Lib:
+        pool = self._library_pool
+        if pool is not None:
+            library = await self._run_blocking(
+                pool.acquire_library, self._library_path
+            )
+            self._pooled_library = library
+        else:
+            loader = self._library_loader
+            if loader is None:
+                loader = _load_library
+            library = await self._run_blocking(loader, self._library_path)
+        if self._call_deadlines is not None:
+            library = set_library_deadlines(library, self._call_deadlines)
+        if self._call_statistics is not None:
+            library = instrument_library(library, self._call_statistics)
+        return library
+
+    def _release_library(self):
+        if self._library_pool is not None and self._pooled_library is not None:
+            self._library_pool.release_library(self._pooled_library)
+        self._pooled_library = None
+
+    async def _run_blocking(self, func: Callable, *args) -> Any:
+        return await get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    def _put(self, data: Any, slot_id: int | None = None):
+        if self._sink is not None:
+            if self._slot_events and isinstance(data, SlotProperties):
+                data = PKCS11SlotEvent(data, slot_id)
+            self._sink(data)
+            return
+        event = make_check_event(data, slot_id)
+        loop = self._loop
+        if loop is not None and get_ident() != self._loop_thread:
+            try:
+                loop.call_soon_threadsafe(self._comm.put_nowait, event)
+            except RuntimeError:
+                # loop already closed
+                pass
+        else:
+            self._comm.put_nowait(event)
+
+    async def _poll_run(self):
+        try:
+            while not self._stop_event.is_set():
+                await self.step()
+        except Exception as ex:
+            self._put(PKCS11CheckError(str(ex)))
+
+    async def _poll_sleep(self, had_event: bool):
+        if self._poll_min_seconds is None:
+            await async_sleep(self._refresh_seconds)
+        else:
+            if had_event:
+                self._poll_interval = self._poll_min_seconds
+            else:
+                self._poll_interval = min(
+                    self._poll_interval * self._poll_factor,
+                    self._poll_max_seconds,
+                )
+            # sleep in short steps so a long backoff does not delay stopping
+            remaining = self._poll_interval
+            while remaining > 0 and not self._stop_event.is_set():
+                step = min(remaining, 0.5)
+                await async_sleep(step)
+                remaining -= step
+
+    async def _wait_run(self, library: PyKCS11Lib):
+        self._wait_loop = get_running_loop()
+        self._wait_events = AsyncQueue()
+        waiter = Thread(
+            target=self.__wait_for_events,
+            args=(library, self._wait_loop, self._wait_events),
+            name="PKCS11 slot event waiter",
+            daemon=True,
+        )
+        waiter.start()
+        running = not self._stop_event.is_set()
+        while running:
+            event = await self._wait_events.get()
+            try:
+                if event is None or self._stop_event.is_set():
+                    running = False
+                elif isinstance(event, PyKCS11Error):
+                    if event.value == CKR_FUNCTION_NOT_SUPPORTED:
+                        # module can not block, fall back to polling
+                        running = False
+                        await self._poll_run()
+                    elif event.value != CKR_NO_EVENT:
+                        self._on_error(str(event))
+                elif isinstance(event, Exception):
+                    raise event
+                else:
+                    self._ticks += 1
+                    await self._on_slot_event(library, event)
+            except (PyKCS11Error, PKCS11CallTimeout) as ne:
+                self._on_error(str(ne))
+            except Exception as ex:
+                self._put(PKCS11CheckError(str(ex)))
+                running = False
+        self._wait_loop = None
+        self._wait_events = None
+
+    def __wait_for_events(
+        self,
+        library: PyKCS11Lib,
+        loop: AbstractEventLoop,
+        events: AsyncQueue,
+    ):
+        waiting = True
+        while waiting and not self._stop_event.is_set():
+            event: int | Exception
+            try:
+                event = library.waitForSlotEvent()
+            except PyKCS11Error as ne:
+                event = ne
+                waiting = ne.value != CKR_FUNCTION_NOT_SUPPORTED
+            except Exception as ex:
+                event = ex
+                waiting = False
+            try:
+                loop.call_soon_threadsafe(events.put_nowait, event)
+            except RuntimeError:
+                # loop already closed
+                waiting = False
+            if waiting and isinstance(event, Exception):
+                self._stop_event.wait(self._refresh_seconds)
+
+    async def _check_slot_event(self, library: PyKCS11Lib):
+        self._ticks += 1
+        slot = await self._run_blocking(
+            library.waitForSlotEvent, CKF_DONT_BLOCK
+        )
+        await self._on_slot_event(library, slot)
+
+    async def _on_slot_event(self, library: PyKCS11Lib, slot: int):
+        await self._handle_slot_event(library, slot)
+
+    async def _handle_slot_event(self, library: PyKCS11Lib, slot: int):
+        self._events += 1
+        statistics = get_library_statistics(library)
+        if statistics is not None:
+            # calls made while handling this event are summarized on the scan
+            self._scan_statistics = PKCS11CallStatistics(parent=statistics)
+            library = instrument_library(library, self._scan_statistics)
+        try:
+            # events are handled on this loop, only the calls that block
+            # go to the executor
+            sp = await self._run_blocking(
+                SlotProperties.read_from_slot, library, slot
+            )
+        except PKCS11CallTimeout as te:
+            if self._slot_health is not None:
+                self._slot_health.mark_degraded(slot, str(te))
+            raise
+        state = (tuple(sp.gen_tags()), tuple(sp.gen_set_flags()))
+        if self._suppress_unchanged and self._slot_states.get(slot) == state:
+            self._suppressed += 1
+        else:
+            self._put(sp, slot)
+        self._slot_states[slot] = state
+        if self._library_pool is not None and not sp.is_token_present():
+            # sessions of a removed token are gone
+            await self._run_blocking(
+                self._library_pool.invalidate, library, slot
+            )
+        if self._incremental:
+            await self._rescan_slot(library, slot, sp)
+        elif sp.is_token_present():
+            handler = self._token_present_handler
+            if handler is None:
+                handler = self.scan_library
+            ret_data = await handler(library)
+            if ret_data is not None and hasattr(ret_data, "has_data"):
+                if ret_data.has_data():
+                    # send tokens to queue
+                    self._put(ret_data)
+                else:
+                    raise TokenException(
+                        "No token present. Please insert card."
+                    )
+
+    async def _rescan_slot(
+        self, library: PyKCS11Lib, slot: int, sp: SlotProperties
+    ):
+        scanner = self._get_scanner(library)
+        if scanner is None:
+            return
+        if self._library_info is None:
+            # first event seeds the state of all slots
+            self._library_info = await scanner.scan_library_info()
+            slots = await self._run_blocking(library.getSlotList, True)
+            rez = await scanner.scan_slots(slots, on_item=self._on_scan_item)
+            self._slot_scans = {
+                sl: data for sl, data in zip(slots, rez) if data is not None
+            }
+            if not self._send_delta:
+                self._put(self._get_merged_scan())
+            else:
+                for sl, data in self._slot_scans.items():
+                    self._put(
+                        PKCS11SlotChange(sl, PKCS11SlotChangeType.added, data)
+                    )
+            return
+        previous = self._slot_scans.get(slot, None)
+        current = None
+        if sp.is_token_present():
+            current = await scanner.scan_slot(slot, on_item=self._on_scan_item)
+        change_type = None
+        if current is not None:
+            self._slot_scans[slot] = current
+            if previous is None:
+                change_type = PKCS11SlotChangeType.added
+            elif _get_stable_slot(previous) != _get_stable_slot(current):
+                change_type = PKCS11SlotChangeType.changed
+        elif previous is not None:
+            del self._slot_scans[slot]
+            change_type = PKCS11SlotChangeType.removed
+        if change_type is not None:
+            if self._send_delta:
+                self._put(PKCS11SlotChange(slot, change_type, current))
+            else:
+                self._put(self._get_merged_scan())
+
+    def _on_scan_item(self, item: PKCS11ScanItem):
+        if self._progressive:
+            self._put(item)
+
+    def _get_merged_scan(self) -> PKCS11Scan:
+        data = dict(self._library_info) if self._library_info else {}
+        data["slots"] = [
+            self._slot_scans[sl] for sl in sorted(self._slot_scans)
+        ]
+        return self._make_scan(data)
+
+    def _make_scan(self, data: dict) -> PKCS11Scan:
+        call_summary = None
+        if self._scan_statistics is not None:
+            call_summary = self._scan_statistics.get_summary()
+        if self._compact_results:
+            return PKCS11Scan(PKCS11LibraryRecord.from_dict(data), call_summary)
+        return PKCS11Scan(data, call_summary)
+
+    def _get_scanner(self, library: PyKCS11Lib) -> PKCS11BaseScanner | None:
+        if self._scanner_factory is None:
+            return None
+        scanner = self._scanner_factory(library)
+        if scanner is not None:
+            if scanner.get_max_workers() is None:
+                # slot scans block, they must not run on this loop
+                scanner.set_max_workers(1)
+            if self._library_pool is not None:
+                scanner.set_library_pool(self._library_pool)
+            if self._call_deadlines is not None:
+                scanner.set_call_deadlines(self._call_deadlines)
+            if self._slot_health is not None:
+                scanner.set_slot_health(self._slot_health)
+        return scanner
+
+    async def scan_library(self, library: PyKCS11Lib) -> PKCS11Scan | None:
+        scanner = self._get_scanner(library)
+        if scanner is not None:
+            data = await scanner.scan_from_library(on_item=self._on_scan_item)
+            return self._make_scan(data)
+        return None
@@ -1,12 +1,15 @@
 from asyncio import run as async_run
-from asyncio import sleep as async_sleep
 from queue import Queue
-from threading import Event, Thread
+from threading import Thread
 
-from pkcs11_cryptography_keys import SlotProperties, TokenException
-from PyKCS11 import CKF_DONT_BLOCK, CKR_NO_EVENT, PyKCS11Error, PyKCS11Lib
+from PyKCS11 import PyKCS11Lib
 
-from .pkcs11_check_error import PKCS11CheckError
+from .pkcs11_base_scanner import PKCS11BaseScanner
+from .pkcs11_check_monitor import PKCS11CheckMonitor
+from .pkcs11_deadlines import PKCS11CallDeadlines
+from .pkcs11_instrumentation import PKCS11CallStatistics
+from .pkcs11_library_pool import PKCS11LibraryPool
+from .pkcs11_slot_health import PKCS11SlotHealth
 
 
 class PKCS11CheckThread(Thread):
@@ -17,47 +20,81 @@ class PKCS11CheckThread(Thread):
         self._library_path = library_path
         self._comm = comm_queue
         self._refresh_seconds = refresh_seconds
-        self._stop_event = Event()
+        self._monitor = PKCS11CheckMonitor(
+            library_path, refresh_seconds, self._get_scanner
+        )
+        # results go to the queue as they are, without event wrappers
+        self._monitor.set_sink(self._comm.put)
+        self._monitor.set_token_present_handler(self._on_token_present)
+
+    def get_monitor(self) -> PKCS11CheckMonitor:
+        return self._monitor
 
     def set_stop_event(self):
-        self._stop_event.set()
+        self._monitor.set_stop_event()
+
+    def set_slot_events(self, slot_events: bool = True):
+        self._monitor.set_slot_events(slot_events)
+
+    def set_blocking_wait(self, blocking: bool = True):
+        self._monitor.set_blocking_wait(blocking)
+
+    def set_incremental_scan(self, send_delta: bool = False):
+        self._monitor.set_incremental_scan(send_delta)
+
+    def set_adaptive_polling(
+        self,
+        min_seconds: float = 0.1,
+        max_seconds: float = 5,
+        factor: float = 2,
+    ):
+        self._monitor.set_adaptive_polling(min_seconds, max_seconds, factor)
+
+    def set_suppress_unchanged(self, suppress: bool = True):
+        self._monitor.set_suppress_unchanged(suppress)
+
+    def set_compact_results(self, compact: bool = True):
+        self._monitor.set_compact_results(compact)
+
+    def set_progressive_scan(self, progressive: bool = True):
+        self._monitor.set_progressive_scan(progressive)
+
+    def set_call_statistics(self, statistics: PKCS11CallStatistics | None):
+        self._monitor.set_call_statistics(statistics)
+
+    def get_call_statistics(self) -> PKCS11CallStatistics | None:
+        return self._monitor.get_call_statistics()
+
+    def set_library_pool(self, pool: PKCS11LibraryPool | None):
+        self._monitor.set_library_pool(pool)
+
+    def get_library_pool(self) -> PKCS11LibraryPool | None:
+        return self._monitor.get_library_pool()
+
+    def set_call_deadlines(self, deadlines: PKCS11CallDeadlines | None):
+        self._monitor.set_call_deadlines(deadlines)
+
+    def get_call_deadlines(self) -> PKCS11CallDeadlines | None:
+        return self._monitor.get_call_deadlines()
+
+    def set_slot_health(self, health: PKCS11SlotHealth | None):
+        self._monitor.set_slot_health(health)
+
+    def get_slot_health(self) -> PKCS11SlotHealth | None:
+        return self._monitor.get_slot_health()
+
+    def get_statistics(self) -> dict[str, int]:
+        return self._monitor.get_statistics()
 
     def run(self):
         async_run(self.async_run())
 
     async def async_run(self):
-        library = PyKCS11Lib()
-        library.load(self._library_path)
-        running = True
-        while running:
-            try:
-                if self._stop_event.is_set():
-                    running = False
-                else:
-                    await self._check_slot_event(library)
-                    await async_sleep(self._refresh_seconds)
-            except PyKCS11Error as ne:
-                if ne.value != CKR_NO_EVENT:
-                    self._comm.put(PKCS11CheckError(str(ne)))
-                await async_sleep(self._refresh_seconds)
-            except Exception as ex:
-                self._comm.put(PKCS11CheckError(str(ex)))
-                running = False
-
-    async def _check_slot_event(self, library):
-        slot = library.waitForSlotEvent(CKF_DONT_BLOCK)
-        sp = SlotProperties.read_from_slot(library, slot)
-        self._comm.put(sp)
-        if sp.is_token_present():
-            ret_data = await self._on_token_present(library)
-            if ret_data is not None and hasattr(ret_data, "has_data"):
-                if ret_data.has_data():
-                    # send tokens to queue
-                    self._comm.put(ret_data)
-                else:
-                    raise TokenException(
-                        "No token present. Please insert card."
-                    )
+        await self._monitor.async_run()
 
     async def _on_token_present(self, library: PyKCS11Lib):
+        # scans with the scanner of this thread, subclasses can replace it
+        return await self._monitor.scan_library(library)
+
+    def _get_scanner(self, library: PyKCS11Lib) -> PKCS11BaseScanner | None:
         return None
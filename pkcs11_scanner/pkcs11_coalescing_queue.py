@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from queue import Queue
+from typing import Any, Callable, Hashable
+
+from pkcs11_cryptography_keys import SlotProperties
+
+from .pkcs11_check_error import PKCS11CheckError
+from .pkcs11_check_event import PKCS11CheckEvent, PKCS11SlotEvent
+from .pkcs11_library_event import PKCS11LibraryEvent
+from .pkcs11_scan import PKCS11Scan
+
+PKCS11CoalescingKey = Callable[[Any], Hashable | None]
+
+
+def _unwrap(item: Any) -> tuple[tuple, int | None, Any]:
+    prefix: tuple = ()
+    slot_id = None
+    while True:
+        if isinstance(item, PKCS11LibraryEvent):
+            prefix += (item.get_library_path(),)
+            item = item.get_event()
+        elif isinstance(item, PKCS11CheckEvent):
+            if isinstance(item, PKCS11SlotEvent):
+                slot_id = item.get_slot_id()
+            item = item.get_data()
+        else:
+            return prefix, slot_id, item
+
+
+def is_error_item(item: Any) -> bool:
+    _, _, item = _unwrap(item)
+    return isinstance(item, (PKCS11CheckError, Exception))
+
+
+def get_coalescing_key(item: Any) -> Hashable | None:
+    # only states are coalesced, deltas, scan items and errors are not
+    prefix, slot_id, item = _unwrap(item)
+    if isinstance(item, PKCS11Scan):
+        return prefix + ("scan", item.get_library_path())
+    if isinstance(item, SlotProperties) and slot_id is not None:
+        # bare slot properties do not tell their slot and are kept as they
+        # are, check threads send slot events with set_slot_events()
+        return prefix + ("slot", slot_id)
+    return None
+
+
+class PKCS11CoalescingQueue(Queue):
+    def __init__(
+        self,
+        maxsize: int = 0,
+        key_function: PKCS11CoalescingKey | None = None,
+    ):
+        # put never blocks, a full queue drops its oldest item instead
+        self._max_depth = maxsize
+        self._key_function: PKCS11CoalescingKey = (
+            key_function if key_function is not None else get_coalescing_key
+        )
+        super().__init__(0)
+
+    def _init(self, maxsize: int):
+        self.queue: OrderedDict[int, Any] = OrderedDict()
+        self._keys: dict[Hashable, int] = {}
+        self._item_keys: dict[int, Hashable] = {}
+        self._sequence = 0
+        self._put_count = 0
+        self._coalesced = 0
+        self._dropped = 0
+        self._dropped_errors = 0
+        self._high_water = 0
+
+    def _qsize(self) -> int:
+        return len(self.queue)
+
+    def _put(self, item: Any):
+        self._put_count += 1
+        key = self._key_function(item)
+        if key is not None:
+            previous = self._keys.pop(key, None)
+            if previous is not None:
+                # the newer state moves to the end, after events it follows
+                self.__remove(previous)
+                self._coalesced += 1
+        if 0 < self._max_depth <= len(self.queue):
+            self.__drop_oldest()
+        self._sequence += 1
+        self.queue[self._sequence] = item
+        if key is not None:
+            self._keys[key] = self._sequence
+            self._item_keys[self._sequence] = key
+        if len(self.queue) > self._high_water:
+            self._high_water = len(self.queue)
+
+    def _get(self) -> Any:
+        sequence, item = self.queue.popitem(last=False)
+        key = self._item_keys.pop(sequence, None)
+        if key is not None:
+            del self._keys[key]
+        return item
+
+    def __drop_oldest(self):
+        # scan items and deltas go first, errors only when nothing else is
+        # left and are counted apart as dropped_errors, latest states are
+        # bounded by their keys and are kept
+        victim = None
+        victim_error = False
+        for sequence, queued in self.queue.items():
+            if sequence in self._item_keys or queued is None:
+                continue
+            if not is_error_item(queued):
+                victim = sequence
+                victim_error = False
+                break
+            if victim is None:
+                victim = sequence
+                victim_error = True
+        if victim is not None:
+            self.__remove(victim)
+            if victim_error:
+                self._dropped_errors += 1
+            else:
+                self._dropped += 1
+
+    def __remove(self, sequence: int):
+        del self.queue[sequence]
+        key = self._item_keys.pop(sequence, None)
+        if key is not None and self._keys.get(key, None) == sequence:
+            del self._keys[key]
+        # the replaced item will never be marked done by a consumer
+        self.unfinished_tasks -= 1
+
+    def get_depth(self) -> int:
+        return self.qsize()
+
+    def get_max_depth(self) -> int:
+        return self._max_depth
+
+    def get_statistics(self) -> dict[str, int]:
+        with self.mutex:
+            return {
+                "depth": len(self.queue),
+                "high_water": self._high_water,
+                "put": self._put_count,
+                "coalesced": self._coalesced,
+                "dropped": self._dropped,
+                "dropped_errors": self._dropped_errors,
+            }
@@ -0,0 +1,312 @@
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from queue import SimpleQueue
+from threading import Lock, Thread
+from time import monotonic
+from typing import Any, Callable, cast
+
+from PyKCS11 import CKF_DONT_BLOCK, PyKCS11Lib
+
+from .pkcs11_instrumentation import (
+    PKCS11_function_names,
+    PKCS11_slot_functions,
+    PKCS11InstrumentedSession,
+    get_library_statistics,
+    instrument_library,
+    uninstrument_library,
+)
+
+
+class PKCS11CallTimeout(TimeoutError):
+    def __init__(self, msg: str, function: str, slot: int | None):
+        super().__init__(msg)
+        self.function = function
+        self.slot = slot
+
+
+class _CallWorker(object):
+    def __init__(self, slot: int | None):
+        self._calls: SimpleQueue = SimpleQueue()
+        self._function: str | None = None
+        name = (
+            "PKCS11 calls" if slot is None else "PKCS11 slot {0}".format(slot)
+        )
+        # a hung call keeps its thread, daemon threads do not block exit
+        self._thread = Thread(target=self.__run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, function: str, call: Callable, args, kwargs) -> Future:
+        future: Future = Future()
+        self._calls.put((future, function, call, args, kwargs))
+        return future
+
+    def get_function(self) -> str | None:
+        return self._function
+
+    def is_busy(self) -> bool:
+        return self._function is not None
+
+    def stop(self):
+        self._calls.put(None)
+
+    def __run(self):
+        while True:
+            task = self._calls.get()
+            if task is None:
+                return
+            future, function, call, args, kwargs = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            self._function = function
+            try:
+                future.set_result(call(*args, **kwargs))
+            except BaseException as ex:
+                future.set_exception(ex)
+            finally:
+                self._function = None
+
+
+class PKCS11CallDeadlines(object):
+    def __init__(
+        self,
+        call_seconds: float | None = 10,
+        slot_seconds: float | None = None,
+    ):
+        self._call_seconds = call_seconds
+        self._slot_seconds = slot_seconds
+        self._lock = Lock()
+        # calls of one slot run in order on the worker of that slot
+        self._workers: dict[int | None, _CallWorker] = {}
+        self._hung: dict[int | None, _CallWorker] = {}
+        # slots being scanned, with their deadline when there is one
+        self._slot_deadlines: dict[int, float | None] = {}
+        self._timed_out: dict[int | None, str] = {}
+        self._statistics: dict[str, int] = {
+            "calls": 0,
+            "timed_out": 0,
+            "cancelled": 0,
+            "refused": 0,
+        }
+
+    def get_call_seconds(self) -> float | None:
+        return self._call_seconds
+
+    def get_slot_seconds(self) -> float | None:
+        return self._slot_seconds
+
+    def start_slot(self, slot: int):
+        with self._lock:
+            self._timed_out.pop(slot, None)
+            self._slot_deadlines[slot] = (
+                monotonic() + self._slot_seconds
+                if self._slot_seconds is not None
+                else None
+            )
+
+    def end_slot(self, slot: int) -> str | None:
+        # returns why the slot timed out, None when it did not
+        with self._lock:
+            self._slot_deadlines.pop(slot, None)
+            return self._timed_out.pop(slot, None)
+
+    def has_timed_out(self, slot: int | None) -> bool:
+        with self._lock:
+            return slot in self._timed_out
+
+    def is_blocked(self, slot: int | None) -> bool:
+        with self._lock:
+            hung = self._hung.get(slot, None)
+            return hung is not None and hung.is_busy()
+
+    def get_statistics(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._statistics)
+
+    def close(self):
+        with self._lock:
+            for worker in self._workers.values():
+                worker.stop()
+            self._workers.clear()
+
+    def call(
+        self, function: str, slot: int | None, call: Callable, *args, **kwargs
+    ) -> Any:
+        with self._lock:
+            timeout, worker = self.__prepare(function, slot)
+            self._statistics["calls"] += 1
+            future = worker.submit(function, call, args, kwargs)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            if future.done() or timeout is None:
+                # the call itself raised a timeout
+                return future.result()
+        msg = "{0} on {1} did not return in {2:g} seconds".format(
+            function, _get_target(slot), timeout
+        )
+        with self._lock:
+            self._statistics["timed_out"] += 1
+            if slot in self._slot_deadlines:
+                self._timed_out[slot] = msg
+            if future.cancel():
+                self._statistics["cancelled"] += 1
+            elif self._workers.get(slot, None) is worker:
+                # a running call can not be interrupted, its worker is left
+                # to finish it and later calls get a new one
+                del self._workers[slot]
+                self._hung[slot] = worker
+                worker.stop()
+        raise PKCS11CallTimeout(msg, function, slot)
+
+    def __prepare(
+        self, function: str, slot: int | None
+    ) -> tuple[float | None, _CallWorker]:
+        hung = self._hung.get(slot, None)
+        if hung is not None:
+            if hung.is_busy():
+                self._statistics["refused"] += 1
+                raise PKCS11CallTimeout(
+                    "{0} is still blocked in {1}".format(
+                        _get_target(slot), hung.get_function()
+                    ),
+                    function,
+                    slot,
+                )
+            del self._hung[slot]
+        timeout = self._call_seconds
+        if slot is not None and slot in self._slot_deadlines:
+            msg = self._timed_out.get(slot, None)
+            deadline = self._slot_deadlines[slot]
+            remaining = None if deadline is None else deadline - monotonic()
+            if msg is None and remaining is not None and remaining <= 0:
+                msg = "Scan of {0} ran past its deadline".format(
+                    _get_target(slot)
+                )
+                self._timed_out[slot] = msg
+            if msg is not None:
+                # the rest of a timed out slot scan fails fast
+                self._statistics["refused"] += 1
+                raise PKCS11CallTimeout(msg, function, slot)
+            if remaining is not None and (
+                timeout is None or remaining < timeout
+            ):
+                timeout = remaining
+        worker = self._workers.get(slot, None)
+        if worker is None:
+            worker = self._workers[slot] = _CallWorker(slot)
+        return timeout, worker
+
+
+def _get_target(slot: int | None) -> str:
+    if slot is None:
+        return "library"
+    return "slot {0}".format(slot)
+
+
+class PKCS11DeadlineSession(object):
+    def __init__(
+        self, session, deadlines: PKCS11CallDeadlines, slot: int | None
+    ):
+        self._session = session
+        self._deadlines = deadlines
+        self._slot = slot
+
+    def get_session(self):
+        return self._session
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._session, name)
+        if not callable(attr):
+            return attr
+
+        def bounded(*args, **kwargs):
+            return self._deadlines.call(
+                PKCS11_function_names.get(name, name),
+                self._slot,
+                attr,
+                *args,
+                **kwargs,
+            )
+
+        return bounded
+
+
+class PKCS11DeadlineLibrary(object):
+    def __init__(self, library: PyKCS11Lib, deadlines: PKCS11CallDeadlines):
+        self._library = library
+        self._deadlines = deadlines
+
+    def get_library(self) -> PyKCS11Lib:
+        return self._library
+
+    def get_deadlines(self) -> PKCS11CallDeadlines:
+        return self._deadlines
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._library, name)
+        if not callable(attr):
+            return attr
+
+        def bounded(*args, **kwargs):
+            if name == "waitForSlotEvent":
+                flags = args[0] if len(args) > 0 else kwargs.get("flags", 0)
+                if not flags & CKF_DONT_BLOCK:
+                    # waiting for an event is meant to block
+                    return attr(*args, **kwargs)
+            slot = None
+            if name in PKCS11_slot_functions:
+                slot = args[0] if len(args) > 0 else kwargs.get("slot", None)
+            ret = self._deadlines.call(
+                PKCS11_function_names.get(name, name),
+                slot,
+                attr,
+                *args,
+                **kwargs,
+            )
+            if name == "openSession":
+                ret = PKCS11DeadlineSession(ret, self._deadlines, slot)
+            return ret
+
+        return bounded
+
+
+def set_library_deadlines(
+    library: Any, deadlines: PKCS11CallDeadlines | None
+) -> PyKCS11Lib:
+    # deadlines sit below instrumentation, so timed out calls are counted
+    statistics = get_library_statistics(library)
+    library = uninstrument_library(library)
+    if isinstance(library, PKCS11DeadlineLibrary):
+        library = library.get_library()
+    if deadlines is not None:
+        library = cast(PyKCS11Lib, PKCS11DeadlineLibrary(library, deadlines))
+    if statistics is not None:
+        library = instrument_library(library, statistics)
+    return library
+
+
+def get_library_deadlines(library: Any) -> PKCS11CallDeadlines | None:
+    library = uninstrument_library(library)
+    if isinstance(library, PKCS11DeadlineLibrary):
+        return library.get_deadlines()
+    return None
+
+
+def unwrap_session(session: Any) -> Any:
+    while isinstance(
+        session, (PKCS11InstrumentedSession, PKCS11DeadlineSession)
+    ):
+        session = session.get_session()
+    return session
+
+
+def wrap_session(session: Any, library: Any, slot: int) -> Any:
+    # wraps a session the way the library wraps the sessions it opens
+    session = unwrap_session(session)
+    deadlines = get_library_deadlines(library)
+    if deadlines is not None:
+        session = PKCS11DeadlineSession(session, deadlines, slot)
+    statistics = get_library_statistics(library)
+    if statistics is not None:
+        session = PKCS11InstrumentedSession(session, statistics, slot)
+    return session
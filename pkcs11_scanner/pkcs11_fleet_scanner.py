@@ -0,0 +1,276 @@
+from asyncio import (
+    Task,
+    as_completed,
+    create_task,
+    gather,
+    get_running_loop,
+    run,
+)
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import get_context
+from os import cpu_count, environ
+from threading import Lock
+from typing import Any, AsyncIterator, Callable
+
+from .pkcs11_base_scanner import PKCS11BaseScanner
+from .pkcs11_card_scanner import PKCS11CardScanner
+from .pkcs11_check_error import PKCS11CheckError
+from .pkcs11_library_event import PKCS11LibraryEvent
+from .pkcs11_scan import PKCS11Scan
+from .pkcs11_scan_serializer import dumps_scan_binary, loads_scan_binary
+
+PKCS11FleetScannerFactory = Callable[[str], PKCS11BaseScanner]
+
+
+class PKCS11FleetTarget(object):
+    def __init__(
+        self,
+        library_path: str,
+        softhsm_conf: str | None = None,
+        pin: str | None = None,
+        environment: dict[str, str] | None = None,
+    ):
+        self._library_path = library_path
+        self._pin = pin
+        self._environment = dict(environment) if environment else {}
+        if softhsm_conf is not None:
+            self._environment["SOFTHSM2_CONF"] = softhsm_conf
+
+    def get_library_path(self) -> str:
+        return self._library_path
+
+    def get_pin(self) -> str | None:
+        return self._pin
+
+    def get_environment(self) -> dict[str, str]:
+        return self._environment
+
+    def get_name(self) -> str:
+        conf = self._environment.get("SOFTHSM2_CONF", None)
+        if conf is None:
+            return self._library_path
+        return "{0}?{1}".format(self._library_path, conf)
+
+    def __str__(self):
+        return self.get_name()
+
+
+def _dump_result(ok: bool, data: Any) -> bytes:
+    # results are sent in the scan encoding, certificate data does not pickle
+    return dumps_scan_binary({"ok": ok, "data": data})
+
+
+def _load_result(frame: bytes) -> tuple[bool, Any]:
+    result, _, _ = loads_scan_binary(frame)
+    return result["ok"], result["data"]
+
+
+def _scan_in_process(
+    conn,
+    library_path: str,
+    environment: dict[str, str],
+    scanner_factory: PKCS11FleetScannerFactory,
+    pin: str | None,
+):
+    # modules read their configuration when they are loaded
+    environ.update(environment)
+    try:
+        scanner = scanner_factory(library_path)
+        try:
+            data = run(scanner.scan_from_library(pin))
+        finally:
+            scanner.close()
+        conn.send_bytes(_dump_result(True, data))
+    except Exception as e:
+        conn.send_bytes(
+            _dump_result(False, "{0}: {1}".format(type(e).__name__, e))
+        )
+    finally:
+        conn.close()
+
+
+class _FleetRun(object):
+    def __init__(self) -> None:
+        self.processes: set = set()
+        self.stopped = False
+
+
+class PKCS11FleetScanner(object):
+    def __init__(
+        self,
+        targets: list[PKCS11FleetTarget] | None = None,
+        max_workers: int | None = None,
+        timeout: float | None = 60,
+        scanner_factory: PKCS11FleetScannerFactory | None = None,
+        start_method: str = "spawn",
+    ):
+        self._targets: list[PKCS11FleetTarget] = (
+            list(targets) if targets is not None else []
+        )
+        self._max_workers = (
+            max_workers if max_workers is not None else (cpu_count() or 1)
+        )
+        self._timeout = timeout
+        # the factory is sent to worker processes, so it has to pickle
+        self._scanner_factory: PKCS11FleetScannerFactory = (
+            scanner_factory
+            if scanner_factory is not None
+            else PKCS11CardScanner.from_library_path
+        )
+        self._context: Any = get_context(start_method)
+        self._lock = Lock()
+        self._statistics: dict[str, int] = {
+            "scanned": 0,
+            "failed": 0,
+            "timed_out": 0,
+        }
+
+    def add_target(self, target: PKCS11FleetTarget):
+        self._targets.append(target)
+
+    def add_library(
+        self,
+        library_path: str,
+        softhsm_conf: str | None = None,
+        pin: str | None = None,
+    ):
+        self.add_target(PKCS11FleetTarget(library_path, softhsm_conf, pin))
+
+    def get_targets(self) -> list[PKCS11FleetTarget]:
+        return self._targets
+
+    def get_statistics(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._statistics)
+
+    def __count(self, name: str):
+        with self._lock:
+            self._statistics[name] += 1
+
+    def __scan_target(
+        self, target: PKCS11FleetTarget, fleet_run: _FleetRun
+    ) -> PKCS11Scan | PKCS11CheckError:
+        # runs in a thread that owns one worker process
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_scan_in_process,
+            args=(
+                sender,
+                target.get_library_path(),
+                target.get_environment(),
+                self._scanner_factory,
+                target.get_pin(),
+            ),
+            daemon=True,
+        )
+        with self._lock:
+            if fleet_run.stopped:
+                sender.close()
+                receiver.close()
+                return PKCS11CheckError(
+                    "Scan of {0} was cancelled".format(target)
+                )
+            process.start()
+            fleet_run.processes.add(process)
+        sender.close()
+        try:
+            if not receiver.poll(self._timeout):
+                # a hung module can not be interrupted, only killed
+                process.kill()
+                self.__count("timed_out")
+                return PKCS11CheckError(
+                    "Scan of {0} timed out after {1} seconds".format(
+                        target, self._timeout
+                    )
+                )
+            try:
+                ok, data = _load_result(receiver.recv_bytes())
+            except EOFError:
+                process.join()
+                self.__count("failed")
+                return PKCS11CheckError(
+                    "Scan of {0} exited with code {1}".format(
+                        target, process.exitcode
+                    )
+                )
+        finally:
+            receiver.close()
+            process.join()
+            with self._lock:
+                fleet_run.processes.discard(process)
+        if not ok:
+            self.__count("failed")
+            return PKCS11CheckError(
+                "Scan of {0} failed: {1}".format(target, data)
+            )
+        self.__count("scanned")
+        return PKCS11Scan(data, library_path=target.get_library_path())
+
+    def __get_executor(self, targets: list) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(
+            max_workers=max(1, min(self._max_workers, len(targets))),
+            thread_name_prefix="PKCS11Fleet",
+        )
+
+    async def __scan(
+        self,
+        executor: ThreadPoolExecutor,
+        target: PKCS11FleetTarget,
+        fleet_run: _FleetRun,
+    ) -> PKCS11LibraryEvent:
+        loop = get_running_loop()
+        result = await loop.run_in_executor(
+            executor, self.__scan_target, target, fleet_run
+        )
+        return PKCS11LibraryEvent(target.get_name(), result)
+
+    def __shutdown(
+        self,
+        executor: ThreadPoolExecutor,
+        tasks: list[Task],
+        fleet_run: _FleetRun,
+    ):
+        # a scan that is left early does not wait for the targets still
+        # running, their workers are killed and their threads end with them
+        for task in tasks:
+            task.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            fleet_run.stopped = True
+            live = list(fleet_run.processes)
+        for process in live:
+            if process.is_alive():
+                process.kill()
+
+    async def gen_scan(
+        self, targets: list[PKCS11FleetTarget] | None = None
+    ) -> AsyncIterator[PKCS11LibraryEvent]:
+        # results are yielded as workers finish
+        if targets is None:
+            targets = self._targets
+        executor = self.__get_executor(targets)
+        fleet_run = _FleetRun()
+        tasks = [
+            create_task(self.__scan(executor, t, fleet_run)) for t in targets
+        ]
+        try:
+            for next_event in as_completed(tasks):
+                yield await next_event
+        finally:
+            self.__shutdown(executor, tasks, fleet_run)
+
+    async def scan(
+        self, targets: list[PKCS11FleetTarget] | None = None
+    ) -> list[PKCS11LibraryEvent]:
+        # results keep the order of the targets
+        if targets is None:
+            targets = self._targets
+        executor = self.__get_executor(targets)
+        fleet_run = _FleetRun()
+        tasks = [
+            create_task(self.__scan(executor, t, fleet_run)) for t in targets
+        ]
+        try:
+            return list(await gather(*tasks))
+        finally:
+            self.__shutdown(executor, tasks, fleet_run)
@@ -0,0 +1,254 @@
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+from typing import Any, Callable, cast
+
+from PyKCS11 import PyKCS11Lib
+
+# upper bounds of latency histogram buckets in seconds, last bucket is open
+PKCS11_histogram_bounds: tuple[float, ...] = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1,
+    5,
+)
+
+PKCS11_function_names: dict[str, str] = {
+    "closeAllSessions": "C_CloseAllSessions",
+    "getInfo": "C_GetInfo",
+    "getMechanismInfo": "C_GetMechanismInfo",
+    "getMechanismList": "C_GetMechanismList",
+    "getSlotInfo": "C_GetSlotInfo",
+    "getSlotList": "C_GetSlotList",
+    "getTokenInfo": "C_GetTokenInfo",
+    "initToken": "C_InitToken",
+    "openSession": "C_OpenSession",
+    "waitForSlotEvent": "C_WaitForSlotEvent",
+    "closeSession": "C_CloseSession",
+    "findObjects": "C_FindObjects",
+    "getAttributeValue": "C_GetAttributeValue",
+    "getAttributeValue_fragmented": "C_GetAttributeValue",
+    "getSessionInfo": "C_GetSessionInfo",
+    "login": "C_Login",
+    "logout": "C_Logout",
+}
+
+PKCS11_slot_functions = (
+    "closeAllSessions",
+    "getMechanismInfo",
+    "getMechanismList",
+    "getSlotInfo",
+    "getTokenInfo",
+    "initToken",
+    "openSession",
+)
+
+PKCS11CallHook = Callable[[str, int | None, float, Exception | None], None]
+
+
+class PKCS11CallEntry(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram = [0] * (len(PKCS11_histogram_bounds) + 1)
+
+    def add(self, seconds: float, error: bool):
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+        self.histogram[bisect_left(PKCS11_histogram_bounds, seconds)] += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "seconds": self.seconds,
+            "max_seconds": self.max_seconds,
+            "histogram": list(self.histogram),
+        }
+
+
+class PKCS11CallStatistics(object):
+    def __init__(
+        self,
+        hook: PKCS11CallHook | None = None,
+        parent: "PKCS11CallStatistics | None" = None,
+    ):
+        self._hook = hook
+        self._parent = parent
+        self._lock = Lock()
+        self._functions: dict[str, PKCS11CallEntry] = {}
+        self._slots: dict[int, dict[str, PKCS11CallEntry]] = {}
+
+    def set_hook(self, hook: PKCS11CallHook | None):
+        self._hook = hook
+
+    def record(
+        self,
+        function: str,
+        slot: int | None,
+        seconds: float,
+        error: Exception | None = None,
+    ):
+        with self._lock:
+            entry = self._functions.get(function, None)
+            if entry is None:
+                entry = self._functions[function] = PKCS11CallEntry()
+            entry.add(seconds, error is not None)
+            if slot is not None:
+                slot_entries = self._slots.setdefault(slot, {})
+                entry = slot_entries.get(function, None)
+                if entry is None:
+                    entry = slot_entries[function] = PKCS11CallEntry()
+                entry.add(seconds, error is not None)
+        if self._hook is not None:
+            self._hook(function, slot, seconds, error)
+        if self._parent is not None:
+            self._parent.record(function, slot, seconds, error)
+
+    def get_statistics(self) -> dict:
+        with self._lock:
+            return {
+                "functions": {
+                    function: entry.to_dict()
+                    for function, entry in self._functions.items()
+                },
+                "slots": {
+                    slot: {
+                        function: entry.to_dict()
+                        for function, entry in entries.items()
+                    }
+                    for slot, entries in self._slots.items()
+                },
+            }
+
+    def get_summary(self) -> dict:
+        with self._lock:
+            ret: dict = {
+                "calls": sum(e.calls for e in self._functions.values()),
+                "errors": sum(e.errors for e in self._functions.values()),
+                "seconds": sum(e.seconds for e in self._functions.values()),
+                "functions": {},
+                "slots": {},
+            }
+            for function, entry in self._functions.items():
+                ret["functions"][function] = {
+                    "calls": entry.calls,
+                    "seconds": entry.seconds,
+                    "max_seconds": entry.max_seconds,
+                }
+            for slot, entries in self._slots.items():
+                ret["slots"][slot] = {
+                    "calls": sum(e.calls for e in entries.values()),
+                    "seconds": sum(e.seconds for e in entries.values()),
+                }
+            return ret
+
+    def clear(self):
+        with self._lock:
+            self._functions.clear()
+            self._slots.clear()
+
+
+def _timed_call(
+    statistics: PKCS11CallStatistics,
+    name: str,
+    slot: int | None,
+    call: Callable,
+    *args,
+    **kwargs,
+) -> Any:
+    function = PKCS11_function_names.get(name, name)
+    start = perf_counter()
+    try:
+        ret = call(*args, **kwargs)
+    except Exception as ex:
+        statistics.record(function, slot, perf_counter() - start, ex)
+        raise
+    statistics.record(function, slot, perf_counter() - start)
+    return ret
+
+
+class PKCS11InstrumentedSession(object):
+    def __init__(
+        self, session, statistics: PKCS11CallStatistics, slot: int | None
+    ):
+        self._session = session
+        self._statistics = statistics
+        self._slot = slot
+
+    def get_session(self):
+        return self._session
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._session, name)
+        if not callable(attr):
+            return attr
+
+        def instrumented(*args, **kwargs):
+            return _timed_call(
+                self._statistics, name, self._slot, attr, *args, **kwargs
+            )
+
+        return instrumented
+
+
+class PKCS11InstrumentedLibrary(object):
+    def __init__(self, library: PyKCS11Lib, statistics: PKCS11CallStatistics):
+        self._library = library
+        self._statistics = statistics
+
+    def get_library(self) -> PyKCS11Lib:
+        return self._library
+
+    def get_statistics(self) -> PKCS11CallStatistics:
+        return self._statistics
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._library, name)
+        if not callable(attr):
+            return attr
+
+        def instrumented(*args, **kwargs):
+            slot = None
+            if name in PKCS11_slot_functions:
+                slot = args[0] if len(args) > 0 else kwargs.get("slot", None)
+            ret = _timed_call(
+                self._statistics, name, slot, attr, *args, **kwargs
+            )
+            if name == "openSession":
+                ret = PKCS11InstrumentedSession(ret, self._statistics, slot)
+            return ret
+
+        return instrumented
+
+
+def uninstrument_library(library: Any) -> PyKCS11Lib:
+    if isinstance(library, PKCS11InstrumentedLibrary):
+        return library.get_library()
+    return library
+
+
+def instrument_library(
+    library: PyKCS11Lib, statistics: PKCS11CallStatistics
+) -> PyKCS11Lib:
+    library = uninstrument_library(library)
+    # the proxy is duck typed, callers keep working with a PyKCS11Lib
+    return cast(PyKCS11Lib, PKCS11InstrumentedLibrary(library, statistics))
+
+
+def get_library_statistics(library: Any) -> PKCS11CallStatistics | None:
+    if isinstance(library, PKCS11InstrumentedLibrary):
+        return library.get_statistics()
+    return None
@@ -0,0 +1,16 @@
+from typing import Any
+
+
+class PKCS11LibraryEvent(object):
+    def __init__(self, library_path: str, event: Any):
+        self._library_path = library_path
+        self._event = event
+
+    def get_library_path(self) -> str:
+        return self._library_path
+
+    def get_event(self) -> Any:
+        return self._event
+
+    def __str__(self):
+        return "{0}: {1}".format(self._library_path, self._event)
@@ -0,0 +1,185 @@
+from asyncio import AbstractEventLoop
+from asyncio import Event as AsyncEvent
+from asyncio import Task, gather, get_running_loop
+from asyncio import run as async_run
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from queue import Queue
+from threading import Event, Lock, Thread
+from time import time
+from typing import Any, Callable
+
+from .pkcs11_check_error import PKCS11CheckError
+from .pkcs11_check_monitor import PKCS11CheckMonitor
+from .pkcs11_check_n_scan_thread import PKCS11ChecknScanThread
+from .pkcs11_check_thread import PKCS11CheckThread
+from .pkcs11_library_event import PKCS11LibraryEvent
+
+PKCS11CheckFactory = Callable[[str, Any, int], PKCS11CheckThread]
+
+
+class _TaggedQueue(object):
+    def __init__(self, library_path: str, comm_queue: Queue):
+        self._library_path = library_path
+        self._comm = comm_queue
+
+    def put(self, item):
+        self._comm.put(PKCS11LibraryEvent(self._library_path, item))
+
+
+class PKCS11LibraryMonitor(Thread):
+    def __init__(
+        self,
+        library_paths: list[str],
+        comm_queue: Queue,
+        refresh_seconds: int = 1,
+        max_workers: int = 4,
+        check_factory: PKCS11CheckFactory | None = None,
+    ):
+        super().__init__()
+        self._comm = comm_queue
+        self._refresh_seconds = refresh_seconds
+        self._max_workers = max_workers
+        self._check_factory: PKCS11CheckFactory = (
+            check_factory
+            if check_factory is not None
+            else PKCS11ChecknScanThread
+        )
+        self._stop_event = Event()
+        self._lock = Lock()
+        self._checks: dict[str, PKCS11CheckThread] = {}
+        self._queues: dict[str, _TaggedQueue] = {}
+        self._health: dict[str, dict] = {}
+        self._tasks: dict[str, Task] = {}
+        self._loop: AbstractEventLoop | None = None
+        self._stopped: AsyncEvent | None = None
+        self._executor: ThreadPoolExecutor | None = None
+        for library_path in library_paths:
+            self.__add_library(library_path)
+
+    def __add_library(self, library_path: str) -> PKCS11CheckThread:
+        with self._lock:
+            if library_path not in self._checks:
+                comm = _TaggedQueue(library_path, self._comm)
+                # checks are never started, they only keep per library state
+                check = self._check_factory(
+                    library_path, comm, self._refresh_seconds
+                )
+                check.get_monitor().set_error_handler(
+                    partial(self.__on_error, library_path)
+                )
+                self._checks[library_path] = check
+                self._queues[library_path] = comm
+                self._health[library_path] = {
+                    "state": "stopped",
+                    "events": 0,
+                    "errors": 0,
+                    "last_error": None,
+                    "last_event": None,
+                }
+            return self._checks[library_path]
+
+    def get_library_paths(self) -> list[str]:
+        with self._lock:
+            return list(self._checks)
+
+    def get_check(self, library_path: str) -> PKCS11CheckThread | None:
+        with self._lock:
+            return self._checks.get(library_path, None)
+
+    def get_health(self, library_path: str) -> dict | None:
+        with self._lock:
+            health = self._health.get(library_path, None)
+            return dict(health) if health is not None else None
+
+    def start_library(self, library_path: str):
+        self.__add_library(library_path)
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(
+                    self.__start_watch, library_path
+                )
+            except RuntimeError:
+                # loop already closed
+                pass
+
+    def stop_library(self, library_path: str):
+        check = self.get_check(library_path)
+        if check is not None:
+            check.set_stop_event()
+
+    def set_stop_event(self):
+        self._stop_event.set()
+        for library_path in self.get_library_paths():
+            self.stop_library(library_path)
+        if self._loop is not None and self._stopped is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._stopped.set)
+            except RuntimeError:
+                # loop already closed
+                pass
+
+    def run(self):
+        async_run(self.async_run())
+
+    async def async_run(self):
+        self._stopped = AsyncEvent()
+        with ThreadPoolExecutor(
+            max_workers=self._max_workers,
+            thread_name_prefix="PKCS11 monitor",
+        ) as executor:
+            self._executor = executor
+            self._loop = get_running_loop()
+            if self._stop_event.is_set():
+                self._stopped.set()
+            for library_path in self.get_library_paths():
+                self.__start_watch(library_path)
+            await self._stopped.wait()
+            await gather(*self._tasks.values(), return_exceptions=True)
+            self._loop = None
+            self._executor = None
+
+    def __start_watch(self, library_path: str):
+        task = self._tasks.get(library_path, None)
+        if self._stop_event.is_set() or (task is not None and not task.done()):
+            return
+        monitor = self._checks[library_path].get_monitor()
+        monitor.set_executor(self._executor)
+        # a library stopped earlier can be started again
+        monitor.clear_stop_event()
+        self.__set_health(library_path, state="starting")
+        self._tasks[library_path] = get_running_loop().create_task(
+            self.__watch(library_path, monitor)
+        )
+
+    def __set_health(self, library_path: str, **kwargs):
+        with self._lock:
+            self._health[library_path].update(kwargs)
+
+    def __on_error(self, library_path: str, msg: str, state: str | None = None):
+        with self._lock:
+            health = self._health[library_path]
+            health["errors"] += 1
+            health["last_error"] = msg
+            if state is not None:
+                health["state"] = state
+        self._queues[library_path].put(PKCS11CheckError(msg))
+
+    async def __watch(self, library_path: str, monitor: PKCS11CheckMonitor):
+        # errors the monitor goes on after reach __on_error through its
+        # error handler, the rest end the watch
+        try:
+            await monitor.open()
+            self.__set_health(library_path, state="running")
+            while not monitor.is_stopped():
+                if await monitor.step():
+                    with self._lock:
+                        health = self._health[library_path]
+                        health["events"] += 1
+                        health["last_event"] = time()
+        except Exception as ex:
+            self.__on_error(library_path, str(ex), "failed")
+            return
+        finally:
+            monitor.close()
+        self.__set_health(library_path, state="stopped")
@@ -0,0 +1,329 @@
+from hashlib import sha256
+from os import getenv
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable
+
+from PyKCS11 import (
+    CKF_SERIAL_SESSION,
+    CKR_USER_ALREADY_LOGGED_IN,
+    PyKCS11Error,
+    PyKCS11Lib,
+)
+
+from .pkcs11_deadlines import unwrap_session, wrap_session
+
+
+def open_session(
+    library: PyKCS11Lib, slot: int, login_required: bool, pin: str | None
+) -> tuple[Any, bool]:
+    session = library.openSession(slot, CKF_SERIAL_SESSION)
+    logged_in: bool = False
+    if login_required and pin is not None:
+        try:
+            session.login(pin)
+        except Exception:
+            session.closeSession()
+            raise
+        logged_in = True
+    return session, logged_in
+
+
+def load_library(
+    library_path: str | None = None, pool: "PKCS11LibraryPool | None" = None
+) -> PyKCS11Lib:
+    # shared through the pool when there is one, otherwise loaded for the
+    # caller alone
+    if pool is not None:
+        return pool.acquire_library(library_path)
+    library = PyKCS11Lib()
+    if library_path is not None:
+        library.load(library_path)
+    else:
+        library.load()
+    return library
+
+
+def close_session(session, logged_in: bool):
+    try:
+        if logged_in:
+            session.logout()
+    finally:
+        session.closeSession()
+
+
+def _close_quietly(session):
+    try:
+        session.closeSession()
+    except Exception:
+        # session of a removed token is already gone
+        pass
+
+
+def _get_library_path(library: PyKCS11Lib) -> str | None:
+    return getattr(library, "pkcs11dll_filename", None)
+
+
+class _PooledLibrary(object):
+    def __init__(self, library: PyKCS11Lib):
+        self.library = library
+        self.references = 0
+        self.released = monotonic()
+
+
+class _PooledSlot(object):
+    def __init__(self, key: tuple[str, int]):
+        self.key = key
+        self.idle: list[tuple[Any, float]] = []
+        # login state is shared by all sessions of a token
+        self.login_lock = Lock()
+        self.in_use = 0
+        self.logins = 0
+        self.pin_digest: bytes | None = None
+
+
+class PKCS11LibraryPool(object):
+    _default: "PKCS11LibraryPool | None" = None
+    _default_lock = Lock()
+
+    def __init__(
+        self,
+        idle_seconds: float = 60,
+        max_idle_sessions: int = 4,
+        keep_login: bool = False,
+    ):
+        self._idle_seconds = idle_seconds
+        self._max_idle_sessions = max_idle_sessions
+        self._keep_login = keep_login
+        self._lock = Lock()
+        self._libraries: dict[str, _PooledLibrary] = {}
+        self._slots: dict[tuple[str, int], _PooledSlot] = {}
+        self._in_use: dict[int, _PooledSlot] = {}
+        self._loads = 0
+        self._opened = 0
+        self._reused = 0
+        self._logins = 0
+        self._closed = 0
+
+    @classmethod
+    def get_default(cls) -> "PKCS11LibraryPool":
+        with PKCS11LibraryPool._default_lock:
+            if PKCS11LibraryPool._default is None:
+                PKCS11LibraryPool._default = cls()
+            return PKCS11LibraryPool._default
+
+    def acquire_library(self, library_path: str | None = None) -> PyKCS11Lib:
+        if library_path is None:
+            library_path = getenv("PYKCS11LIB")
+        if library_path is None:
+            # nothing to share, load reports the missing library
+            return PyKCS11Lib().load()
+        self.purge()
+        with self._lock:
+            pooled = self._libraries.get(library_path, None)
+            if pooled is None:
+                library = PyKCS11Lib()
+                library.load(library_path)
+                pooled = _PooledLibrary(library)
+                self._libraries[library_path] = pooled
+                self._loads += 1
+            pooled.references += 1
+            return pooled.library
+
+    def release_library(self, library: PyKCS11Lib):
+        library_path = _get_library_path(library)
+        if library_path is None:
+            return
+        with self._lock:
+            pooled = self._libraries.get(library_path, None)
+            if pooled is not None and pooled.references > 0:
+                pooled.references -= 1
+                if pooled.references == 0:
+                    pooled.released = monotonic()
+
+    def acquire_session(
+        self,
+        library: PyKCS11Lib,
+        slot: int,
+        login_required: bool = False,
+        pin: str | None = None,
+    ) -> tuple[Any, bool]:
+        library_path = _get_library_path(library)
+        if library_path is None:
+            return open_session(library, slot, login_required, pin)
+        session = None
+        expired: list = []
+        now = monotonic()
+        with self._lock:
+            key = (library_path, slot)
+            pooled = self._slots.get(key, None)
+            if pooled is None:
+                pooled = _PooledSlot(key)
+                self._slots[key] = pooled
+            while len(pooled.idle) > 0:
+                idle_session, released = pooled.idle.pop()
+                if now - released > self._idle_seconds:
+                    expired.append(idle_session)
+                else:
+                    session = idle_session
+                    break
+            self._closed += len(expired)
+            self.__forget_login(pooled, session is None)
+            pooled.in_use += 1
+        for idle_session in expired:
+            _close_quietly(idle_session)
+        try:
+            if session is not None:
+                # calls on a reused session count for the scan reusing it
+                session = wrap_session(session, library, slot)
+                try:
+                    # a pooled session dies with its token
+                    session.getSessionInfo()
+                    with self._lock:
+                        self._reused += 1
+                except PyKCS11Error:
+                    _close_quietly(session)
+                    session = None
+                    pooled.pin_digest = None
+            if session is None:
+                session = library.openSession(slot, CKF_SERIAL_SESSION)
+                with self._lock:
+                    self._opened += 1
+        except Exception:
+            with self._lock:
+                pooled.in_use -= 1
+            raise
+        with self._lock:
+            self._in_use[id(session)] = pooled
+        logged_in: bool = False
+        if login_required and pin is not None:
+            try:
+                self.__login(pooled, session, pin)
+            except Exception:
+                self.release_session(session, False, False)
+                raise
+            logged_in = True
+        return session, logged_in
+
+    def __forget_login(self, pooled: _PooledSlot, closing: bool = True):
+        # the token logs out when its last session is closed
+        if closing and pooled.in_use == 0 and len(pooled.idle) == 0:
+            pooled.pin_digest = None
+
+    def __login(self, pooled: _PooledSlot, session, pin: str):
+        digest = sha256(pin.encode()).digest()
+        did_login = False
+        with pooled.login_lock:
+            if pooled.pin_digest != digest:
+                try:
+                    session.login(pin)
+                except PyKCS11Error as ex:
+                    if ex.value != CKR_USER_ALREADY_LOGGED_IN:
+                        raise
+                pooled.pin_digest = digest
+                did_login = True
+            pooled.logins += 1
+        if did_login:
+            with self._lock:
+                self._logins += 1
+
+    def release_session(self, session, logged_in: bool, valid: bool = True):
+        with self._lock:
+            pooled = self._in_use.pop(id(session), None)
+        if pooled is None:
+            close_session(session, logged_in)
+            return
+        if logged_in:
+            with pooled.login_lock:
+                pooled.logins -= 1
+                if (
+                    pooled.logins == 0
+                    and pooled.pin_digest is not None
+                    and not self._keep_login
+                ):
+                    # logout ends the login of every session on the token
+                    pooled.pin_digest = None
+                    try:
+                        session.logout()
+                    except PyKCS11Error:
+                        valid = False
+        with self._lock:
+            pooled.in_use -= 1
+            keep = (
+                valid
+                and self._slots.get(pooled.key, None) is pooled
+                and len(pooled.idle) < self._max_idle_sessions
+            )
+            if keep:
+                pooled.idle.append((unwrap_session(session), monotonic()))
+            else:
+                self._closed += 1
+                self.__forget_login(pooled)
+        if not keep:
+            _close_quietly(session)
+
+    def invalidate(self, library: PyKCS11Lib, slot: int | None = None):
+        library_path = _get_library_path(library)
+        self.__invalidate(
+            lambda key: key[0] == library_path
+            and (slot is None or key[1] == slot)
+        )
+
+    def __invalidate(self, matches: Callable[[tuple[str, int]], bool]):
+        with self._lock:
+            keys = [key for key in self._slots if matches(key)]
+            sessions: list = []
+            for key in keys:
+                pooled = self._slots.pop(key)
+                pooled.pin_digest = None
+                sessions.extend(s for s, _ in pooled.idle)
+                pooled.idle.clear()
+            self._closed += len(sessions)
+        for session in sessions:
+            _close_quietly(session)
+
+    def purge(self):
+        now = monotonic()
+        sessions = []
+        libraries = []
+        with self._lock:
+            for pooled in self._slots.values():
+                expired = [
+                    s for s, r in pooled.idle if now - r > self._idle_seconds
+                ]
+                if len(expired) > 0:
+                    pooled.idle = [
+                        (s, r)
+                        for s, r in pooled.idle
+                        if now - r <= self._idle_seconds
+                    ]
+                    sessions.extend(expired)
+                    self.__forget_login(pooled)
+            for library_path, pooled_library in list(self._libraries.items()):
+                if (
+                    pooled_library.references == 0
+                    and now - pooled_library.released > self._idle_seconds
+                ):
+                    del self._libraries[library_path]
+                    libraries.append(pooled_library.library)
+            self._closed += len(sessions)
+        for session in sessions:
+            _close_quietly(session)
+        for library in libraries:
+            self.invalidate(library)
+            library.unload()
+
+    def clear(self):
+        self.__invalidate(lambda key: True)
+
+    def get_statistics(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "libraries": len(self._libraries),
+                "loads": self._loads,
+                "opened": self._opened,
+                "reused": self._reused,
+                "logins": self._logins,
+                "closed": self._closed,
+                "idle": sum(len(p.idle) for p in self._slots.values()),
+            }
@@ -0,0 +1,136 @@
+from collections import OrderedDict
+from json import dump, load
+from os import replace
+from os.path import exists
+from threading import Lock
+
+from pkcs11_cryptography_keys import MechanismProperties, TokenProperties
+from PyKCS11 import PyKCS11Lib
+
+
+def read_mechanisms(library: PyKCS11Lib, slot: int) -> dict:
+    ret: dict = {}
+    for mp in MechanismProperties.gen_mechanism_properties(library, slot):
+        ret[mp.get_mechanism_type()] = {}
+        for tag, val in mp.gen_tags():
+            ret[mp.get_mechanism_type()][tag] = val
+    return ret
+
+
+def _copy_mechanisms(mechanisms: dict) -> dict:
+    # scans get their own copy, so changing one does not change the cache
+    return {
+        name: {
+            tag: list(val) if isinstance(val, list) else val
+            for tag, val in tags.items()
+        }
+        for name, tags in mechanisms.items()
+    }
+
+
+class PKCS11MechanismCache(object):
+    def __init__(self, max_size: int = 64, cache_file: str | None = None):
+        self._max_size = max_size
+        self._cache_file = cache_file
+        self._cache: OrderedDict[tuple, dict] = OrderedDict()
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        self._dirty = False
+        if self._cache_file is not None and exists(self._cache_file):
+            self.load()
+
+    @staticmethod
+    def get_key(
+        library: PyKCS11Lib, token_properties: TokenProperties
+    ) -> tuple | None:
+        library_path = getattr(library, "pkcs11dll_filename", None)
+        if library_path is None:
+            return None
+        return (
+            library_path,
+            token_properties.get_manufacturer_id(),
+            token_properties.get_model(),
+            tuple(token_properties.get_firmware_version()),
+        )
+
+    def get(self, key: tuple) -> dict | None:
+        with self._lock:
+            if key in self._cache:
+                self._hits += 1
+                self._cache.move_to_end(key)
+                return _copy_mechanisms(self._cache[key])
+            self._misses += 1
+            return None
+
+    def put(self, key: tuple, mechanisms: dict):
+        with self._lock:
+            self._cache[key] = _copy_mechanisms(mechanisms)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+            # the file is written by flush, once per scan
+            self._dirty = True
+
+    def get_mechanisms(
+        self,
+        library: PyKCS11Lib,
+        slot: int,
+        token_properties: TokenProperties | None = None,
+    ) -> dict:
+        if token_properties is None:
+            token_properties = TokenProperties.read_from_slot(library, slot)
+        key = self.get_key(library, token_properties)
+        ret = self.get(key) if key is not None else None
+        if ret is None:
+            ret = read_mechanisms(library, slot)
+            if key is not None:
+                self.put(key, ret)
+        return ret
+
+    def get_statistics(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "size": len(self._cache),
+            }
+
+    def flush(self):
+        with self._lock:
+            dirty = self._dirty
+        if dirty:
+            self.save()
+
+    def close(self):
+        self.flush()
+
+    def clear(self):
+        with self._lock:
+            self._dirty = self._dirty or len(self._cache) > 0
+            self._cache.clear()
+            self._hits = 0
+            self._misses = 0
+
+    def save(self):
+        if self._cache_file is not None:
+            with self._lock:
+                entries = [
+                    [list(key[:3]) + [list(key[3])], mechanisms]
+                    for key, mechanisms in self._cache.items()
+                ]
+                self._dirty = False
+            tmp_file = "{0}.tmp".format(self._cache_file)
+            with open(tmp_file, "w") as f:
+                dump(entries, f)
+            replace(tmp_file, self._cache_file)
+
+    def load(self):
+        if self._cache_file is not None:
+            with open(self._cache_file, "r") as f:
+                entries = load(f)
+            with self._lock:
+                for key, mechanisms in entries:
+                    self._cache[tuple(key[:3]) + (tuple(key[3]),)] = mechanisms
+                while len(self._cache) > self._max_size:
+                    self._cache.popitem(last=False)
@@ -0,0 +1,117 @@
+from pkcs11_cryptography_keys import KeyTypes, TokenProperties
+from PyKCS11 import (
+    CKA_CLASS,
+    CKA_ID,
+    CKA_KEY_TYPE,
+    CKA_LABEL,
+    CKO_CERTIFICATE,
+    CKO_DATA,
+    CKO_PRIVATE_KEY,
+    CKO_PUBLIC_KEY,
+    CKO_SECRET_KEY,
+)
+
+from .pkcs11_attribute_reader import PKCS11_key_type_translation
+
+PKCS11_type_translation: dict[str, int] = {
+    "certificate": CKO_CERTIFICATE,
+    "data": CKO_DATA,
+    "private": CKO_PRIVATE_KEY,
+    "public": CKO_PUBLIC_KEY,
+    "secret-key": CKO_SECRET_KEY,
+}
+
+_key_type_classes: list[str] = ["private", "public", "secret-key"]
+
+
+class PKCS11Query(object):
+    def __init__(
+        self,
+        object_types: list[str] | None = None,
+        key_id: bytes | None = None,
+        label: str | None = None,
+        key_type: KeyTypes | None = None,
+        token_label: str | None = None,
+        token_serial: str | None = None,
+        with_mechanisms: bool = True,
+    ) -> None:
+        self._object_types = object_types
+        self._key_id = key_id
+        self._label = label
+        self._key_type = key_type
+        self._token_label = token_label
+        self._token_serial = token_serial
+        self._with_mechanisms = with_mechanisms
+
+    def get_object_types(self) -> list[str] | None:
+        return self._object_types
+
+    def get_key_id(self) -> bytes | None:
+        return self._key_id
+
+    def get_label(self) -> str | None:
+        return self._label
+
+    def get_key_type(self) -> KeyTypes | None:
+        return self._key_type
+
+    def get_token_label(self) -> str | None:
+        return self._token_label
+
+    def get_token_serial(self) -> str | None:
+        return self._token_serial
+
+    def has_mechanisms(self) -> bool:
+        return self._with_mechanisms
+
+    def matches_token(self, token_properties: TokenProperties) -> bool:
+        if self._token_label is not None:
+            if token_properties.get_label() != self._token_label:
+                return False
+        if self._token_serial is not None:
+            if token_properties.get_serialNumber() != self._token_serial:
+                return False
+        return True
+
+    def accepts_type(self, tp: str) -> bool:
+        if tp not in PKCS11_type_translation:
+            return False
+        if self._object_types is not None and tp not in self._object_types:
+            return False
+        # only key objects have a key type
+        if self._key_type is not None and tp not in _key_type_classes:
+            return False
+        return True
+
+    def matches_object(self, key_id: bytes | None, label: str | None) -> bool:
+        if self._key_id is not None and key_id != self._key_id:
+            return False
+        if self._label is not None and label != self._label:
+            return False
+        return True
+
+    def get_template(self, tp: str) -> list[tuple]:
+        template: list[tuple] = [(CKA_CLASS, PKCS11_type_translation[tp])]
+        if self._key_id is not None:
+            template.append((CKA_ID, self._key_id))
+        if self._label is not None:
+            template.append((CKA_LABEL, self._label))
+        if self._key_type is not None:
+            for ckk, kt in PKCS11_key_type_translation.items():
+                if kt == self._key_type:
+                    template.append((CKA_KEY_TYPE, ckk))
+        return template
+
+    def __str__(self):
+        parts = []
+        for name, val in (
+            ("object_types", self._object_types),
+            ("key_id", self._key_id),
+            ("label", self._label),
+            ("key_type", self._key_type),
+            ("token_label", self._token_label),
+            ("token_serial", self._token_serial),
+        ):
+            if val is not None:
+                parts.append("{0}={1}".format(name, val))
+        return "Query {0}".format(", ".join(parts))
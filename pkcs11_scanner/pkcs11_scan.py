@@ -1,36 +1,250 @@
+from collections.abc import Mapping
+from hashlib import sha256
+from typing import Any
+
+from cryptography.hazmat.primitives.hashes import SHA256
+
+from .pkcs11_certificate_record import PKCS11CertificateRecord
+from .pkcs11_scan_diff import PKCS11ScanDiff
+from .pkcs11_scan_records import PKCS11LibraryRecord
+from .pkcs11_scan_serializer import (
+    dumps_scan_binary,
+    dumps_scan_json,
+    loads_scan_binary,
+    loads_scan_json,
+)
+
+_object_lists = ["private keys", "public keys", "certificates"]
+
+_missing = object()
+
+
+def _get_tag(node: Any, tag: str) -> Any:
+    # nodes are dicts, or records when the scan is compact
+    if isinstance(node, Mapping):
+        return node.get(tag, _missing)
+    if tag != "extra" and tag in node.__dataclass_fields__:
+        value = getattr(node, tag)
+        if value is not None:
+            return value
+    if node.extra is not None:
+        return node.extra.get(tag, _missing)
+    return _missing
+
+
+def _has_tag(node: Any, tag: str) -> bool:
+    return _get_tag(node, tag) is not _missing
+
+
+def _get_slots(data: Any) -> list:
+    slots = _get_tag(data, "slots")
+    return slots if slots is not _missing and slots is not None else []
+
+
+def _get_token(slot: Any) -> Any:
+    token = _get_tag(slot, "token")
+    return token if token is not _missing else None
+
+
+def _get_objects(token: Any, obj_list: str) -> list:
+    if isinstance(token, Mapping):
+        return token.get(obj_list, [])
+    if token.objects is None:
+        return []
+    return token.objects.get(obj_list, [])
+
+
+def _as_dict(node: Any) -> Any:
+    # records are turned into dicts for the caller, the copy is not kept
+    if node is None or isinstance(node, Mapping):
+        return node
+    return node.to_dict()
+
+
+def _get_fingerprint(obj: Any) -> bytes | None:
+    # SHA-256 of the DER value, hashed without decoding when it is there
+    if isinstance(obj, PKCS11CertificateRecord):
+        return sha256(obj.get_der()).digest()
+    value = _get_tag(obj, "value")
+    if value is not _missing and value is not None:
+        return sha256(bytes(value)).digest()
+    certificate = _get_tag(obj, "certificate_object")
+    if certificate is not _missing and certificate is not None:
+        return certificate.fingerprint(SHA256())
+    return None
+
+
 class PKCS11Scan(object):
-    def __init__(self, data: dict | None = None):
-        self._scan_data: dict = dict() if data is None else data
+    def __init__(
+        self,
+        data: dict | PKCS11LibraryRecord | None = None,
+        call_summary: dict | None = None,
+        library_path: str | None = None,
+    ):
+        # a compact scan keeps only its record, walked in place
+        self._scan_data: dict | PKCS11LibraryRecord = (
+            dict() if data is None else data
+        )
+        self._indexes: dict[str, dict] | None = None
+        self._call_summary = call_summary
+        self._library_path = library_path
 
     def has_data(self) -> bool:
+        if isinstance(self._scan_data, PKCS11LibraryRecord):
+            return len(_get_slots(self._scan_data)) > 0
         return len(self._scan_data) > 0
 
+    def to_dict(self) -> dict:
+        # a compact scan builds a new dict on every call
+        return _as_dict(self._scan_data)
+
+    def to_json(self) -> str:
+        return dumps_scan_json(
+            self.to_dict(), self._library_path, self._call_summary
+        )
+
+    @classmethod
+    def from_json(cls, text: str | bytes) -> "PKCS11Scan":
+        data, library_path, call_summary = loads_scan_json(text)
+        return cls(data, call_summary, library_path)
+
+    def to_bytes(self) -> bytes:
+        return dumps_scan_binary(
+            self.to_dict(), self._library_path, self._call_summary
+        )
+
+    @classmethod
+    def from_bytes(cls, frame: bytes) -> "PKCS11Scan":
+        data, library_path, call_summary = loads_scan_binary(frame)
+        return cls(data, call_summary, library_path)
+
+    def diff(self, other: "PKCS11Scan") -> PKCS11ScanDiff:
+        # changes that turn this scan into the other one
+        return PKCS11ScanDiff.from_scan_data(self.to_dict(), other.to_dict())
+
+    def apply(self, diff: PKCS11ScanDiff) -> "PKCS11Scan":
+        return PKCS11Scan(
+            diff.apply_to(self.to_dict()),
+            self._call_summary,
+            self._library_path,
+        )
+
+    def get_call_summary(self) -> dict | None:
+        return self._call_summary
+
+    def get_library_path(self) -> str | None:
+        return self._library_path
+
+    def get_record(self) -> PKCS11LibraryRecord:
+        if isinstance(self._scan_data, PKCS11LibraryRecord):
+            return self._scan_data
+        return PKCS11LibraryRecord.from_dict(self._scan_data)
+
+    def invalidate_indexes(self):
+        self._indexes = None
+
+    def _get_index(self, name: str) -> dict:
+        if self._indexes is None:
+            self._indexes = self.__build_indexes()
+        if name == "fingerprint" and name not in self._indexes:
+            # certificates are hashed on the first fingerprint lookup
+            self._indexes[name] = self.__build_fingerprint_index()
+        return self._indexes[name]
+
+    def __build_indexes(self) -> dict[str, dict]:
+        labels: dict[str, Any] = {}
+        serials: dict[str, Any] = {}
+        key_ids: dict[bytes, list[tuple[Any, Any]]] = {}
+        uris: dict[str, Any] = {}
+        if _has_tag(self._scan_data, "uri"):
+            uris.setdefault(_get_tag(self._scan_data, "uri"), self._scan_data)
+        for s in _get_slots(self._scan_data):
+            if _has_tag(s, "uri"):
+                uris.setdefault(_get_tag(s, "uri"), s)
+            token = _get_token(s)
+            if token is None:
+                continue
+            if _has_tag(token, "label"):
+                labels.setdefault(_get_tag(token, "label"), token)
+            if _has_tag(token, "serialNumber"):
+                serials.setdefault(_get_tag(token, "serialNumber"), token)
+            if _has_tag(token, "uri"):
+                uris.setdefault(_get_tag(token, "uri"), token)
+            for obj_list in _object_lists:
+                for obj in _get_objects(token, obj_list):
+                    key_id = _get_tag(obj, "id")
+                    if key_id is _missing:
+                        key_id = _get_tag(obj, "key_id")
+                    if key_id is not _missing and key_id is not None:
+                        key_ids.setdefault(key_id, []).append((token, obj))
+                    if _has_tag(obj, "uri"):
+                        uris.setdefault(_get_tag(obj, "uri"), obj)
+        return {
+            "label": labels,
+            "serial": serials,
+            "key_id": key_ids,
+            "uri": uris,
+        }
+
+    def __build_fingerprint_index(self) -> dict[bytes, tuple[Any, Any]]:
+        fingerprints: dict[bytes, tuple[Any, Any]] = {}
+        for s in _get_slots(self._scan_data):
+            token = _get_token(s)
+            if token is None:
+                continue
+            for obj in _get_objects(token, "certificates"):
+                fp = _get_fingerprint(obj)
+                if fp is not None:
+                    fingerprints.setdefault(fp, (token, obj))
+        return fingerprints
+
     def get_token_labels(self):
-        if "slots" in self._scan_data:
-            for s in self._scan_data["slots"]:
-                if "token" in s and "label" in s["token"]:
-                    yield (s["token"]["label"])
+        for s in _get_slots(self._scan_data):
+            token = _get_token(s)
+            if token is not None and _has_tag(token, "label"):
+                yield _get_tag(token, "label")
 
     def get_HW_token_labels(self):
-        if "slots" in self._scan_data:
-            for s in self._scan_data["slots"]:
-                if "token" in s and "label" in s["token"]:
-                    if "HW_slot" in s["token"]:
-                        if s["token"]["HW_slot"]:
-                            yield (s["token"]["label"])
+        for s in _get_slots(self._scan_data):
+            token = _get_token(s)
+            if token is not None and _has_tag(token, "label"):
+                if _get_tag(token, "HW_slot") not in (_missing, None, False):
+                    yield _get_tag(token, "label")
 
     def has_token_with_label(self, label: str) -> bool:
-        if "slots" in self._scan_data:
-            for s in self._scan_data["slots"]:
-                if "token" in s and "label" in s["token"]:
-                    if s["token"]["label"] == label:
-                        return True
-        return False
+        return label in self._get_index("label")
 
     def get_token_for_label(self, label: str) -> dict | None:
-        if "slots" in self._scan_data:
-            for s in self._scan_data["slots"]:
-                if "token" in s and "label" in s["token"]:
-                    if s["token"]["label"] == label:
-                        return s["token"]
-        return None
+        return _as_dict(self._get_index("label").get(label, None))
+
+    def has_token_with_serial(self, serial: str) -> bool:
+        return serial in self._get_index("serial")
+
+    def get_token_for_serial(self, serial: str) -> dict | None:
+        return _as_dict(self._get_index("serial").get(serial, None))
+
+    def get_objects_for_key_id(self, key_id: bytes) -> list[dict]:
+        return [
+            _as_dict(obj)
+            for _, obj in self._get_index("key_id").get(key_id, [])
+        ]
+
+    def get_tokens_for_key_id(self, key_id: bytes) -> list[dict]:
+        tokens: list[Any] = []
+        for token, _ in self._get_index("key_id").get(key_id, []):
+            if not any(token is t for t in tokens):
+                tokens.append(token)
+        return [_as_dict(token) for token in tokens]
+
+    def get_certificate_for_fingerprint(
+        self, fingerprint: bytes
+    ) -> dict | None:
+        hit = self._get_index("fingerprint").get(fingerprint, None)
+        return _as_dict(hit[1]) if hit is not None else None
+
+    def get_token_for_fingerprint(self, fingerprint: bytes) -> dict | None:
+        hit = self._get_index("fingerprint").get(fingerprint, None)
+        return _as_dict(hit[0]) if hit is not None else None
+
+    def get_for_uri(self, uri: str) -> dict | None:
+        return _as_dict(self._get_index("uri").get(uri, None))
@@ -0,0 +1,230 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from os import replace
+from os.path import exists
+from threading import Lock
+from typing import Callable
+
+from pkcs11_cryptography_keys import TokenProperties
+from PyKCS11 import PyKCS11Lib
+
+from .pkcs11_library_pool import PKCS11LibraryPool, close_session, open_session
+from .pkcs11_scan_serializer import dumps_scan_binary, loads_scan_binary
+
+
+def _dump_slot(slot: dict | None) -> bytes:
+    # slots are kept encoded, every lookup decodes its own copy
+    return dumps_scan_binary({"slot": slot})
+
+
+def _load_slot(frame: bytes) -> dict | None:
+    data, _, _ = loads_scan_binary(frame)
+    return data["slot"]
+
+
+def _load_entries(raw: bytes) -> list[tuple[tuple, tuple, bytes]]:
+    data, _, _ = loads_scan_binary(raw)
+    ret = []
+    for entry in data["entries"]:
+        key, fingerprint, frame = entry
+        if not (
+            isinstance(key, tuple)
+            and isinstance(fingerprint, tuple)
+            and isinstance(frame, bytes)
+        ):
+            raise ValueError("Not a scan cache entry")
+        ret.append((key, fingerprint, frame))
+    return ret
+
+
+def read_token_fingerprint(
+    library: PyKCS11Lib,
+    slot: int,
+    token_properties: TokenProperties,
+    pool: PKCS11LibraryPool | None = None,
+) -> tuple:
+    # cheap markers that change when objects are added to or removed from
+    # a token, private objects are not visible without login
+    if pool is not None:
+        session, _ = pool.acquire_session(library, slot)
+        valid = False
+        try:
+            object_count = len(session.findObjects([]))
+            valid = True
+        finally:
+            pool.release_session(session, False, valid)
+    else:
+        session, _ = open_session(library, slot, False, None)
+        try:
+            object_count = len(session.findObjects([]))
+        finally:
+            close_session(session, False)
+    return (
+        object_count,
+        tuple(sorted(token_properties.gen_set_flags())),
+        token_properties.get_free_public_memory(),
+        token_properties.get_free_private_memory(),
+        token_properties.get_total_public_memory(),
+        token_properties.get_total_private_memory(),
+    )
+
+
+class PKCS11ScanCache(object):
+    def __init__(
+        self,
+        cache_file: str | None = None,
+        max_size: int = 256,
+        background_revalidation: bool = False,
+    ):
+        self._cache_file = cache_file
+        self._max_size = max_size
+        self._background_revalidation = background_revalidation
+        self._cache: OrderedDict[tuple, tuple[tuple, bytes]] = OrderedDict()
+        self._lock = Lock()
+        self._save_lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        self._stale = 0
+        self._dirty = False
+        self._revalidations: list[Future] = []
+        self._executor: ThreadPoolExecutor | None = None
+        if self._cache_file is not None and exists(self._cache_file):
+            self.load()
+
+    @staticmethod
+    def get_key(
+        library: PyKCS11Lib,
+        token_properties: TokenProperties,
+        variant: tuple,
+    ) -> tuple | None:
+        library_path = getattr(library, "pkcs11dll_filename", None)
+        if library_path is None:
+            return None
+        return (
+            library_path,
+            token_properties.get_serialNumber(),
+            token_properties.get_label(),
+        ) + variant
+
+    def is_background_revalidation(self) -> bool:
+        return self._background_revalidation
+
+    def lookup(
+        self, key: tuple, fingerprint: tuple | None = None
+    ) -> tuple[bool, dict | None]:
+        # without a fingerprint any cached entry is answered
+        with self._lock:
+            entry = self._cache.get(key, None)
+            if entry is None:
+                self._misses += 1
+                return False, None
+            if fingerprint is not None and entry[0] != fingerprint:
+                self._stale += 1
+                return False, None
+        try:
+            # every caller gets its own copy of the cached slot
+            slot = _load_slot(entry[1])
+        except ValueError:
+            with self._lock:
+                if self._cache.get(key, None) is entry:
+                    del self._cache[key]
+                self._misses += 1
+            return False, None
+        with self._lock:
+            self._hits += 1
+            if key in self._cache:
+                self._cache.move_to_end(key)
+        return True, slot
+
+    def get_fingerprint(self, key: tuple) -> tuple | None:
+        with self._lock:
+            entry = self._cache.get(key, None)
+            return entry[0] if entry is not None else None
+
+    def put(self, key: tuple, fingerprint: tuple, slot: dict | None):
+        data = _dump_slot(slot)
+        with self._lock:
+            self._cache[key] = (fingerprint, data)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+            # the file is written by flush, once per scan
+            self._dirty = True
+
+    def revalidate(self, func: Callable[[], None]):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="PKCS11 scan cache"
+                )
+            self._revalidations = [
+                f for f in self._revalidations if not f.done()
+            ]
+            self._revalidations.append(
+                self._executor.submit(self.__revalidate, func)
+            )
+
+    def __revalidate(self, func: Callable[[], None]):
+        # revalidation ends after the scan, it writes its own results
+        func()
+        self.flush()
+
+    def wait_for_revalidation(self, timeout: float | None = None):
+        with self._lock:
+            pending = list(self._revalidations)
+        wait(pending, timeout)
+
+    def get_statistics(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "stale": self._stale,
+                "size": len(self._cache),
+            }
+
+    def flush(self):
+        with self._lock:
+            dirty = self._dirty
+        if dirty:
+            self.save()
+
+    def close(self):
+        self.flush()
+
+    def clear(self):
+        with self._lock:
+            self._dirty = self._dirty or len(self._cache) > 0
+            self._cache.clear()
+            self._hits = 0
+            self._misses = 0
+            self._stale = 0
+
+    def save(self):
+        if self._cache_file is not None:
+            with self._lock:
+                entries = [
+                    (key, fingerprint, frame)
+                    for key, (fingerprint, frame) in self._cache.items()
+                ]
+                self._dirty = False
+            tmp_file = "{0}.tmp".format(self._cache_file)
+            with self._save_lock:
+                with open(tmp_file, "wb") as f:
+                    f.write(dumps_scan_binary({"entries": entries}))
+                replace(tmp_file, self._cache_file)
+
+    def load(self):
+        if self._cache_file is not None:
+            try:
+                with open(self._cache_file, "rb") as f:
+                    entries = _load_entries(f.read())
+            except (OSError, ValueError, KeyError, TypeError):
+                # a file that does not decode leaves the cache empty, it is
+                # written again after the next scan
+                return
+            with self._lock:
+                for key, fingerprint, frame in entries:
+                    self._cache[key] = (fingerprint, frame)
+                while len(self._cache) > self._max_size:
+                    self._cache.popitem(last=False)
@@ -0,0 +1,482 @@
+from collections.abc import Mapping
+from enum import Enum
+from json import dumps, loads
+from typing import Any
+
+from .pkcs11_scan_serializer import (
+    PKCS11_scan_schema_version,
+    decode_json_value,
+    encode_json_value,
+)
+from .pkcs11_slot_change import PKCS11SlotChangeType
+
+_object_buckets = ("private keys", "public keys", "certificates")
+_token_children = _object_buckets + ("mechanisms",)
+
+
+class PKCS11ScanChangeTarget(Enum):
+    library = 1
+    slot = 2
+    token = 3
+    object = 4
+    mechanism = 5
+
+    def __str__(self):
+        return super().__str__().replace("PKCS11ScanChangeTarget.", "")
+
+
+class PKCS11ScanChange(object):
+    def __init__(
+        self,
+        target: PKCS11ScanChangeTarget,
+        change_type: PKCS11SlotChangeType,
+        slot_key: tuple | None = None,
+        bucket: str | None = None,
+        key: Any = None,
+        data: Any = None,
+        removed_fields: list[str] | None = None,
+    ):
+        # added items carry their data, changed ones only the changed fields
+        self._target = target
+        self._change_type = change_type
+        self._slot_key = slot_key
+        self._bucket = bucket
+        self._key = key
+        self._data = data
+        self._removed_fields = removed_fields
+
+    def get_target(self) -> PKCS11ScanChangeTarget:
+        return self._target
+
+    def get_change_type(self) -> PKCS11SlotChangeType:
+        return self._change_type
+
+    def get_slot_key(self) -> tuple | None:
+        return self._slot_key
+
+    def get_bucket(self) -> str | None:
+        return self._bucket
+
+    def get_key(self) -> Any:
+        return self._key
+
+    def get_data(self) -> Any:
+        return self._data
+
+    def get_removed_fields(self) -> list[str]:
+        return self._removed_fields if self._removed_fields else []
+
+    def to_dict(self) -> dict:
+        ret: dict = {
+            "target": self._target.name,
+            "change": self._change_type.name,
+        }
+        for name, val in (
+            ("slot", self._slot_key),
+            ("bucket", self._bucket),
+            ("key", self._key),
+            ("data", self._data),
+            ("removed_fields", self._removed_fields),
+        ):
+            if val is not None:
+                ret[name] = val
+        return ret
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PKCS11ScanChange":
+        return cls(
+            PKCS11ScanChangeTarget[data["target"]],
+            PKCS11SlotChangeType[data["change"]],
+            data.get("slot", None),
+            data.get("bucket", None),
+            data.get("key", None),
+            data.get("data", None),
+            data.get("removed_fields", None),
+        )
+
+    def __str__(self):
+        ret = "{0} {1}".format(self._target, self._change_type)
+        if self._slot_key is not None:
+            ret = "{0} in {1}".format(ret, self._slot_key[1])
+        if self._key is not None:
+            ret = "{0}: {1}".format(ret, self._key)
+        return ret
+
+
+def _keyed(items: list, get_key) -> dict:
+    # duplicate keys are told apart by their occurrence
+    ret: dict = {}
+    seen: dict = {}
+    for item in items:
+        base = get_key(item)
+        n = seen.get(base, 0)
+        seen[base] = n + 1
+        ret[base + (n,)] = item
+    return ret
+
+
+def _get_slot_key(slot: Mapping) -> tuple:
+    token = slot.get("token", None)
+    if token is not None:
+        serial = token.get("serialNumber", None)
+        if serial:
+            return ("serial", serial)
+        return ("label", token.get("label", None))
+    return ("slot", slot.get("slotDescription", None))
+
+
+def _get_object_key(obj: Mapping) -> tuple:
+    key_id = obj.get("id", obj.get("key_id", None))
+    if key_id is not None:
+        return ("id", key_id)
+    return ("label", obj.get("label", obj.get("key_label", None)))
+
+
+def _diff_fields(
+    old: Mapping, new: Mapping, skip: tuple = ()
+) -> tuple[dict, list[str]]:
+    changed = {
+        k: v
+        for k, v in new.items()
+        if k not in skip and (k not in old or old[k] != v)
+    }
+    removed = [k for k in old if k not in skip and k not in new]
+    return changed, removed
+
+
+def _apply_fields(data: Mapping, changed: dict, removed: list[str]) -> dict:
+    ret = dict(data)
+    for k in removed:
+        ret.pop(k, None)
+    ret.update(changed)
+    return ret
+
+
+def _get_order(
+    old_keys: list, new_keys: list, removed: set, added: list
+) -> list | None:
+    # an order is only sent when removing and appending does not give it
+    expected = [k for k in old_keys if k not in removed] + added
+    return None if expected == new_keys else new_keys
+
+
+def _reorder(keyed: dict, order: list | None) -> list:
+    if order is None:
+        return list(keyed.values())
+    return [keyed[k] for k in order]
+
+
+class PKCS11ScanDiff(object):
+    def __init__(
+        self,
+        changes: list[PKCS11ScanChange] | None = None,
+        orders: dict | None = None,
+    ):
+        self._changes: list[PKCS11ScanChange] = (
+            changes if changes is not None else []
+        )
+        # new order of slots (key None) or of objects in a bucket
+        self._orders: dict = orders if orders is not None else {}
+
+    @classmethod
+    def from_scan_data(cls, old: dict, new: dict) -> "PKCS11ScanDiff":
+        diff = cls()
+        diff.__diff_scan(old, new)
+        return diff
+
+    def get_changes(self) -> list[PKCS11ScanChange]:
+        return self._changes
+
+    def get_orders(self) -> dict:
+        return self._orders
+
+    def is_empty(self) -> bool:
+        return len(self._changes) == 0 and len(self._orders) == 0
+
+    def __len__(self):
+        return len(self._changes)
+
+    def __add(self, *args, **kwargs):
+        self._changes.append(PKCS11ScanChange(*args, **kwargs))
+
+    def __diff_scan(self, old: dict, new: dict):
+        changed, removed = _diff_fields(old, new, ("slots",))
+        if len(changed) > 0 or len(removed) > 0:
+            self.__add(
+                PKCS11ScanChangeTarget.library,
+                PKCS11SlotChangeType.changed,
+                data=changed,
+                removed_fields=removed,
+            )
+        old_slots = _keyed(old.get("slots", []), _get_slot_key)
+        new_slots = _keyed(new.get("slots", []), _get_slot_key)
+        for key, slot in old_slots.items():
+            if key not in new_slots:
+                self.__add(
+                    PKCS11ScanChangeTarget.slot,
+                    PKCS11SlotChangeType.removed,
+                    key,
+                )
+        added = []
+        for key, slot in new_slots.items():
+            old_slot = old_slots.get(key, None)
+            if old_slot is None:
+                added.append(key)
+                self.__add(
+                    PKCS11ScanChangeTarget.slot,
+                    PKCS11SlotChangeType.added,
+                    key,
+                    data=slot,
+                )
+            elif old_slot is not slot:
+                self.__diff_slot(key, old_slot, slot)
+        order = _get_order(
+            list(old_slots),
+            list(new_slots),
+            {k for k in old_slots if k not in new_slots},
+            added,
+        )
+        if order is not None:
+            self._orders[None] = order
+
+    def __diff_slot(self, slot_key: tuple, old: Mapping, new: Mapping):
+        changed, removed = _diff_fields(old, new, ("token",))
+        if len(changed) > 0 or len(removed) > 0:
+            self.__add(
+                PKCS11ScanChangeTarget.slot,
+                PKCS11SlotChangeType.changed,
+                slot_key,
+                data=changed,
+                removed_fields=removed,
+            )
+        old_token = old.get("token", None)
+        new_token = new.get("token", None)
+        if old_token is None or new_token is None or old_token is new_token:
+            return
+        # children present on one side only change as token fields
+        skip = tuple(
+            k for k in _token_children if k in old_token and k in new_token
+        )
+        changed, removed = _diff_fields(old_token, new_token, skip)
+        if len(changed) > 0 or len(removed) > 0:
+            self.__add(
+                PKCS11ScanChangeTarget.token,
+                PKCS11SlotChangeType.changed,
+                slot_key,
+                data=changed,
+                removed_fields=removed,
+            )
+        for bucket in skip:
+            if bucket == "mechanisms":
+                self.__diff_mechanisms(
+                    slot_key, old_token[bucket], new_token[bucket]
+                )
+            else:
+                self.__diff_objects(
+                    slot_key, bucket, old_token[bucket], new_token[bucket]
+                )
+
+    def __diff_objects(
+        self, slot_key: tuple, bucket: str, old: list, new: list
+    ):
+        old_objects = _keyed(old, _get_object_key)
+        new_objects = _keyed(new, _get_object_key)
+        for key in old_objects:
+            if key not in new_objects:
+                self.__add(
+                    PKCS11ScanChangeTarget.object,
+                    PKCS11SlotChangeType.removed,
+                    slot_key,
+                    bucket,
+                    key,
+                )
+        added = []
+        for key, obj in new_objects.items():
+            old_obj = old_objects.get(key, None)
+            if old_obj is None:
+                added.append(key)
+                self.__add(
+                    PKCS11ScanChangeTarget.object,
+                    PKCS11SlotChangeType.added,
+                    slot_key,
+                    bucket,
+                    key,
+                    obj,
+                )
+            elif old_obj is not obj:
+                changed, removed = _diff_fields(old_obj, obj)
+                if len(changed) > 0 or len(removed) > 0:
+                    self.__add(
+                        PKCS11ScanChangeTarget.object,
+                        PKCS11SlotChangeType.changed,
+                        slot_key,
+                        bucket,
+                        key,
+                        changed,
+                        removed,
+                    )
+        order = _get_order(
+            list(old_objects),
+            list(new_objects),
+            {k for k in old_objects if k not in new_objects},
+            added,
+        )
+        if order is not None:
+            self._orders[(slot_key, bucket)] = order
+
+    def __diff_mechanisms(self, slot_key: tuple, old: dict, new: dict):
+        if old is new:
+            return
+        for name in old:
+            if name not in new:
+                self.__add(
+                    PKCS11ScanChangeTarget.mechanism,
+                    PKCS11SlotChangeType.removed,
+                    slot_key,
+                    key=name,
+                )
+        for name, tags in new.items():
+            if name not in old:
+                change_type = PKCS11SlotChangeType.added
+            elif old[name] != tags:
+                change_type = PKCS11SlotChangeType.changed
+            else:
+                continue
+            self.__add(
+                PKCS11ScanChangeTarget.mechanism,
+                change_type,
+                slot_key,
+                key=name,
+                data=tags,
+            )
+
+    def apply_to(self, data: dict) -> dict:
+        # the old data is not modified, only changed containers are copied
+        ret = dict(data)
+        slots = _keyed(data.get("slots", []), _get_slot_key)
+        tokens: dict[tuple, dict] = {}
+        buckets: dict[tuple, dict] = {}
+        for change in self._changes:
+            target = change.get_target()
+            change_type = change.get_change_type()
+            slot_key = change.get_slot_key()
+            if target == PKCS11ScanChangeTarget.library:
+                ret = _apply_fields(
+                    ret, change.get_data(), change.get_removed_fields()
+                )
+            elif slot_key is None:
+                raise ValueError(
+                    "Scan change without a slot: {0}".format(change)
+                )
+            elif target == PKCS11ScanChangeTarget.slot:
+                if change_type == PKCS11SlotChangeType.removed:
+                    del slots[slot_key]
+                elif change_type == PKCS11SlotChangeType.added:
+                    slots[slot_key] = change.get_data()
+                else:
+                    slots[slot_key] = _apply_fields(
+                        slots[slot_key],
+                        change.get_data(),
+                        change.get_removed_fields(),
+                    )
+            elif target == PKCS11ScanChangeTarget.token:
+                token = self.__get_token(slots, tokens, slot_key)
+                new_token = _apply_fields(
+                    token, change.get_data(), change.get_removed_fields()
+                )
+                token.clear()
+                token.update(new_token)
+            elif target == PKCS11ScanChangeTarget.mechanism:
+                token = self.__get_token(slots, tokens, slot_key)
+                mechanisms = dict(token["mechanisms"])
+                if change_type == PKCS11SlotChangeType.removed:
+                    del mechanisms[change.get_key()]
+                else:
+                    mechanisms[change.get_key()] = change.get_data()
+                token["mechanisms"] = mechanisms
+            else:
+                objects = self.__get_bucket(
+                    slots, tokens, buckets, (slot_key, change.get_bucket())
+                )
+                key = change.get_key()
+                if change_type == PKCS11SlotChangeType.removed:
+                    del objects[key]
+                elif change_type == PKCS11SlotChangeType.added:
+                    objects[key] = change.get_data()
+                else:
+                    objects[key] = _apply_fields(
+                        objects[key],
+                        change.get_data(),
+                        change.get_removed_fields(),
+                    )
+        for order_key in self._orders:
+            if order_key is not None:
+                self.__get_bucket(slots, tokens, buckets, order_key)
+        for (slot_key, bucket), objects in buckets.items():
+            tokens[slot_key][bucket] = _reorder(
+                objects, self._orders.get((slot_key, bucket), None)
+            )
+        if "slots" in data or len(slots) > 0:
+            ret["slots"] = _reorder(slots, self._orders.get(None, None))
+        return ret
+
+    def __get_token(self, slots: dict, tokens: dict, slot_key: tuple) -> dict:
+        token = tokens.get(slot_key, None)
+        if token is None:
+            slot = dict(slots[slot_key])
+            token = dict(slot["token"])
+            slot["token"] = token
+            slots[slot_key] = slot
+            tokens[slot_key] = token
+        return token
+
+    def __get_bucket(
+        self, slots: dict, tokens: dict, buckets: dict, bucket_key: tuple
+    ) -> dict:
+        objects = buckets.get(bucket_key, None)
+        if objects is None:
+            token = self.__get_token(slots, tokens, bucket_key[0])
+            objects = _keyed(token[bucket_key[1]], _get_object_key)
+            buckets[bucket_key] = objects
+        return objects
+
+    def to_dict(self) -> dict:
+        return {
+            "changes": [c.to_dict() for c in self._changes],
+            "orders": [[k, v] for k, v in self._orders.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PKCS11ScanDiff":
+        orders = {}
+        for k, v in data.get("orders", []):
+            if k is not None:
+                k = (tuple(k[0]), k[1])
+            orders[k] = [tuple(o) for o in v]
+        return cls(
+            [PKCS11ScanChange.from_dict(c) for c in data.get("changes", [])],
+            orders,
+        )
+
+    def to_json(self) -> str:
+        return dumps(
+            encode_json_value(
+                {"schema": PKCS11_scan_schema_version, "diff": self.to_dict()}
+            ),
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, text: str | bytes) -> "PKCS11ScanDiff":
+        data = decode_json_value(loads(text))
+        if not isinstance(data, dict) or "diff" not in data:
+            raise ValueError("Not a serialized scan diff")
+        schema = data.get("schema", None)
+        if not isinstance(schema, int) or schema > PKCS11_scan_schema_version:
+            raise ValueError(
+                "Unsupported scan schema version {0}".format(schema)
+            )
+        return cls.from_dict(data["diff"])
+
+    def __str__(self):
+        return "\n".join(str(c) for c in self._changes)
@@ -0,0 +1,96 @@
+from typing import BinaryIO, Iterator
+
+from .pkcs11_scan import PKCS11Scan
+from .pkcs11_scan_serializer import (
+    PKCS11_scan_magic,
+    PKCS11_scan_schema_version,
+    PKCS11ScanDecoder,
+    PKCS11ScanEncoder,
+    read_binary_header,
+    write_varint,
+)
+
+# every binary frame starts with this byte, a header starts with the magic
+_frame_marker = b"\x00"
+
+
+def _read_exactly(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated scan history")
+    return data
+
+
+def _read_frame_size(f: BinaryIO) -> int:
+    ret = 0
+    shift = 0
+    while True:
+        b = _read_exactly(f, 1)[0]
+        ret |= (b & 0x7F) << shift
+        if b < 0x80:
+            return ret
+        shift += 7
+
+
+class PKCS11ScanHistoryWriter(object):
+    def __init__(self, f: BinaryIO, binary: bool = True):
+        self._f = f
+        self._binary = binary
+        self._encoder: PKCS11ScanEncoder | None = None
+        self._count = 0
+
+    def write(self, scan: PKCS11Scan):
+        if not self._binary:
+            self._f.write(scan.to_json().encode())
+            self._f.write(b"\n")
+        else:
+            if self._encoder is None:
+                # a new header starts a new string table, so histories can be
+                # appended to
+                self._encoder = PKCS11ScanEncoder()
+                self._f.write(PKCS11_scan_magic)
+                self._f.write(bytes([PKCS11_scan_schema_version]))
+            frame = self._encoder.encode(
+                scan.to_dict(),
+                scan.get_library_path(),
+                scan.get_call_summary(),
+            )
+            size = bytearray()
+            write_varint(size, len(frame))
+            self._f.write(_frame_marker + bytes(size) + frame)
+        self._count += 1
+
+    def get_count(self) -> int:
+        return self._count
+
+
+def _gen_binary_history(f: BinaryIO, first: bytes) -> Iterator[PKCS11Scan]:
+    decoder: PKCS11ScanDecoder | None = None
+    marker = first
+    while len(marker) > 0:
+        if marker == _frame_marker:
+            if decoder is None:
+                raise ValueError("Scan frame without a header")
+            frame = _read_exactly(f, _read_frame_size(f))
+            data, library_path, call_summary = decoder.decode(frame)
+            yield PKCS11Scan(data, call_summary, library_path)
+        else:
+            header = marker + _read_exactly(f, len(PKCS11_scan_magic))
+            read_binary_header(header)
+            decoder = PKCS11ScanDecoder()
+        marker = f.read(1)
+
+
+def gen_scan_history(f: BinaryIO) -> Iterator[PKCS11Scan]:
+    # scans are read one at a time, the history is never loaded as a whole
+    first = f.read(1)
+    if len(first) == 0:
+        return
+    if first == PKCS11_scan_magic[:1]:
+        yield from _gen_binary_history(f, first)
+        return
+    line = first + f.readline()
+    while len(line) > 0:
+        if len(line.strip()) > 0:
+            yield PKCS11Scan.from_json(line)
+        line = f.readline()
@@ -0,0 +1,222 @@
+from dataclasses import dataclass, fields
+from threading import Lock
+from typing import Any
+from weakref import WeakValueDictionary
+
+from pkcs11_cryptography_keys import KeyTypes, PKCS11KeyUsage
+
+_object_buckets = ("private keys", "public keys", "certificates")
+
+# a table is shared while a record uses it and dropped with the last one
+_mechanism_tables: WeakValueDictionary[tuple, "PKCS11MechanismTable"] = (
+    WeakValueDictionary()
+)
+_mechanism_tables_lock = Lock()
+
+
+def _split_fields(cls, data: dict, skip: tuple = ()) -> tuple[dict, dict]:
+    names = {f.name for f in fields(cls)}
+    known: dict = {}
+    extra: dict = {}
+    for k, v in data.items():
+        if k in skip:
+            continue
+        if k in names and k != "extra" and v is not None:
+            known[k] = v
+        else:
+            # tags without a value stay in extra, so they are written back
+            extra[k] = v
+    return known, extra
+
+
+def _join_fields(record, skip: tuple = ()) -> dict:
+    extra = record.extra if record.extra is not None else {}
+    ret: dict = {}
+    for f in fields(record):
+        if f.name in skip or f.name == "extra":
+            continue
+        val = getattr(record, f.name)
+        if val is not None:
+            ret[f.name] = list(val) if f.name == "flags" else val
+        elif f.name in extra:
+            ret[f.name] = None
+    for k, v in extra.items():
+        ret.setdefault(k, v)
+    return ret
+
+
+@dataclass(slots=True, frozen=True)
+class PKCS11MechanismRecord:
+    name: str
+    ulMinKeySize: int | None = None
+    ulMaxKeySize: int | None = None
+    flags: tuple[str, ...] = ()
+
+    def to_dict(self) -> dict:
+        ret: dict = {}
+        if self.ulMinKeySize is not None:
+            ret["ulMinKeySize"] = self.ulMinKeySize
+        if self.ulMaxKeySize is not None:
+            ret["ulMaxKeySize"] = self.ulMaxKeySize
+        ret["flags"] = list(self.flags)
+        return ret
+
+
+def _get_mechanism_table(key: tuple) -> "PKCS11MechanismTable":
+    with _mechanism_tables_lock:
+        table = _mechanism_tables.get(key, None)
+        if table is None:
+            table = PKCS11MechanismTable(
+                tuple(PKCS11MechanismRecord(*k) for k in key)
+            )
+            _mechanism_tables[key] = table
+    return table
+
+
+@dataclass(frozen=True)
+class PKCS11MechanismTable:
+    __slots__ = ("mechanisms", "__weakref__")
+    mechanisms: tuple[PKCS11MechanismRecord, ...]
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PKCS11MechanismTable":
+        return _get_mechanism_table(
+            tuple(
+                (
+                    name,
+                    tags.get("ulMinKeySize", None),
+                    tags.get("ulMaxKeySize", None),
+                    tuple(tags.get("flags", ())),
+                )
+                for name, tags in data.items()
+            )
+        )
+
+    def to_dict(self) -> dict:
+        return {mr.name: mr.to_dict() for mr in self.mechanisms}
+
+    def __reduce__(self):
+        # unpickled tables are shared like the ones read from a scan
+        return _get_mechanism_table, (
+            tuple(
+                (mr.name, mr.ulMinKeySize, mr.ulMaxKeySize, mr.flags)
+                for mr in self.mechanisms
+            ),
+        )
+
+
+@dataclass(slots=True)
+class PKCS11ObjectRecord:
+    label: str | None = None
+    id: bytes | None = None
+    type: str | None = None
+    key_type: KeyTypes | None = None
+    key_usage: PKCS11KeyUsage | None = None
+    uri: str | None = None
+    extra: dict | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PKCS11ObjectRecord":
+        known, extra = _split_fields(cls, data)
+        return cls(**known, extra=extra if len(extra) > 0 else None)
+
+    def to_dict(self) -> dict:
+        return _join_fields(self)
+
+
+@dataclass(slots=True)
+class PKCS11TokenRecord:
+    label: str | None = None
+    manufacturerID: str | None = None
+    model: str | None = None
+    serialNumber: str | None = None
+    flags: tuple[str, ...] | None = None
+    objects: dict[str, list[PKCS11ObjectRecord]] | None = None
+    mechanisms: PKCS11MechanismTable | None = None
+    uri: str | None = None
+    extra: dict | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PKCS11TokenRecord":
+        known, extra = _split_fields(cls, data, ("objects",) + _object_buckets)
+        if "flags" in known:
+            known["flags"] = tuple(known["flags"])
+        if "mechanisms" in known:
+            known["mechanisms"] = PKCS11MechanismTable.from_dict(
+                known["mechanisms"]
+            )
+        objects = {
+            bucket: [PKCS11ObjectRecord.from_dict(obj) for obj in data[bucket]]
+            for bucket in _object_buckets
+            if bucket in data
+        }
+        return cls(
+            **known,
+            objects=objects if len(objects) > 0 else None,
+            extra=extra if len(extra) > 0 else None,
+        )
+
+    def to_dict(self) -> dict:
+        ret = _join_fields(self, ("objects", "mechanisms"))
+        if self.objects is not None:
+            for bucket, objs in self.objects.items():
+                ret[bucket] = [obj.to_dict() for obj in objs]
+        if self.mechanisms is not None:
+            ret["mechanisms"] = self.mechanisms.to_dict()
+        return ret
+
+
+@dataclass(slots=True)
+class PKCS11SlotRecord:
+    slotDescription: str | None = None
+    manufacturerID: str | None = None
+    flags: tuple[str, ...] | None = None
+    hardwareVersion: Any = None
+    firmwareVersion: Any = None
+    token: PKCS11TokenRecord | None = None
+    uri: str | None = None
+    extra: dict | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PKCS11SlotRecord":
+        known, extra = _split_fields(cls, data)
+        if "flags" in known:
+            known["flags"] = tuple(known["flags"])
+        if "token" in known:
+            known["token"] = PKCS11TokenRecord.from_dict(known["token"])
+        return cls(**known, extra=extra if len(extra) > 0 else None)
+
+    def to_dict(self) -> dict:
+        ret = _join_fields(self, ("token",))
+        if self.token is not None:
+            ret["token"] = self.token.to_dict()
+        return ret
+
+
+@dataclass(slots=True)
+class PKCS11LibraryRecord:
+    cryptokiVersion: Any = None
+    manufacturerID: str | None = None
+    flags: tuple[str, ...] | None = None
+    libraryDescription: str | None = None
+    libraryVersion: Any = None
+    slots: list[PKCS11SlotRecord] | None = None
+    uri: str | None = None
+    extra: dict | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PKCS11LibraryRecord":
+        known, extra = _split_fields(cls, data)
+        if "flags" in known:
+            known["flags"] = tuple(known["flags"])
+        if "slots" in known:
+            known["slots"] = [
+                PKCS11SlotRecord.from_dict(s) for s in known["slots"]
+            ]
+        return cls(**known, extra=extra if len(extra) > 0 else None)
+
+    def to_dict(self) -> dict:
+        ret = _join_fields(self, ("slots",))
+        if self.slots is not None:
+            ret["slots"] = [s.to_dict() for s in self.slots]
+        return ret
@@ -0,0 +1,434 @@
+from collections.abc import Mapping
+from datetime import datetime
+from enum import Enum
+from json import dumps, loads
+from struct import Struct
+from struct import error as StructError
+from typing import Any, Callable
+
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509 import (
+    Certificate,
+    ObjectIdentifier,
+    Version,
+    load_der_x509_certificate,
+)
+from pkcs11_cryptography_keys import KeyTypes, OperationTypes, PKCS11KeyUsage
+
+# bump when the encoding changes, readers refuse newer schemas
+PKCS11_scan_schema_version = 1
+PKCS11_scan_magic = b"PKCS11SCAN"
+
+_key_usage_operations: list[OperationTypes] = [
+    OperationTypes.CRYPT,
+    OperationTypes.SIGN,
+    OperationTypes.WRAP,
+    OperationTypes.RECOVER,
+    OperationTypes.DERIVE,
+]
+_enum_types: dict[str, type[Enum]] = {
+    "key_type": KeyTypes,
+    "x509_version": Version,
+}
+_double = Struct(">d")
+
+# binary value tags
+_NONE = 0
+_FALSE = 1
+_TRUE = 2
+_INT = 3
+_FLOAT = 4
+_STR = 5
+_BYTES = 6
+_LIST = 7
+_TUPLE = 8
+_DICT = 9
+_DATETIME = 10
+_ENUM = 11
+_KEY_USAGE = 12
+_OID = 13
+_CERTIFICATE = 14
+
+
+def _check_schema(schema: Any):
+    if not isinstance(schema, int) or schema > PKCS11_scan_schema_version:
+        raise ValueError("Unsupported scan schema version {0}".format(schema))
+
+
+def _get_enum_name(value: Enum) -> str | None:
+    for name, enum_type in _enum_types.items():
+        if isinstance(value, enum_type):
+            return name
+    return None
+
+
+def _get_key_usage(value: PKCS11KeyUsage) -> list[bool | None]:
+    return [value.get(op) for op in _key_usage_operations]
+
+
+def _make_key_usage(usage: list) -> PKCS11KeyUsage:
+    crypt, sign, wrap, recover, derive = usage
+    return PKCS11KeyUsage(crypt, sign, wrap, recover, derive)
+
+
+def encode_json_value(value: Any) -> Any:
+    # JSON native values stay as they are, others become tagged objects
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, bytes):
+        return {"$bytes": value.hex()}
+    if isinstance(value, list):
+        return [encode_json_value(v) for v in value]
+    if isinstance(value, tuple):
+        return {"$tuple": [encode_json_value(v) for v in value]}
+    if isinstance(value, Mapping):
+        if all(isinstance(k, str) and not k.startswith("$") for k in value):
+            return {k: encode_json_value(v) for k, v in value.items()}
+        return {
+            "$items": [
+                [encode_json_value(k), encode_json_value(v)]
+                for k, v in value.items()
+            ]
+        }
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, Enum):
+        name = _get_enum_name(value)
+        if name is not None:
+            return {"$" + name: value.name}
+    if isinstance(value, PKCS11KeyUsage):
+        return {"$key_usage": _get_key_usage(value)}
+    if isinstance(value, ObjectIdentifier):
+        return {"$oid": value.dotted_string}
+    if isinstance(value, Certificate):
+        return {"$certificate": value.public_bytes(Encoding.DER).hex()}
+    raise TypeError(
+        "Can not serialize {0} in a scan".format(type(value).__name__)
+    )
+
+
+def _decode_tagged(tag: str, value: Any) -> Any:
+    if tag == "$bytes":
+        return bytes.fromhex(value)
+    if tag == "$tuple":
+        return tuple(decode_json_value(v) for v in value)
+    if tag == "$items":
+        return {decode_json_value(k): decode_json_value(v) for k, v in value}
+    if tag == "$datetime":
+        return datetime.fromisoformat(value)
+    if tag == "$key_usage":
+        return _make_key_usage(value)
+    if tag == "$oid":
+        return ObjectIdentifier(value)
+    if tag == "$certificate":
+        return load_der_x509_certificate(bytes.fromhex(value))
+    enum_type = _enum_types.get(tag[1:], None)
+    if enum_type is not None:
+        return enum_type[value]
+    raise ValueError("Unknown scan value tag {0}".format(tag))
+
+
+def decode_json_value(value: Any) -> Any:
+    if isinstance(value, list):
+        return [decode_json_value(v) for v in value]
+    if isinstance(value, dict):
+        if len(value) == 1:
+            tag, tagged = next(iter(value.items()))
+            if tag.startswith("$"):
+                return _decode_tagged(tag, tagged)
+        return {k: decode_json_value(v) for k, v in value.items()}
+    return value
+
+
+def _make_envelope(
+    data: dict, library_path: str | None, call_summary: dict | None
+) -> dict:
+    envelope: dict = {"schema": PKCS11_scan_schema_version, "data": data}
+    if library_path is not None:
+        envelope["library_path"] = library_path
+    if call_summary is not None:
+        envelope["call_summary"] = call_summary
+    return envelope
+
+
+def _open_envelope(envelope: Any) -> tuple[dict, str | None, dict | None]:
+    if not isinstance(envelope, dict) or "data" not in envelope:
+        raise ValueError("Not a serialized scan")
+    _check_schema(envelope.get("schema", None))
+    return (
+        envelope["data"],
+        envelope.get("library_path", None),
+        envelope.get("call_summary", None),
+    )
+
+
+def dumps_scan_json(
+    data: dict,
+    library_path: str | None = None,
+    call_summary: dict | None = None,
+) -> str:
+    return dumps(
+        encode_json_value(_make_envelope(data, library_path, call_summary)),
+        separators=(",", ":"),
+    )
+
+
+def loads_scan_json(
+    text: str | bytes,
+) -> tuple[dict, str | None, dict | None]:
+    return _open_envelope(decode_json_value(loads(text)))
+
+
+def write_varint(out: bytearray, value: int):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: bytes | memoryview, pos: int) -> tuple[int, int]:
+    ret = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        ret |= (b & 0x7F) << shift
+        if b < 0x80:
+            return ret, pos
+        shift += 7
+
+
+class PKCS11ScanEncoder(object):
+    # strings are sent once, later frames of a stream refer to them by index
+    def __init__(self) -> None:
+        self._strings: dict[str, int] = {}
+        self._new_strings: list[str] = []
+        self._encoders: dict[type, Callable[[bytearray, Any], None]] = {
+            str: self.__encode_str,
+            int: self.__encode_int,
+            bool: self.__encode_bool,
+            bytes: self.__encode_bytes,
+            list: self.__encode_list,
+            dict: self.__encode_dict,
+        }
+
+    def encode(
+        self,
+        data: dict,
+        library_path: str | None = None,
+        call_summary: dict | None = None,
+    ) -> bytes:
+        self._new_strings = []
+        body = bytearray()
+        try:
+            self.__encode(
+                body, _make_envelope(data, library_path, call_summary)
+            )
+        except Exception:
+            # strings of a frame that is not sent must not be referenced
+            for s in self._new_strings:
+                del self._strings[s]
+            raise
+        out = bytearray()
+        write_varint(out, len(self._new_strings))
+        for s in self._new_strings:
+            raw = s.encode()
+            write_varint(out, len(raw))
+            out += raw
+        out += body
+        return bytes(out)
+
+    def __encode(self, out: bytearray, value: Any):
+        encoder = self._encoders.get(type(value), None)
+        if encoder is not None:
+            encoder(out, value)
+        else:
+            self.__encode_other(out, value)
+
+    def __encode_str(self, out: bytearray, value: str):
+        out.append(_STR)
+        index = self._strings.get(value, None)
+        if index is None:
+            index = len(self._strings)
+            self._strings[value] = index
+            self._new_strings.append(value)
+        write_varint(out, index)
+
+    def __encode_int(self, out: bytearray, value: int):
+        out.append(_INT)
+        # zigzag keeps small negative numbers short
+        write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+
+    def __encode_bool(self, out: bytearray, value: bool):
+        out.append(_TRUE if value else _FALSE)
+
+    def __encode_bytes(self, out: bytearray, value: bytes, tag: int = _BYTES):
+        out.append(tag)
+        write_varint(out, len(value))
+        out += value
+
+    def __encode_list(self, out: bytearray, value: list, tag: int = _LIST):
+        out.append(tag)
+        write_varint(out, len(value))
+        for v in value:
+            self.__encode(out, v)
+
+    def __encode_dict(self, out: bytearray, value: Mapping):
+        out.append(_DICT)
+        write_varint(out, len(value))
+        for k, v in value.items():
+            self.__encode(out, k)
+            self.__encode(out, v)
+
+    def __encode_other(self, out: bytearray, value: Any):
+        if value is None:
+            out.append(_NONE)
+        elif isinstance(value, bool):
+            self.__encode_bool(out, value)
+        elif isinstance(value, Enum) and _get_enum_name(value) is not None:
+            out.append(_ENUM)
+            self.__encode(out, _get_enum_name(value))
+            self.__encode(out, value.name)
+        elif isinstance(value, int):
+            self.__encode_int(out, value)
+        elif isinstance(value, float):
+            out.append(_FLOAT)
+            out += _double.pack(value)
+        elif isinstance(value, str):
+            self.__encode_str(out, value)
+        elif isinstance(value, bytes):
+            self.__encode_bytes(out, value)
+        elif isinstance(value, tuple):
+            self.__encode_list(out, list(value), _TUPLE)
+        elif isinstance(value, list):
+            self.__encode_list(out, value)
+        elif isinstance(value, Mapping):
+            self.__encode_dict(out, value)
+        elif isinstance(value, datetime):
+            out.append(_DATETIME)
+            self.__encode(out, value.isoformat())
+        elif isinstance(value, PKCS11KeyUsage):
+            out.append(_KEY_USAGE)
+            flags = 0
+            for i, v in enumerate(_get_key_usage(value)):
+                # two bits per usage, unset usages are kept apart from False
+                flags |= (0 if v is None else 2 if v else 1) << (i * 2)
+            write_varint(out, flags)
+        elif isinstance(value, ObjectIdentifier):
+            out.append(_OID)
+            self.__encode(out, value.dotted_string)
+        elif isinstance(value, Certificate):
+            self.__encode_bytes(
+                out, value.public_bytes(Encoding.DER), _CERTIFICATE
+            )
+        else:
+            raise TypeError(
+                "Can not serialize {0} in a scan".format(type(value).__name__)
+            )
+
+
+def _slice(data: memoryview, pos: int, size: int) -> memoryview:
+    if pos + size > len(data):
+        raise IndexError("Value out of frame")
+    return data[pos : pos + size]
+
+
+class PKCS11ScanDecoder(object):
+    def __init__(self) -> None:
+        self._strings: list[str] = []
+
+    def decode(self, frame: bytes) -> tuple[dict, str | None, dict | None]:
+        data = memoryview(frame)
+        try:
+            count, pos = _read_varint(data, 0)
+            for _ in range(count):
+                size, pos = _read_varint(data, pos)
+                self._strings.append(str(_slice(data, pos, size), "utf-8"))
+                pos += size
+            envelope, pos = self.__decode(data, pos)
+        except (IndexError, StructError):
+            raise ValueError("Truncated scan frame")
+        if pos != len(data):
+            raise ValueError("Trailing data in scan frame")
+        return _open_envelope(envelope)
+
+    def __decode(self, data: memoryview, pos: int) -> tuple[Any, int]:
+        tag = data[pos]
+        pos += 1
+        if tag == _STR:
+            index, pos = _read_varint(data, pos)
+            return self._strings[index], pos
+        if tag == _DICT:
+            size, pos = _read_varint(data, pos)
+            ret: dict = {}
+            for _ in range(size):
+                k, pos = self.__decode(data, pos)
+                ret[k], pos = self.__decode(data, pos)
+            return ret, pos
+        if tag == _LIST or tag == _TUPLE:
+            size, pos = _read_varint(data, pos)
+            items = []
+            for _ in range(size):
+                v, pos = self.__decode(data, pos)
+                items.append(v)
+            return (items if tag == _LIST else tuple(items)), pos
+        if tag == _INT:
+            value, pos = _read_varint(data, pos)
+            return (value >> 1 if value & 1 == 0 else -(value >> 1) - 1), pos
+        if tag == _NONE:
+            return None, pos
+        if tag == _FALSE or tag == _TRUE:
+            return tag == _TRUE, pos
+        if tag == _BYTES or tag == _CERTIFICATE:
+            size, pos = _read_varint(data, pos)
+            raw = bytes(_slice(data, pos, size))
+            if tag == _CERTIFICATE:
+                return load_der_x509_certificate(raw), pos + size
+            return raw, pos + size
+        if tag == _FLOAT:
+            return _double.unpack_from(data, pos)[0], pos + _double.size
+        if tag == _DATETIME:
+            text, pos = self.__decode(data, pos)
+            return datetime.fromisoformat(text), pos
+        if tag == _ENUM:
+            name, pos = self.__decode(data, pos)
+            member, pos = self.__decode(data, pos)
+            return _enum_types[name][member], pos
+        if tag == _KEY_USAGE:
+            flags, pos = _read_varint(data, pos)
+            usage = [
+                (None, False, True)[(flags >> (i * 2)) & 3]
+                for i in range(len(_key_usage_operations))
+            ]
+            return _make_key_usage(usage), pos
+        if tag == _OID:
+            text, pos = self.__decode(data, pos)
+            return ObjectIdentifier(text), pos
+        raise ValueError("Unknown scan value tag {0}".format(tag))
+
+
+def dumps_scan_binary(
+    data: dict,
+    library_path: str | None = None,
+    call_summary: dict | None = None,
+) -> bytes:
+    return (
+        PKCS11_scan_magic
+        + bytes([PKCS11_scan_schema_version])
+        + PKCS11ScanEncoder().encode(data, library_path, call_summary)
+    )
+
+
+def read_binary_header(header: bytes) -> int:
+    magic_size = len(PKCS11_scan_magic)
+    if len(header) <= magic_size or header[:magic_size] != PKCS11_scan_magic:
+        raise ValueError("Not a serialized scan")
+    _check_schema(header[magic_size])
+    return magic_size + 1
+
+
+def loads_scan_binary(
+    frame: bytes,
+) -> tuple[dict, str | None, dict | None]:
+    start = read_binary_header(frame)
+    return PKCS11ScanDecoder().decode(frame[start:])
@@ -0,0 +1,127 @@
+from enum import Enum
+from typing import Callable
+
+
+class PKCS11ScanItemType(Enum):
+    library = 1
+    slot = 2
+    token = 3
+    object = 4
+    mechanisms = 5
+
+    def __str__(self):
+        return super().__str__().replace("PKCS11ScanItemType.", "")
+
+
+class PKCS11ScanItem(object):
+    def __init__(
+        self,
+        item_type: PKCS11ScanItemType,
+        data: dict,
+        slot_id: int | None = None,
+        bucket: str | None = None,
+        slot_ids: list | None = None,
+    ):
+        self._item_type = item_type
+        self._data = data
+        self._slot_id = slot_id
+        self._bucket = bucket
+        # library items announce the slots that will follow
+        self._slot_ids = slot_ids
+
+    def get_type(self) -> PKCS11ScanItemType:
+        return self._item_type
+
+    def get_data(self) -> dict:
+        return self._data
+
+    def get_slot_id(self) -> int | None:
+        return self._slot_id
+
+    def get_bucket(self) -> str | None:
+        return self._bucket
+
+    def get_slot_ids(self) -> list | None:
+        return self._slot_ids
+
+    def __str__(self):
+        if self._slot_id is None:
+            return str(self._item_type)
+        if self._bucket is not None:
+            return "Slot {0} {1} in {2}".format(
+                self._slot_id, self._item_type, self._bucket
+            )
+        return "Slot {0} {1}".format(self._slot_id, self._item_type)
+
+
+PKCS11ScanItemCallback = Callable[[PKCS11ScanItem], None]
+
+_object_buckets = ("private keys", "public keys", "certificates")
+
+
+def gen_slot_items(slot_id: int, slot: dict):
+    # replays an assembled slot as the records a scanner would yield
+    yield PKCS11ScanItem(
+        PKCS11ScanItemType.slot,
+        {tag: val for tag, val in slot.items() if tag != "token"},
+        slot_id,
+    )
+    if "token" in slot:
+        token = slot["token"]
+        yield PKCS11ScanItem(
+            PKCS11ScanItemType.token,
+            {
+                tag: val
+                for tag, val in token.items()
+                if tag not in _object_buckets and tag != "mechanisms"
+            },
+            slot_id,
+        )
+        for bucket in _object_buckets:
+            for obj in token.get(bucket, []):
+                yield PKCS11ScanItem(
+                    PKCS11ScanItemType.object, obj, slot_id, bucket
+                )
+        if "mechanisms" in token:
+            yield PKCS11ScanItem(
+                PKCS11ScanItemType.mechanisms, token["mechanisms"], slot_id
+            )
+
+
+class PKCS11ScanAssembler(object):
+    def __init__(self) -> None:
+        self._library: dict = {}
+        self._slot_ids: list | None = None
+        self._slots: dict[int, dict] = {}
+
+    def add(self, item: PKCS11ScanItem):
+        tp = item.get_type()
+        sl = item.get_slot_id()
+        if tp == PKCS11ScanItemType.library:
+            self._library.update(item.get_data())
+            if item.get_slot_ids() is not None:
+                self._slot_ids = item.get_slot_ids()
+        elif sl is not None:
+            if tp == PKCS11ScanItemType.slot:
+                self._slots[sl] = dict(item.get_data())
+            else:
+                slot = self._slots.setdefault(sl, {})
+                if tp == PKCS11ScanItemType.token:
+                    slot["token"] = dict(item.get_data())
+                else:
+                    token = slot.setdefault("token", {})
+                    if tp == PKCS11ScanItemType.object:
+                        bucket = item.get_bucket()
+                        token.setdefault(bucket, []).append(item.get_data())
+                    elif tp == PKCS11ScanItemType.mechanisms:
+                        token["mechanisms"] = item.get_data()
+
+    def get_slot(self, slot_id: int) -> dict | None:
+        return self._slots.get(slot_id, None)
+
+    def get_scan(self, slots: list | None = None) -> dict:
+        ret = dict(self._library)
+        if slots is None:
+            slots = self._slot_ids if self._slot_ids else list(self._slots)
+        ret["slots"] = [self._slots[sl] for sl in slots if sl in self._slots]
+        return ret
@@ -1,146 +1,175 @@
-from pkcs11_cryptography_keys import (
-    KeyTypes,
-    LibraryProperties,
-    MechanismProperties,
-    SlotProperties,
-    TokenProperties,
-    read_key_usage_from_key,
+from threading import Lock
+from typing import AsyncIterator
+
+from pkcs11_cryptography_keys import SlotProperties, TokenProperties
+from PyKCS11 import CKA_CLASS, PyKCS11Lib
+
+from .pkcs11_attribute_reader import (
+    PKCS11_key_type_translation as PKCS11_key_type_translation,
 )
-from PyKCS11 import (
-    CKA_CLASS,
-    CKA_ID,
-    CKA_KEY_TYPE,
-    CKA_LABEL,
-    CKF_SERIAL_SESSION,
-    CKK_EC,
-    CKK_RSA,
-    CKO_CERTIFICATE,
-    CKO_DATA,
-    CKO_PRIVATE_KEY,
-    CKO_PUBLIC_KEY,
-    CKO_SECRET_KEY,
-    PyKCS11Lib,
+from .pkcs11_attribute_reader import PKCS11AttributeReader
+from .pkcs11_base_scanner import PKCS11BaseScanner
+from .pkcs11_library_pool import PKCS11LibraryPool, load_library
+from .pkcs11_query import PKCS11_type_translation as PKCS11_type_translation
+from .pkcs11_query import PKCS11Query
+from .pkcs11_scan_stream import (
+    PKCS11ScanItem,
+    PKCS11ScanItemCallback,
+    PKCS11ScanItemType,
 )
 
-PKCS11_type_translation: dict[str, int] = {
-    "certificate": CKO_CERTIFICATE,
-    "data": CKO_DATA,
-    "private": CKO_PRIVATE_KEY,
-    "public": CKO_PUBLIC_KEY,
-    "secret-key": CKO_SECRET_KEY,
+PKCS11_type_buckets: dict[str, str] = {
+    "private": "private keys",
+    "public": "public keys",
+    "certificate": "certificates",
 }
 
-PKCS11_key_type_translation: dict[int, KeyTypes] = {
-    CKK_EC: KeyTypes.EC,
-    CKK_RSA: KeyTypes.RSA,
-}
 
-
-class PKCS11Scanner(object):
-    def __init__(self, library: PyKCS11Lib) -> None:
-        self._library = library
+class PKCS11Scanner(PKCS11BaseScanner):
+    def __init__(
+        self,
+        library: PyKCS11Lib,
+        single_session: bool = False,
+        max_workers: int | None = None,
+    ) -> None:
+        super().__init__(library, max_workers)
+        self._single_session = single_session
+        self._session_count = 0
+        self._login_count = 0
+        self._count_lock = Lock()
 
     @classmethod
-    def from_library_path(cls, library_path: str | None = None):
-        library = PyKCS11Lib()
-        if library_path is not None:
-            library.load(library_path)
-        else:
-            library.load()
-        return cls(library)
+    def from_library_path(
+        cls,
+        library_path: str | None = None,
+        *,
+        single_session: bool = False,
+        max_workers: int | None = None,
+        pool: PKCS11LibraryPool | None = None,
+    ):
+        scanner = cls(
+            load_library(library_path, pool),
+            single_session=single_session,
+            max_workers=max_workers,
+        )
+        scanner._library_owner = pool
+        return scanner
+
+    def get_session_statistics(self) -> dict[str, int]:
+        return {"sessions": self._session_count, "logins": self._login_count}
 
-    async def __read_keys(
+    def __open_session(self, slot: int, login_required: bool, pin: str | None):
+        session, logged_in = self._open_session(slot, login_required, pin)
+        with self._count_lock:
+            self._session_count += 1
+            if logged_in:
+                self._login_count += 1
+        return session, logged_in
+
+    def __gen_objects(self, session, tp: str, query: PKCS11Query | None):
+        template = []
+        if tp in PKCS11_type_translation:
+            if query is not None:
+                template = query.get_template(tp)
+            else:
+                template.append((CKA_CLASS, PKCS11_type_translation[tp]))
+            keys = session.findObjects(template)
+            reader = PKCS11AttributeReader(session)
+            for key in keys:
+                key_data = reader.read_key_data(key, tp)
+                # some modules ignore parts of the search template
+                if query is None or query.matches_object(
+                    key_data["id"], key_data["label"]
+                ):
+                    yield key_data
+
+    async def __gen_all_keys(
         self,
-        library: PyKCS11Lib,
         slot: int,
-        tp: str,
         login_required: bool,
         pin: str | None,
-    ):
-        ret = []
-        template = []
-        if tp in PKCS11_type_translation:
-            tp_v = PKCS11_type_translation[tp]
-            template.append((CKA_CLASS, tp_v))
-            session = library.openSession(slot, CKF_SERIAL_SESSION)
-            logged_in: bool = False
+        query: PKCS11Query | None,
+    ) -> AsyncIterator[tuple[str, dict]]:
+        buckets = {
+            tp: bucket
+            for tp, bucket in PKCS11_type_buckets.items()
+            if query is None or query.accepts_type(tp)
+        }
+        if len(buckets) == 0:
+            return
+        if self._single_session:
+            session, logged_in = self.__open_session(slot, login_required, pin)
+            valid = False
             try:
-                if login_required and pin is not None:
-                    session.login(pin)
-                    logged_in = True
-                keys = session.findObjects(template)
-                for key in keys:
-                    key_data = {}
-                    attrs = session.getAttributeValue(
-                        key, [CKA_LABEL, CKA_ID, CKA_KEY_TYPE]
-                    )
-                    label = attrs[0]
-                    key_id = bytes(attrs[1])
-                    kt = attrs[2]
-                    key_data["label"] = label
-                    key_data["id"] = key_id
-                    key_data["type"] = tp
-                    kt_i = PKCS11_key_type_translation.get(kt, None)
-                    if kt_i is not None:
-                        key_data["key_type"] = kt_i
-                    key_usage = read_key_usage_from_key(session, key)
-                    if key_usage is not None:
-                        key_data["key_usage"] = key_usage
-                    ret.append(key_data)
+                for tp, bucket in buckets.items():
+                    for obj in self.__gen_objects(session, tp, query):
+                        yield bucket, obj
+                valid = True
             finally:
-                if logged_in:
-                    session.logout()
-                session.closeSession()
-        return ret
-
-    async def scan_from_library(
-        self,
-        pin: str | None = None,
-    ) -> dict:
-        ret: dict = {}
-        login_required = False
+                self._close_session(session, logged_in, valid)
+        else:
+            for tp, bucket in buckets.items():
+                session, logged_in = self.__open_session(
+                    slot, login_required, pin
+                )
+                valid = False
+                try:
+                    for obj in self.__gen_objects(session, tp, query):
+                        yield bucket, obj
+                    valid = True
+                finally:
+                    self._close_session(session, logged_in, valid)
 
-        lp = LibraryProperties.read_from_slot(self._library)
-        for tag, val in lp.gen_tags():
-            ret[tag] = val
-        slots = self._library.getSlotList(tokenPresent=True)
-        ret["slots"] = []
-        for sl in slots:
+    async def _gen_slot(
+        self, sl: int, pin: str | None, query: PKCS11Query | None = None
+    ) -> AsyncIterator[PKCS11ScanItem]:
+        tp = TokenProperties.read_from_slot(self._library, sl)
+        if tp.is_initialized() and (query is None or query.matches_token(tp)):
             slot = {}
-            tp = TokenProperties.read_from_slot(self._library, sl)
-            if tp.is_login_required():
-                login_required = True
-            if tp.is_initialized():
-                sp = SlotProperties.read_from_slot(self._library, sl)
-                for tag, val in sp.gen_tags():
-                    slot[tag] = val
-                slot["token"] = {}
-                # slot["token"]["max_pin_length"] = tp.get_max_pin_length()
-                # slot["token"]["min_pin_length"] = tp.get_min_pin_length()
-                for tag, val in tp.gen_tags():
-                    slot["token"][tag] = val
-                slot["token"]["private keys"] = await self.__read_keys(
-                    self._library, sl, "private", login_required, pin
-                )
-                slot["token"]["public keys"] = await self.__read_keys(
-                    self._library, sl, "public", login_required, pin
-                )
-                slot["token"]["certificates"] = await self.__read_keys(
-                    self._library,
+            sp = SlotProperties.read_from_slot(self._library, sl)
+            for tag, val in sp.gen_tags():
+                slot[tag] = val
+            yield PKCS11ScanItem(PKCS11ScanItemType.slot, slot, sl)
+            token = {}
+            # token["max_pin_length"] = tp.get_max_pin_length()
+            # token["min_pin_length"] = tp.get_min_pin_length()
+            for tag, val in tp.gen_tags():
+                token[tag] = val
+            yield PKCS11ScanItem(PKCS11ScanItemType.token, token, sl)
+            async for bucket, obj in self.__gen_all_keys(
+                sl, tp.is_login_required(), pin, query
+            ):
+                yield PKCS11ScanItem(PKCS11ScanItemType.object, obj, sl, bucket)
+            if query is None or query.has_mechanisms():
+                yield PKCS11ScanItem(
+                    PKCS11ScanItemType.mechanisms,
+                    self._read_mechanisms(sl, tp),
                     sl,
-                    "certificate",
-                    login_required,
-                    pin,
                 )
-                slot["token"]["mechanisms"] = {}
-                for mp in MechanismProperties.gen_mechanism_properties(
-                    self._library, sl
-                ):
-                    slot["token"]["mechanisms"][mp.get_mechanism_type()] = {}
-                    for tag, val in mp.gen_tags():
-                        slot["token"]["mechanisms"][mp.get_mechanism_type()][
-                            tag
-                        ] = val
-                ret["slots"].append(slot)
 
-        return ret
+    def _finish_slot(self, slot: dict | None) -> dict | None:
+        if slot is not None and "token" in slot:
+            # empty buckets produce no records but belong to the result
+            token = slot["token"]
+            buckets = PKCS11_type_buckets.values()
+            rez = {
+                tag: val
+                for tag, val in token.items()
+                if tag not in buckets and tag != "mechanisms"
+            }
+            for bucket in buckets:
+                rez[bucket] = token.get(bucket, [])
+            if "mechanisms" in token:
+                rez["mechanisms"] = token["mechanisms"]
+            slot["token"] = rez
+        return slot
+
+    async def scan_from_library(
+        self,
+        pin: str | None = None,
+        on_item: PKCS11ScanItemCallback | None = None,
+        query: PKCS11Query | None = None,
+    ) -> dict:
+        self._session_count = 0
+        self._login_count = 0
+        return await super().scan_from_library(pin, on_item, query)
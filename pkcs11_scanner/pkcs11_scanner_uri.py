@@ -1,27 +1,10 @@
-from urllib.parse import quote, quote_from_bytes
-
 from PyKCS11 import PyKCS11Lib
 
+from .pkcs11_library_pool import PKCS11LibraryPool, load_library
+from .pkcs11_query import PKCS11Query
+from .pkcs11_scan_stream import PKCS11ScanItemCallback
 from .pkcs11_scanner import PKCS11Scanner
-
-_translation = {
-    "info": {
-        "libraryDescription": "library-description",
-        # "libraryVersion": "library-version",
-        "manufacturerID": "library-manufacturer",
-    },
-    "slots": {
-        "manufacturerID": "slot-manufacturer",
-        "slotDescription": "slot-description",
-    },
-    "token": {
-        "label": "token",
-        "manufacturerID": "manufacturer",
-        "model": "model",
-        "serialNumber": "serial",
-    },
-    "object": {"object": "object", "id": "id", "type": "type"},
-}
+from .pkcs11_uri import PKCS11URIBuilder
 
 
 class PKCS11ScannerURI(PKCS11Scanner):
@@ -29,61 +12,49 @@ class PKCS11ScannerURI(PKCS11Scanner):
         self,
         library: PyKCS11Lib,
         ignore_parents: list[str] | None = None,
+        single_session: bool = False,
+        max_workers: int | None = None,
     ) -> None:
-        super().__init__(library)
+        super().__init__(library, single_session, max_workers)
         self._ignore_parents = (
             ignore_parents if ignore_parents is not None else []
         )
+        self._lazy_uris = False
+        self._pin_in_uri = False
 
     @classmethod
     def from_library_path(
         cls,
         library_path: str | None = None,
         ignore_parents: list[str] | None = None,
+        single_session: bool = False,
+        max_workers: int | None = None,
+        pool: PKCS11LibraryPool | None = None,
     ):
-        library = PyKCS11Lib()
-        if library_path is not None:
-            library.load(library_path)
-        else:
-            library.load()
-        return cls(library, ignore_parents)
+        library = load_library(library_path, pool)
+        scanner = cls(library, ignore_parents, single_session, max_workers)
+        scanner._library_owner = pool
+        return scanner
 
-    async def __add_uris(
-        self, parent: str, path: list | None, query: list, data: dict
-    ):
-        if parent in ["certificates", "public keys", "private keys"]:
-            parent = "object"
-        lpath = []
-        if path is not None:
-            lpath.extend(path)
-        for k, v in data.items():
-            if isinstance(v, dict):
-                await self.__add_uris(k, lpath, query, v)
-            elif isinstance(v, list):
-                for a in v:
-                    if isinstance(a, dict):
-                        await self.__add_uris(k, lpath, query, a)
-            else:
-                if parent not in self._ignore_parents:
-                    tag = _translation[parent].get(k, None)
-                    if tag is not None:
-                        if isinstance(v, bytes):
-                            lpath.append("{0}=%{1}".format(tag, v.hex()))
-                        else:
-                            lpath.append("{0}={1}".format(tag, quote(v)))
-        if len(lpath) > 0:
-            data["uri"] = "pkcs11:{0}".format(";".join(lpath))
-            if len(query) > 0:
-                data["uri"] = "{0}?{1}".format(data["uri"], ";".join(query))
+    def set_lazy_uris(self, lazy: bool = True):
+        self._lazy_uris = lazy
 
-    async def scan_from_library(self, pin: str | None = None) -> dict:
-        rez = await super().scan_from_library(pin)
-        parent = "info"
-        query = []
-        # TODO fix this
-        # if self._library is not None:
-        #    query.append("module-path={0}".format(self._library))
-        if pin is not None:
-            query.append("pin-value={0}".format(pin))
-        await self.__add_uris(parent, None, query, rez)
+    def set_pin_in_uri(self, pin_in_uri: bool = True):
+        self._pin_in_uri = pin_in_uri
+
+    def get_uri_builder(self, pin: str | None = None) -> PKCS11URIBuilder:
+        query = {}
+        if self._pin_in_uri and pin is not None:
+            query["pin-value"] = pin
+        return PKCS11URIBuilder(self._ignore_parents, query)
+
+    async def scan_from_library(
+        self,
+        pin: str | None = None,
+        on_item: PKCS11ScanItemCallback | None = None,
+        query: PKCS11Query | None = None,
+    ) -> dict:
+        rez = await super().scan_from_library(pin, on_item, query)
+        if not self._lazy_uris:
+            self.get_uri_builder(pin).add_uris(rez)
         return rez
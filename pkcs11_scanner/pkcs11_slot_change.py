@@ -0,0 +1,34 @@
+from enum import Enum
+
+
+class PKCS11SlotChangeType(Enum):
+    added = 1
+    removed = 2
+    changed = 3
+
+    def __str__(self):
+        return super().__str__().replace("PKCS11SlotChangeType.", "")
+
+
+class PKCS11SlotChange(object):
+    def __init__(
+        self,
+        slot_id: int,
+        change_type: PKCS11SlotChangeType,
+        slot_data: dict | None = None,
+    ):
+        self._slot_id = slot_id
+        self._change_type = change_type
+        self._slot_data = slot_data
+
+    def get_slot_id(self) -> int:
+        return self._slot_id
+
+    def get_change_type(self) -> PKCS11SlotChangeType:
+        return self._change_type
+
+    def get_slot_data(self) -> dict | None:
+        return self._slot_data
+
+    def __str__(self):
+        return "Slot {0} {1}".format(self._slot_id, self._change_type)
@@ -0,0 +1,73 @@
+from threading import Lock
+from time import monotonic
+
+
+class _SlotState(object):
+    def __init__(self):
+        self.reason = ""
+        self.failures = 0
+        self.retry_at = 0.0
+
+
+class PKCS11SlotHealth(object):
+    def __init__(
+        self,
+        min_backoff_seconds: float = 30,
+        max_backoff_seconds: float = 600,
+        factor: float = 2,
+    ):
+        self._min_backoff_seconds = min_backoff_seconds
+        self._max_backoff_seconds = max_backoff_seconds
+        self._factor = factor
+        self._lock = Lock()
+        self._slots: dict[int, _SlotState] = {}
+
+    def mark_degraded(self, slot: int, reason: str) -> dict:
+        with self._lock:
+            state = self._slots.get(slot, None)
+            if state is None:
+                state = self._slots[slot] = _SlotState()
+            state.reason = reason
+            state.failures += 1
+            # every failure in a row doubles the time the slot is skipped
+            backoff = min(
+                self._min_backoff_seconds
+                * self._factor ** (state.failures - 1),
+                self._max_backoff_seconds,
+            )
+            state.retry_at = monotonic() + backoff
+            return self.__get_info(state)
+
+    def mark_healthy(self, slot: int):
+        with self._lock:
+            self._slots.pop(slot, None)
+
+    def is_skipped(self, slot: int) -> bool:
+        with self._lock:
+            state = self._slots.get(slot, None)
+            return state is not None and monotonic() < state.retry_at
+
+    def get_degraded(self, slot: int) -> dict | None:
+        with self._lock:
+            state = self._slots.get(slot, None)
+            if state is None:
+                return None
+            return self.__get_info(state)
+
+    def get_degraded_slots(self) -> dict[int, dict]:
+        with self._lock:
+            return {
+                slot: self.__get_info(state)
+                for slot, state in self._slots.items()
+            }
+
+    def clear(self):
+        with self._lock:
+            self._slots.clear()
+
+    def __get_info(self, state: _SlotState) -> dict:
+        return {
+            "reason": state.reason,
+            "failures": state.failures,
+            "retry_seconds": max(state.retry_at - monotonic(), 0.0),
+        }
@@ -0,0 +1,270 @@
+from typing import Iterator
+from urllib.parse import quote, unquote, unquote_to_bytes
+
+from .pkcs11_query import PKCS11Query
+
+# RFC 7512 characters that need no percent-encoding besides unreserved ones
+_path_safe = ":[]@!$'()*+,="
+_query_safe = _path_safe + "/?|"
+
+_library_attributes: list[tuple[str, str]] = [
+    ("manufacturerID", "library-manufacturer"),
+    ("libraryDescription", "library-description"),
+    ("libraryVersion", "library-version"),
+]
+_slot_attributes: list[tuple[str, str]] = [
+    ("slotDescription", "slot-description"),
+    ("manufacturerID", "slot-manufacturer"),
+]
+_token_attributes: list[tuple[str, str]] = [
+    ("label", "token"),
+    ("manufacturerID", "manufacturer"),
+    ("model", "model"),
+    ("serialNumber", "serial"),
+]
+_object_attributes: list[tuple[str, str]] = [
+    ("label", "object"),
+    ("id", "id"),
+    ("type", "type"),
+]
+_object_lists: list[str] = ["private keys", "public keys", "certificates"]
+_object_types: dict[str, str] = {"certificate": "cert"}
+_record_types: dict[str, str] = {v: k for k, v in _object_types.items()}
+
+PKCS11_object_uri_attributes: list[str] = [tag for _, tag in _object_attributes]
+
+
+def quote_uri_value(value: str | bytes, query: bool = False) -> str:
+    if isinstance(value, bytes):
+        return "".join("%{0:02X}".format(b) for b in value)
+    return quote(value, safe=_query_safe if query else _path_safe)
+
+
+def get_uri_attributes(
+    node: dict, attributes: list[tuple[str, str]]
+) -> dict[str, str | bytes]:
+    ret: dict[str, str | bytes] = {}
+    for key, tag in attributes:
+        val = node.get(key, None)
+        if val is None:
+            continue
+        if isinstance(val, bytes):
+            ret[tag] = val
+        elif isinstance(val, (tuple, list)):
+            # versions are major and minor number
+            ret[tag] = ".".join(str(v) for v in val)
+        elif tag == "type":
+            ret[tag] = _object_types.get(val, val)
+        else:
+            ret[tag] = str(val)
+    return ret
+
+
+def get_library_uri_attributes(node: dict) -> dict[str, str | bytes]:
+    return get_uri_attributes(node, _library_attributes)
+
+
+def get_slot_uri_attributes(node: dict) -> dict[str, str | bytes]:
+    return get_uri_attributes(node, _slot_attributes)
+
+
+def get_token_uri_attributes(node: dict) -> dict[str, str | bytes]:
+    return get_uri_attributes(node, _token_attributes)
+
+
+def get_object_uri_attributes(node: dict) -> dict[str, str | bytes]:
+    return get_uri_attributes(node, _object_attributes)
+
+
+class PKCS11URI(object):
+    def __init__(
+        self,
+        path: dict[str, str | bytes],
+        query: dict[str, str] | None = None,
+    ) -> None:
+        self._path = path
+        self._query = query if query is not None else {}
+
+    @classmethod
+    def from_string(cls, uri: str) -> "PKCS11URI":
+        if not uri.startswith("pkcs11:"):
+            raise ValueError("Not a PKCS#11 URI: {0}".format(uri))
+        path_part, _, query_part = uri[7:].partition("?")
+        path: dict[str, str | bytes] = {}
+        for attr in path_part.split(";"):
+            if len(attr) == 0:
+                continue
+            tag, sep, val = attr.partition("=")
+            if len(sep) == 0 or tag in path:
+                raise ValueError("Invalid PKCS#11 URI: {0}".format(uri))
+            path[tag] = unquote_to_bytes(val) if tag == "id" else unquote(val)
+        query: dict[str, str] = {}
+        for attr in query_part.split("&"):
+            if len(attr) == 0:
+                continue
+            tag, sep, val = attr.partition("=")
+            if len(sep) == 0:
+                raise ValueError("Invalid PKCS#11 URI: {0}".format(uri))
+            query[tag] = unquote(val)
+        return cls(path, query)
+
+    def get_path(self) -> dict[str, str | bytes]:
+        return self._path
+
+    def get_query(self) -> dict[str, str]:
+        return self._query
+
+    def get(self, tag: str) -> str | bytes | None:
+        return self._path.get(tag, None)
+
+    def has_object_attributes(self) -> bool:
+        return any(tag in self._path for tag in PKCS11_object_uri_attributes)
+
+    def matches(
+        self, attributes: dict, ignore: list[str] | None = None
+    ) -> bool:
+        for tag, val in self._path.items():
+            if ignore is not None and tag in ignore:
+                continue
+            if attributes.get(tag, None) != val:
+                return False
+        return True
+
+    def to_query(self) -> PKCS11Query:
+        object_types = None
+        tp = self._path.get("type", None)
+        if isinstance(tp, str):
+            object_types = [_record_types.get(tp, tp)]
+        elif not self.has_object_attributes():
+            # token URIs do not select any objects
+            object_types = []
+        key_id = self._path.get("id", None)
+        label = self._path.get("object", None)
+        token_label = self._path.get("token", None)
+        token_serial = self._path.get("serial", None)
+        return PKCS11Query(
+            object_types=object_types,
+            key_id=key_id if isinstance(key_id, bytes) else None,
+            label=label if isinstance(label, str) else None,
+            token_label=token_label if isinstance(token_label, str) else None,
+            token_serial=(
+                token_serial if isinstance(token_serial, str) else None
+            ),
+            with_mechanisms=False,
+        )
+
+    def __str__(self):
+        ret = "pkcs11:{0}".format(
+            ";".join(
+                "{0}={1}".format(k, quote_uri_value(v))
+                for k, v in self._path.items()
+            )
+        )
+        if len(self._query) > 0:
+            ret = "{0}?{1}".format(
+                ret,
+                "&".join(
+                    "{0}={1}".format(k, quote_uri_value(v, True))
+                    for k, v in self._query.items()
+                ),
+            )
+        return ret
+
+
+class PKCS11URIBuilder(object):
+    def __init__(
+        self,
+        ignore_parents: list[str] | None = None,
+        query: dict[str, str] | None = None,
+    ) -> None:
+        self._ignore_parents = (
+            set(ignore_parents) if ignore_parents is not None else set()
+        )
+        self._query = ""
+        if query is not None and len(query) > 0:
+            self._query = "?{0}".format(
+                "&".join(
+                    "{0}={1}".format(k, quote_uri_value(v, True))
+                    for k, v in query.items()
+                )
+            )
+        # URIs of the last scan looked up, by node id, the nodes are kept so
+        # their ids are not reused
+        self._uri_data: dict | None = None
+        self._uris: dict[int, tuple[dict, str]] = {}
+
+    def __get_path(
+        self, parent: str, node: dict, attributes: list[tuple[str, str]]
+    ) -> str:
+        if parent in self._ignore_parents:
+            return ""
+        return ";".join(
+            "{0}={1}".format(tag, quote_uri_value(val))
+            for tag, val in get_uri_attributes(node, attributes).items()
+        )
+
+    def __make_uri(self, prefix: str, path: str) -> tuple[str, str | None]:
+        if len(path) > 0:
+            prefix = "{0};{1}".format(prefix, path) if prefix else path
+        if len(prefix) == 0:
+            return prefix, None
+        return prefix, "pkcs11:{0}{1}".format(prefix, self._query)
+
+    def gen_uris(self, data: dict) -> Iterator[tuple[dict, str]]:
+        # each level extends the path of its parent, mechanisms and key
+        # attributes are never visited
+        library_prefix, uri = self.__make_uri(
+            "", self.__get_path("info", data, _library_attributes)
+        )
+        if uri is not None:
+            yield data, uri
+        for slot in data.get("slots", []):
+            slot_prefix, uri = self.__make_uri(
+                library_prefix,
+                self.__get_path("slots", slot, _slot_attributes),
+            )
+            if uri is not None:
+                yield slot, uri
+            token = slot.get("token", None)
+            if token is None:
+                continue
+            token_prefix, uri = self.__make_uri(
+                slot_prefix,
+                self.__get_path("token", token, _token_attributes),
+            )
+            if uri is not None:
+                yield token, uri
+            for obj_list in _object_lists:
+                for obj in token.get(obj_list, []):
+                    _, uri = self.__make_uri(
+                        token_prefix,
+                        self.__get_path("object", obj, _object_attributes),
+                    )
+                    if uri is not None:
+                        yield obj, uri
+
+    def add_uris(self, data: dict):
+        for node, uri in self.gen_uris(data):
+            node["uri"] = uri
+
+    def get_uri(self, data: dict, node: dict) -> str | None:
+        hit = self.__lookup(data, node)
+        if hit is None and self._uri_data is data:
+            # the node may have been added after the URIs were built
+            self.invalidate()
+            hit = self.__lookup(data, node)
+        return hit
+
+    def invalidate(self):
+        # call after changing the scan data URIs were looked up in
+        self._uri_data = None
+        self._uris = {}
+
+    def __lookup(self, data: dict, node: dict) -> str | None:
+        if self._uri_data is not data:
+            self._uris = {id(n): (n, uri) for n, uri in self.gen_uris(data)}
+            self._uri_data = data
+        hit = self._uris.get(id(node), None)
+        if hit is None or hit[0] is not node:
+            return None
+        return hit[1]
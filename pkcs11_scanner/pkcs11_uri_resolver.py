@@ -0,0 +1,220 @@
+from threading import Lock
+
+from .pkcs11_base_scanner import PKCS11BaseScanner
+from .pkcs11_scan_stream import PKCS11ScanItem, PKCS11ScanItemType
+from .pkcs11_uri import (
+    PKCS11URI,
+    PKCS11_object_uri_attributes,
+    get_library_uri_attributes,
+    get_object_uri_attributes,
+    get_slot_uri_attributes,
+    get_token_uri_attributes,
+)
+
+
+class PKCS11URIMatch(object):
+    def __init__(self, slot_id: int, token: dict, obj: dict | None = None):
+        self._slot_id = slot_id
+        self._token = token
+        self._object = obj
+
+    def get_slot_id(self) -> int:
+        return self._slot_id
+
+    def get_token(self) -> dict:
+        return self._token
+
+    def get_object(self) -> dict | None:
+        return self._object
+
+    def __str__(self):
+        ret = "Slot {0} token {1}".format(
+            self._slot_id, self._token.get("label", None)
+        )
+        if self._object is not None:
+            ret = "{0} object {1}".format(ret, self._object.get("label", None))
+        return ret
+
+
+class _IndexedObject(object):
+    def __init__(self, match: PKCS11URIMatch, attributes: dict):
+        self.match = match
+        self.attributes = attributes
+
+
+class PKCS11URIResolver(object):
+    def __init__(self, scanner: PKCS11BaseScanner, pin: str | None = None):
+        self._scanner = scanner
+        self._pin = pin
+        self._lock = Lock()
+        self._library: dict = {}
+        self._slots: dict[int, dict] = {}
+        self._tokens: dict[int, dict] = {}
+        self._objects: dict[int, dict[tuple, _IndexedObject]] = {}
+        self._by_id: dict[bytes, list[_IndexedObject]] | None = None
+        self._by_label: dict[str, list[_IndexedObject]] | None = None
+        self._resolved: dict[str, list[PKCS11URIMatch]] = {}
+        self._hits = 0
+        self._misses = 0
+        self._fallbacks = 0
+
+    async def refresh(self):
+        with self._lock:
+            self._slots.clear()
+            self._tokens.clear()
+            self._objects.clear()
+            self.__invalidate()
+        async for item in self._scanner.gen_scan(self._pin):
+            self.add_item(item)
+
+    def __invalidate(self):
+        self._by_id = None
+        self._by_label = None
+        self._resolved.clear()
+
+    def add_item(self, item: PKCS11ScanItem):
+        tp = item.get_type()
+        slot_id = item.get_slot_id()
+        with self._lock:
+            if tp == PKCS11ScanItemType.library:
+                self._library = get_library_uri_attributes(item.get_data())
+            elif slot_id is None:
+                return
+            elif tp == PKCS11ScanItemType.slot:
+                self._slots[slot_id] = get_slot_uri_attributes(item.get_data())
+            elif tp == PKCS11ScanItemType.token:
+                token = item.get_data()
+                previous = self._tokens.get(slot_id, None)
+                if previous is None or get_token_uri_attributes(
+                    previous
+                ) != get_token_uri_attributes(token):
+                    # objects of a replaced token are gone
+                    self._objects.pop(slot_id, None)
+                self._tokens[slot_id] = token
+            elif tp == PKCS11ScanItemType.object:
+                owner = self._tokens.get(slot_id, None)
+                if owner is None:
+                    return
+                obj = item.get_data()
+                attributes = self.__get_token_attributes(slot_id)
+                attributes.update(get_object_uri_attributes(obj))
+                key = (
+                    attributes.get("type", None),
+                    attributes.get("id", None),
+                    attributes.get("object", None),
+                )
+                self._objects.setdefault(slot_id, {})[key] = _IndexedObject(
+                    PKCS11URIMatch(slot_id, owner, obj), attributes
+                )
+            else:
+                return
+            self.__invalidate()
+
+    def remove_slot(self, slot_id: int):
+        with self._lock:
+            self._slots.pop(slot_id, None)
+            self._tokens.pop(slot_id, None)
+            self._objects.pop(slot_id, None)
+            self.__invalidate()
+
+    def __get_token_attributes(self, slot_id: int) -> dict:
+        ret = dict(self._library)
+        ret.update(self._slots.get(slot_id, {}))
+        ret.update(get_token_uri_attributes(self._tokens.get(slot_id, {})))
+        return ret
+
+    def __get_indexes(
+        self,
+    ) -> tuple[
+        dict[bytes, list[_IndexedObject]], dict[str, list[_IndexedObject]]
+    ]:
+        if self._by_id is not None and self._by_label is not None:
+            return self._by_id, self._by_label
+        by_id: dict[bytes, list[_IndexedObject]] = {}
+        by_label: dict[str, list[_IndexedObject]] = {}
+        for objects in self._objects.values():
+            for indexed in objects.values():
+                key_id = indexed.attributes.get("id", None)
+                if key_id is not None:
+                    by_id.setdefault(key_id, []).append(indexed)
+                label = indexed.attributes.get("object", None)
+                if label is not None:
+                    by_label.setdefault(label, []).append(indexed)
+        self._by_id = by_id
+        self._by_label = by_label
+        return by_id, by_label
+
+    def __find(self, uri: PKCS11URI) -> list[PKCS11URIMatch]:
+        if not uri.has_object_attributes():
+            return [
+                PKCS11URIMatch(slot_id, token)
+                for slot_id, token in self._tokens.items()
+                if uri.matches(self.__get_token_attributes(slot_id))
+            ]
+        by_id, by_label = self.__get_indexes()
+        key_id = uri.get("id")
+        label = uri.get("object")
+        if isinstance(key_id, bytes):
+            candidates = by_id.get(key_id, [])
+        elif isinstance(label, str):
+            candidates = by_label.get(label, [])
+        else:
+            candidates = [
+                indexed
+                for objects in self._objects.values()
+                for indexed in objects.values()
+            ]
+        return [c.match for c in candidates if uri.matches(c.attributes)]
+
+    def lookup(self, uri: str) -> list[PKCS11URIMatch]:
+        with self._lock:
+            ret = self._resolved.get(uri, None)
+            if ret is not None:
+                self._hits += 1
+                return ret
+            ret = self.__find(PKCS11URI.from_string(uri))
+            if len(ret) > 0:
+                self._hits += 1
+                self._resolved[uri] = ret
+            else:
+                self._misses += 1
+            return ret
+
+    async def resolve(self, uri: str) -> list[PKCS11URIMatch]:
+        ret = self.lookup(uri)
+        if len(ret) > 0:
+            return ret
+        parsed = PKCS11URI.from_string(uri)
+        with self._lock:
+            self._fallbacks += 1
+            slots = [
+                slot_id
+                for slot_id in self._tokens
+                if parsed.matches(
+                    self.__get_token_attributes(slot_id),
+                    PKCS11_object_uri_attributes,
+                )
+            ]
+        if len(slots) == 0:
+            # token was not part of the scan, it may have been inserted since
+            library = self._scanner.get_library()
+            slots = library.getSlotList(tokenPresent=True)
+        async for item in self._scanner.gen_slots(
+            slots, self._pin, parsed.to_query()
+        ):
+            self.add_item(item)
+        with self._lock:
+            ret = self.__find(parsed)
+            if len(ret) > 0:
+                self._resolved[uri] = ret
+            return ret
+
+    def get_statistics(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "fallbacks": self._fallbacks,
+                "tokens": len(self._tokens),
+                "objects": sum(len(o) for o in self._objects.values()),
+            }
@@ -0,0 +1,434 @@
+from argparse import ArgumentParser
+from asyncio import run as async_run
+from datetime import datetime, timedelta
+from itertools import product
+from json import dumps
+from multiprocessing import get_context
+from os import environ
+from os.path import join
+from platform import python_version
+from queue import Empty, Queue
+from statistics import median
+from subprocess import DEVNULL, check_output
+from sys import stdout
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from tracemalloc import get_traced_memory
+from tracemalloc import start as tracemalloc_start
+from tracemalloc import stop as tracemalloc_stop
+
+_pkcs11lib = environ.get(
+    "PKCS11_TEST_MODULE", "/usr/lib/softhsm/libsofthsm2.so"
+)
+_so_pin = "123456"
+_user_pin = "1234"
+# how often a running configuration is checked for having died
+_result_seconds = 5
+# DER encoded OID of the P-256 curve
+_ec_params = bytes.fromhex("06082a8648ce3d030107")
+
+
+def _make_certificate():
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name(
+        [x509.NameAttribute(NameOID.COMMON_NAME, "Benchmark User")]
+    )
+    now = datetime.now()
+    builder = x509.CertificateBuilder()
+    builder = builder.subject_name(name).issuer_name(name)
+    builder = builder.public_key(key.public_key())
+    builder = builder.serial_number(x509.random_serial_number())
+    builder = builder.not_valid_before(now - timedelta(1))
+    builder = builder.not_valid_after(now + timedelta(30))
+    builder = builder.add_extension(
+        x509.KeyUsage(
+            digital_signature=True,
+            content_commitment=False,
+            key_encipherment=False,
+            data_encipherment=False,
+            key_agreement=False,
+            key_cert_sign=False,
+            crl_sign=False,
+            encipher_only=False,
+            decipher_only=False,
+        ),
+        critical=True,
+    )
+    certificate = builder.sign(key, hashes.SHA256())
+    return (
+        certificate.public_bytes(serialization.Encoding.DER),
+        certificate.subject.public_bytes(),
+    )
+
+
+def _populate(slots: int, objects: int, certificates: int):
+    from PyKCS11 import (
+        CKA_CERTIFICATE_TYPE,
+        CKA_CLASS,
+        CKA_EC_PARAMS,
+        CKA_ID,
+        CKA_KEY_TYPE,
+        CKA_LABEL,
+        CKA_PRIVATE,
+        CKA_SENSITIVE,
+        CKA_SIGN,
+        CKA_SUBJECT,
+        CKA_TOKEN,
+        CKA_VALUE,
+        CKA_VERIFY,
+        CKC_X_509,
+        CKF_RW_SESSION,
+        CKF_SERIAL_SESSION,
+        CKF_TOKEN_INITIALIZED,
+        CKK_EC,
+        CKM_EC_KEY_PAIR_GEN,
+        CKO_CERTIFICATE,
+        CKO_PRIVATE_KEY,
+        CKO_PUBLIC_KEY,
+        CKU_SO,
+        Mechanism,
+        PyKCS11Lib,
+    )
+
+    cert_der, subject_der = _make_certificate()
+    library = PyKCS11Lib()
+    library.load(_pkcs11lib)
+    for i in range(slots):
+        # SoftHSM adds a fresh uninitialized slot after each initialization
+        sl = [
+            s
+            for s in library.getSlotList(tokenPresent=True)
+            if library.getTokenInfo(s).flags & CKF_TOKEN_INITIALIZED == 0
+        ][0]
+        label = "Bench token {0}".format(i)
+        library.initToken(sl, _so_pin, label)
+        sl = [
+            s
+            for s in library.getSlotList(tokenPresent=True)
+            if library.getTokenInfo(s).label.strip() == label
+        ][0]
+        session = library.openSession(sl, CKF_SERIAL_SESSION | CKF_RW_SESSION)
+        session.login(_so_pin, CKU_SO)
+        session.initPin(_user_pin)
+        session.logout()
+        session.login(_user_pin)
+        for k in range(max(objects // 2, 0)):
+            key_id = "key {0}".format(k).encode()
+            key_label = "Key {0}".format(k)
+            session.generateKeyPair(
+                [
+                    (CKA_CLASS, CKO_PUBLIC_KEY),
+                    (CKA_TOKEN, True),
+                    (CKA_KEY_TYPE, CKK_EC),
+                    (CKA_EC_PARAMS, _ec_params),
+                    (CKA_VERIFY, True),
+                    (CKA_LABEL, key_label),
+                    (CKA_ID, key_id),
+                ],
+                [
+                    (CKA_CLASS, CKO_PRIVATE_KEY),
+                    (CKA_TOKEN, True),
+                    (CKA_PRIVATE, True),
+                    (CKA_SENSITIVE, True),
+                    (CKA_SIGN, True),
+                    (CKA_LABEL, key_label),
+                    (CKA_ID, key_id),
+                ],
+                Mechanism(CKM_EC_KEY_PAIR_GEN),
+            )
+        for c in range(certificates):
+            session.createObject(
+                [
+                    (CKA_CLASS, CKO_CERTIFICATE),
+                    (CKA_CERTIFICATE_TYPE, CKC_X_509),
+                    (CKA_TOKEN, True),
+                    (CKA_LABEL, "Key {0}".format(c)),
+                    (CKA_ID, "key {0}".format(c).encode()),
+                    (CKA_SUBJECT, subject_der),
+                    (CKA_VALUE, cert_der),
+                ]
+            )
+        session.logout()
+        session.closeSession()
+
+
+def _get_scanners(library):
+    from pkcs11_scanner.pkcs11_card_scanner import PKCS11CardScanner
+    from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+    from pkcs11_scanner.pkcs11_scanner_uri import PKCS11ScannerURI
+    from pkcs11_scanner.pkcs11_X509_scanner import PKCS11X506Scanner
+
+    return {
+        "PKCS11Scanner": PKCS11Scanner(library),
+        "PKCS11Scanner single session": PKCS11Scanner(
+            library, single_session=True
+        ),
+        "PKCS11ScannerURI": PKCS11ScannerURI(library),
+        "PKCS11CardScanner": PKCS11CardScanner(library),
+        "PKCS11X506Scanner": PKCS11X506Scanner(library),
+    }
+
+
+def _get_check_threads():
+    from pkcs11_scanner.pkcs11_check_card_scan_thread import (
+        PKCS11CheckCardScanThread,
+    )
+    from pkcs11_scanner.pkcs11_check_n_scan_thread import (
+        PKCS11ChecknScanThread,
+    )
+    from pkcs11_scanner.pkcs11_check_n_scan_w_uri_thread import (
+        PKCS11ChecknScanwURIThread,
+    )
+    from pkcs11_scanner.pkcs11_check_X509_scan_thread import (
+        PKCS11CheckX509ScanThread,
+    )
+
+    return {
+        "PKCS11ChecknScanThread": lambda q: PKCS11ChecknScanThread(
+            _pkcs11lib, q
+        ),
+        "PKCS11ChecknScanwURIThread": lambda q: PKCS11ChecknScanwURIThread(
+            _pkcs11lib, q
+        ),
+        "PKCS11CheckCardScanThread": lambda q: PKCS11CheckCardScanThread(
+            _pkcs11lib, q
+        ),
+        "PKCS11CheckX509ScanThread": lambda q: PKCS11CheckX509ScanThread(
+            _pkcs11lib, None, q
+        ),
+    }
+
+
+def _measure(repeat: int, func) -> tuple[list[float], int]:
+    times = []
+    tracemalloc_start()
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    peak = get_traced_memory()[1]
+    tracemalloc_stop()
+    return times, peak
+
+
+def _result(target: str, times: list[float], statistics, peak: int):
+    functions = statistics.get_summary()["functions"]
+    return {
+        "target": target,
+        "wall_seconds": {
+            "min": min(times),
+            "median": median(times),
+            "max": max(times),
+        },
+        "calls": {
+            k: v["calls"] // len(times) for k, v in sorted(functions.items())
+        },
+        "call_seconds": {
+            k: v["seconds"] / len(times) for k, v in sorted(functions.items())
+        },
+        "peak_memory": peak,
+    }
+
+
+def _bench_scanners(repeat: int) -> list[dict]:
+    from PyKCS11 import PyKCS11Lib
+
+    from pkcs11_scanner.pkcs11_instrumentation import (
+        PKCS11CallStatistics,
+        instrument_library,
+    )
+
+    ret = []
+    library = PyKCS11Lib()
+    library.load(_pkcs11lib)
+    statistics = PKCS11CallStatistics()
+    counting = instrument_library(library, statistics)
+    for target, scanner in _get_scanners(counting).items():
+        try:
+            async_run(scanner.scan_from_library(_user_pin))
+            statistics.clear()
+            times, peak = _measure(
+                repeat,
+                lambda: async_run(scanner.scan_from_library(_user_pin)),
+            )
+            ret.append(_result(target, times, statistics, peak))
+        except Exception as ex:
+            ret.append({"target": target, "error": str(ex)})
+    return ret
+
+
+class _SlotEventLibrary(object):
+    # SoftHSM has no slot events, this one reports one for the slot on
+    # every check
+    def __init__(self, library, slot: int):
+        self._library = library
+        self._slot = slot
+
+    def waitForSlotEvent(self, flags=0):
+        return self._slot
+
+    def __getattr__(self, name: str):
+        return getattr(self._library, name)
+
+
+def _bench_check_threads(repeat: int) -> list[dict]:
+    from PyKCS11 import PyKCS11Lib
+
+    from pkcs11_scanner.pkcs11_check_error import PKCS11CheckError
+    from pkcs11_scanner.pkcs11_instrumentation import (
+        PKCS11CallStatistics,
+        instrument_library,
+    )
+
+    ret = []
+    library = PyKCS11Lib()
+    library.load(_pkcs11lib)
+    statistics = PKCS11CallStatistics()
+    counting = instrument_library(library, statistics)
+    slot = library.getSlotList(tokenPresent=True)[0]
+    for (target, factory), incremental in product(
+        _get_check_threads().items(), [False, True]
+    ):
+        queue: Queue = Queue()
+        thread = factory(queue)
+        if incremental:
+            target = "{0} incremental".format(target)
+            thread.set_incremental_scan()
+        monitor = thread.get_monitor()
+        monitor.set_library_loader(
+            lambda library_path: _SlotEventLibrary(counting, slot)
+        )
+        # no sleep to speak of after an event
+        monitor.set_adaptive_polling(1e-6, 1e-6)
+
+        async def step():
+            await monitor.open()
+            try:
+                await monitor.step()
+            finally:
+                monitor.close()
+
+        def event():
+            async_run(step())
+            while not queue.empty():
+                item = queue.get_nowait()
+                if isinstance(item, PKCS11CheckError):
+                    raise item
+
+        try:
+            # event to queue latency, from slot event to scan on the queue
+            event()
+            statistics.clear()
+            times, peak = _measure(repeat, event)
+            ret.append(_result(target, times, statistics, peak))
+        except Exception as ex:
+            ret.append({"target": target, "error": str(ex)})
+    return ret
+
+
+def _run_configuration(conf: dict, results):
+    try:
+        with TemporaryDirectory() as token_dir:
+            conf_file = join(token_dir, "softhsm2.conf")
+            with open(conf_file, "w") as f:
+                f.write("directories.tokendir = {0}\n".format(token_dir))
+                f.write("objectstore.backend = file\n")
+            environ["SOFTHSM2_CONF"] = conf_file
+            start = perf_counter()
+            _populate(conf["slots"], conf["objects"], conf["certificates"])
+            populate_seconds = perf_counter() - start
+            rez = _bench_scanners(conf["repeat"])
+            rez.extend(_bench_check_threads(conf["repeat"]))
+            for r in rez:
+                r.update(conf)
+                r["populate_seconds"] = populate_seconds
+                results.put(r)
+    except Exception as ex:
+        results.put(dict(conf, error=str(ex)))
+    results.put(None)
+
+
+def _get_commit() -> str | None:
+    try:
+        return (
+            check_output(["git", "rev-parse", "HEAD"], stderr=DEVNULL)
+            .decode()
+            .strip()
+        )
+    except Exception:
+        return None
+
+
+def _write_result(out, r: dict, commit: str | None):
+    r["commit"] = commit
+    r["python"] = python_version()
+    out.write(dumps(r) + "\n")
+    out.flush()
+
+
+def main(argv: list[str] | None = None):
+    parser = ArgumentParser(
+        description="Benchmark PKCS11 scanners and check threads on SoftHSM."
+    )
+    parser.add_argument("--slots", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--objects", type=int, nargs="+", default=[10, 100])
+    parser.add_argument(
+        "--certificates",
+        type=int,
+        default=None,
+        help="certificates per token, default is half of the objects",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    commit = _get_commit()
+    out = open(args.output, "a") if args.output is not None else stdout
+    ctx = get_context("spawn")
+    try:
+        for slots, objects in product(args.slots, args.objects):
+            conf = {
+                "slots": slots,
+                "objects": objects,
+                "certificates": (
+                    args.certificates
+                    if args.certificates is not None
+                    else objects // 2
+                ),
+                "repeat": args.repeat,
+            }
+            # each configuration gets its own process and SoftHSM token store
+            results = ctx.Queue()
+            proc = ctx.Process(target=_run_configuration, args=(conf, results))
+            proc.start()
+            while True:
+                try:
+                    r = results.get(timeout=_result_seconds)
+                except Empty:
+                    if proc.is_alive():
+                        continue
+                    # crashed or killed before it sent its end
+                    r = dict(
+                        conf,
+                        error="Benchmark process exited with code {0}".format(
+                            proc.exitcode
+                        ),
+                    )
+                    _write_result(out, r, commit)
+                    break
+                if r is None:
+                    break
+                _write_result(out, r, commit)
+            proc.join()
+    finally:
+        if out is not stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
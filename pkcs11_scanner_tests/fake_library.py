@@ -0,0 +1,262 @@
+from collections import Counter
+from os import environ, getpid
+from threading import Condition, Event
+
+from PyKCS11 import (
+    CK_INFO,
+    CK_MECHANISM_INFO,
+    CK_SLOT_INFO,
+    CK_TOKEN_INFO,
+    CKA_CLASS,
+    CKA_DECRYPT,
+    CKA_DERIVE,
+    CKA_ENCRYPT,
+    CKA_ID,
+    CKA_KEY_TYPE,
+    CKA_LABEL,
+    CKA_SIGN,
+    CKA_SIGN_RECOVER,
+    CKA_UNWRAP,
+    CKA_VERIFY,
+    CKA_VERIFY_RECOVER,
+    CKA_WRAP,
+    CKF_DONT_BLOCK,
+    CKF_LOGIN_REQUIRED,
+    CKF_REMOVABLE_DEVICE,
+    CKF_SIGN,
+    CKF_TOKEN_INITIALIZED,
+    CKF_TOKEN_PRESENT,
+    CKF_USER_PIN_INITIALIZED,
+    CKF_VERIFY,
+    CKK_RSA,
+    CKO_PRIVATE_KEY,
+    CKO_PUBLIC_KEY,
+    CKR_FUNCTION_NOT_SUPPORTED,
+    CKR_NO_EVENT,
+    CKR_SESSION_HANDLE_INVALID,
+    CKR_TOKEN_NOT_PRESENT,
+    PyKCS11Error,
+)
+
+
+def _make_objects(slot: int, keys: int) -> list[dict]:
+    ret = []
+    for k in range(keys):
+        key_id = bytes([slot, k])
+        ret.append(
+            {
+                CKA_CLASS: CKO_PRIVATE_KEY,
+                CKA_LABEL: "key {0}".format(k),
+                CKA_ID: key_id,
+                CKA_KEY_TYPE: CKK_RSA,
+                CKA_DECRYPT: True,
+                CKA_SIGN: True,
+                CKA_UNWRAP: False,
+                CKA_DERIVE: False,
+                CKA_SIGN_RECOVER: False,
+            }
+        )
+        ret.append(
+            {
+                CKA_CLASS: CKO_PUBLIC_KEY,
+                CKA_LABEL: "key {0}".format(k),
+                CKA_ID: key_id,
+                CKA_KEY_TYPE: CKK_RSA,
+                CKA_ENCRYPT: True,
+                CKA_VERIFY: True,
+                CKA_WRAP: False,
+                CKA_VERIFY_RECOVER: False,
+            }
+        )
+    return ret
+
+
+class FakeSession(object):
+    def __init__(self, library: "FakeLibrary", slot: int):
+        self._library = library
+        self._slot = slot
+
+    def login(self, pin, user_type=None):
+        self._library.count("C_Login", self._slot)
+
+    def logout(self):
+        self._library.count("C_Logout", self._slot)
+
+    def getSessionInfo(self):
+        self._library.count("C_GetSessionInfo", self._slot)
+        if self._slot not in self._library.tokens:
+            raise PyKCS11Error(CKR_SESSION_HANDLE_INVALID)
+
+    def closeSession(self):
+        self._library.count("C_CloseSession", self._slot)
+        self._library.sessions -= 1
+
+    def findObjects(self, template=()):
+        self._library.count("C_FindObjects", self._slot)
+        self._library.hang_if("C_FindObjects", self._slot)
+        match = {
+            k: v
+            for k, v in template
+            if k not in self._library.ignored_attributes
+        }
+        return [
+            handle
+            for handle, obj in enumerate(self._library.tokens[self._slot])
+            if all(obj.get(k) == v for k, v in match.items())
+        ]
+
+    def getAttributeValue(self, handle, attrs, allAsBinary=False):
+        self._library.count("C_GetAttributeValue", self._slot)
+        obj = self._library.tokens[self._slot][handle]
+        return [obj.get(attr, None) for attr in attrs]
+
+
+class FakeLibrary(object):
+    # a module without hardware, tokens can be inserted and removed, and
+    # any call can be made to hang
+    def __init__(self, slots: int = 2, keys: int = 1, blocking: bool = True):
+        self.pkcs11dll_filename = "fake-pkcs11.so"
+        self.slots = slots
+        self.keys = keys
+        self.blocking = blocking
+        self.block_seconds = 0.05
+        self.tokens: dict[int, list[dict]] = {
+            slot: _make_objects(slot, keys) for slot in range(slots)
+        }
+        self.calls: Counter = Counter()
+        self.slot_calls: Counter = Counter()
+        self.sessions = 0
+        self.events: list[int | None] = []
+        self.hangs: set[str] = set()
+        # attributes C_FindObjects leaves out of the match, as some modules do
+        self.ignored_attributes: set[int] = set()
+        self.hang_slots: set[int | None] = set()
+        self.release = Event()
+        self._events_ready = Condition()
+
+    def count(self, function: str, slot: int | None = None):
+        self.calls[function] += 1
+        if slot is not None:
+            self.slot_calls[(function, slot)] += 1
+
+    def hang_if(self, function: str, slot: int | None = None):
+        if function in self.hangs and (
+            len(self.hang_slots) == 0 or slot in self.hang_slots
+        ):
+            self.release.wait(30)
+
+    def add_event(self, slot: int | None):
+        # None stands for a poll without an event
+        with self._events_ready:
+            self.events.append(slot)
+            self._events_ready.notify_all()
+
+    def insert_token(self, slot: int):
+        self.tokens[slot] = _make_objects(slot, self.keys)
+        self.add_event(slot)
+
+    def remove_token(self, slot: int):
+        del self.tokens[slot]
+        self.add_event(slot)
+
+    def getInfo(self):
+        self.count("C_GetInfo")
+        info = CK_INFO()
+        info.cryptokiVersion = (2, 40)
+        info.manufacturerID = "Fake"
+        info.flags = 0
+        info.libraryDescription = "Fake library"
+        info.libraryVersion = (1, 0)
+        return info
+
+    def getSlotList(self, tokenPresent=False):
+        self.count("C_GetSlotList")
+        self.hang_if("C_GetSlotList")
+        if tokenPresent:
+            return sorted(self.tokens)
+        return list(range(self.slots))
+
+    def getSlotInfo(self, slot):
+        self.count("C_GetSlotInfo", slot)
+        self.hang_if("C_GetSlotInfo", slot)
+        info = CK_SLOT_INFO()
+        info.slotDescription = "Slot {0}".format(slot)
+        info.manufacturerID = "Fake"
+        info.flags = CKF_REMOVABLE_DEVICE
+        if slot in self.tokens:
+            info.flags |= CKF_TOKEN_PRESENT
+        info.hardwareVersion = (1, 0)
+        info.firmwareVersion = (1, 0)
+        return info
+
+    def getTokenInfo(self, slot):
+        self.count("C_GetTokenInfo", slot)
+        self.hang_if("C_GetTokenInfo", slot)
+        if slot not in self.tokens:
+            raise PyKCS11Error(CKR_TOKEN_NOT_PRESENT)
+        info = CK_TOKEN_INFO()
+        for field in info.fields:
+            setattr(info, field, 0)
+        info.label = "Token {0}".format(slot)
+        info.manufacturerID = "Fake"
+        info.model = "Model"
+        info.serialNumber = "SN{0}".format(slot)
+        info.flags = (
+            CKF_TOKEN_INITIALIZED
+            | CKF_LOGIN_REQUIRED
+            | CKF_USER_PIN_INITIALIZED
+        )
+        # volatile fields change on every call
+        info.ulSessionCount = self.sessions
+        info.ulFreePublicMemory = self.calls["C_GetTokenInfo"]
+        info.hardwareVersion = (1, 0)
+        info.firmwareVersion = (1, 0)
+        info.utcTime = ""
+        return info
+
+    def openSession(self, slot, flags=0):
+        self.count("C_OpenSession", slot)
+        self.sessions += 1
+        return FakeSession(self, slot)
+
+    def closeAllSessions(self, slot):
+        self.count("C_CloseAllSessions", slot)
+
+    def getMechanismList(self, slot):
+        self.count("C_GetMechanismList", slot)
+        return ["CKM_RSA_PKCS"]
+
+    def getMechanismInfo(self, slot, mechanism):
+        self.count("C_GetMechanismInfo", slot)
+        info = CK_MECHANISM_INFO()
+        info.ulMinKeySize = 1024
+        info.ulMaxKeySize = 4096
+        info.flags = CKF_SIGN | CKF_VERIFY
+        return info
+
+    def waitForSlotEvent(self, flags=0):
+        self.count("C_WaitForSlotEvent")
+        self.hang_if("C_WaitForSlotEvent")
+        with self._events_ready:
+            if not flags & CKF_DONT_BLOCK:
+                if not self.blocking:
+                    raise PyKCS11Error(CKR_FUNCTION_NOT_SUPPORTED)
+                if len(self.events) == 0:
+                    self._events_ready.wait(self.block_seconds)
+            slot = self.events.pop(0) if len(self.events) > 0 else None
+        if slot is None:
+            raise PyKCS11Error(CKR_NO_EVENT)
+        return slot
+
+
+def fake_fleet_scanner(library_path: str):
+    # fleet scanner factory, runs in the worker process of a target
+    pid_file = environ.get("FAKE_PID_FILE", None)
+    if pid_file is not None:
+        with open(pid_file, "w") as f:
+            f.write(str(getpid()))
+    if library_path == "hang":
+        Event().wait()
+    from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+
+    return PKCS11Scanner(FakeLibrary(slots=1))
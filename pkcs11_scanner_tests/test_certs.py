@@ -143,6 +143,29 @@ class TestCertificates:
             tkn = ret.get_token_for_label(a)
             assert len(tkn["certificates"]) == 1
 
+    @mark.asyncio
+    async def test_lazy_X509_scan(self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        from pkcs11_scanner import PKCS11CertificateRecord
+        from pkcs11_scanner.pkcs11_X509_scanner import PKCS11X506Scanner
+
+        scanner = PKCS11X506Scanner.from_library_path(
+            _pkcs11lib, {"digital_signature": True}
+        )
+        data = await scanner.scan_from_library()
+        scanner.set_lazy_certificates()
+        lazy = await scanner.scan_from_library()
+        cert = lazy["slots"][0]["token"]["certificates"][0]
+        assert isinstance(cert, PKCS11CertificateRecord)
+        assert not cert.is_decoded()
+        assert lazy == data
+        scanner.set_lazy_certificates(False)
+        with ProcessPoolExecutor(2) as executor:
+            scanner.set_decode_executor(executor, 1)
+            assert await scanner.scan_from_library() == data
+        scanner.close()
+
     @mark.asyncio
     async def test_card_scan(self):
         from pkcs11_scanner import PKCS11Scan
@@ -166,3 +189,307 @@ class TestCertificates:
         for a in ret.get_token_labels():
             tkn = ret.get_token_for_label(a)
             assert len(tkn["certificates"]) == 1
+
+    @mark.asyncio
+    async def test_single_session_scan(self):
+        from pkcs11_scanner import PKCS11Scan
+        from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+
+        scanner = PKCS11Scanner.from_library_path(
+            _pkcs11lib, single_session=True
+        )
+        data = await scanner.scan_from_library("1234")
+        ret = PKCS11Scan(data)
+        stats = scanner.get_session_statistics()
+        assert stats["sessions"] == len(data["slots"])
+        assert stats["logins"] <= stats["sessions"]
+        for a in ret.get_token_labels():
+            tkn = ret.get_token_for_label(a)
+            assert len(tkn["certificates"]) == 1
+            assert len(tkn["private keys"]) == 1
+
+    @mark.asyncio
+    async def test_key_attributes_scan(self):
+        from pkcs11_cryptography_keys import KeyTypes, OperationTypes
+
+        from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+
+        scanner = PKCS11Scanner.from_library_path(
+            _pkcs11lib, single_session=True
+        )
+        data = await scanner.scan_from_library("1234")
+        for slot in data["slots"]:
+            for key in slot["token"]["private keys"]:
+                assert key["id"] == b"254"
+                assert key["key_type"] == KeyTypes.RSA
+                assert key["key_usage"].get(OperationTypes.SIGN)
+            for cert in slot["token"]["certificates"]:
+                assert "key_usage" not in cert
+
+    @mark.asyncio
+    async def test_concurrent_card_scan(self):
+        from pkcs11_scanner.pkcs11_card_scanner import PKCS11CardScanner
+
+        scanner = PKCS11CardScanner.from_library_path(_pkcs11lib)
+        data = await scanner.scan_from_library()
+        scanner = PKCS11CardScanner.from_library_path(_pkcs11lib, 4)
+        c_data = await scanner.scan_from_library()
+        assert [s["token"]["serialNumber"] for s in data["slots"]] == [
+            s["token"]["serialNumber"] for s in c_data["slots"]
+        ]
+        for slot in c_data["slots"]:
+            assert len(slot["token"]["certificates"]) == 1
+
+    @mark.asyncio
+    async def test_mechanism_cache(self):
+        from pkcs11_scanner.pkcs11_base_scanner import PKCS11BaseScanner
+        from pkcs11_scanner.pkcs11_mechanism_cache import PKCS11MechanismCache
+        from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+
+        cache = PKCS11MechanismCache()
+        PKCS11BaseScanner.set_mechanism_cache(cache)
+        try:
+            scanner = PKCS11Scanner.from_library_path(_pkcs11lib)
+            data = await scanner.scan_from_library()
+            c_data = await scanner.scan_from_library()
+        finally:
+            PKCS11BaseScanner.set_mechanism_cache(None)
+        stats = cache.get_statistics()
+        assert stats["size"] == 1
+        assert stats["misses"] == 1
+        assert stats["hits"] == 2 * len(data["slots"]) - 1
+        assert (
+            data["slots"][0]["token"]["mechanisms"]
+            == c_data["slots"][0]["token"]["mechanisms"]
+        )
+
+    @mark.asyncio
+    async def test_call_statistics(self):
+        from pkcs11_scanner import PKCS11CallStatistics
+        from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+
+        calls = []
+        statistics = PKCS11CallStatistics(
+            hook=lambda function, slot, seconds, error: calls.append(function)
+        )
+        scanner = PKCS11Scanner.from_library_path(_pkcs11lib)
+        scanner.set_call_statistics(statistics)
+        data = await scanner.scan_from_library("1234")
+        summary = statistics.get_summary()
+        assert summary["calls"] == len(calls)
+        assert summary["functions"]["C_Login"]["calls"] > 0
+        assert len(summary["slots"]) >= len(data["slots"])
+        rez = statistics.get_statistics()["functions"]["C_FindObjects"]
+        assert sum(rez["histogram"]) == rez["calls"]
+
+    @mark.asyncio
+    async def test_call_deadlines(self):
+        from pkcs11_scanner import PKCS11CallDeadlines, PKCS11SlotHealth
+        from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+
+        scanner = PKCS11Scanner.from_library_path(_pkcs11lib)
+        data = await scanner.scan_from_library("1234")
+        deadlines = PKCS11CallDeadlines(call_seconds=30, slot_seconds=120)
+        health = PKCS11SlotHealth()
+        scanner.set_call_deadlines(deadlines)
+        scanner.set_slot_health(health)
+        assert scanner.get_call_deadlines() is deadlines
+        assert await scanner.scan_from_library("1234") == data
+        assert health.get_degraded_slots() == {}
+        assert deadlines.get_statistics()["timed_out"] == 0
+        scanner.set_call_deadlines(None)
+        scanner.close()
+        deadlines.close()
+
+    @mark.asyncio
+    async def test_streaming_scan(self):
+        from pkcs11_scanner import PKCS11ScanItemType
+        from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+
+        scanner = PKCS11Scanner.from_library_path(_pkcs11lib)
+        items = [item async for item in scanner.gen_scan("1234")]
+        assert items[0].get_type() == PKCS11ScanItemType.library
+        objects = [
+            item
+            for item in items
+            if item.get_type() == PKCS11ScanItemType.object
+        ]
+        data = await scanner.scan_from_library("1234")
+        assert len(objects) == sum(
+            len(slot["token"][bucket])
+            for slot in data["slots"]
+            for bucket in ["private keys", "public keys", "certificates"]
+        )
+        streamed = []
+        c_data = await scanner.scan_from_library("1234", streamed.append)
+        assert len(streamed) == len(items)
+        assert len(c_data["slots"]) == len(data["slots"])
+
+    @mark.asyncio
+    async def test_targeted_query(self):
+        from pkcs11_cryptography_keys import KeyTypes
+
+        from pkcs11_scanner import PKCS11Query
+        from pkcs11_scanner.pkcs11_card_scanner import PKCS11CardScanner
+        from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+
+        scanner = PKCS11Scanner.from_library_path(_pkcs11lib)
+        data = await scanner.scan_from_library("1234")
+        serial = data["slots"][0]["token"]["serialNumber"]
+        query = PKCS11Query(
+            object_types=["private"],
+            key_id=b"254",
+            key_type=KeyTypes.RSA,
+            token_serial=serial,
+            with_mechanisms=False,
+        )
+        keys = await scanner.find(query, "1234")
+        assert len(keys) == 1
+        assert keys[0]["id"] == b"254"
+        assert keys[0]["type"] == "private"
+        assert len(await scanner.find(PKCS11Query(key_id=b"none"), "1234")) == 0
+        scanner = PKCS11CardScanner.from_library_path(_pkcs11lib)
+        q_data = await scanner.scan_from_library(
+            query=PKCS11Query(key_id=b"254", token_serial=serial)
+        )
+        assert len(q_data["slots"]) == 1
+        assert len(q_data["slots"][0]["token"]["certificates"]) == 1
+
+    @mark.asyncio
+    async def test_scan_cache(self, tmp_path):
+        from pkcs11_scanner import PKCS11ScanCache
+        from pkcs11_scanner.pkcs11_card_scanner import PKCS11CardScanner
+
+        cache_file = str(tmp_path / "scan.cache")
+        scanner = PKCS11CardScanner.from_library_path(_pkcs11lib)
+        scanner.set_scan_cache(PKCS11ScanCache(cache_file))
+        data = await scanner.scan_from_library()
+        cache = PKCS11ScanCache(cache_file, background_revalidation=True)
+        scanner = PKCS11CardScanner.from_library_path(_pkcs11lib)
+        scanner.set_scan_cache(cache)
+        c_data = await scanner.scan_from_library()
+        cache.wait_for_revalidation()
+        stats = cache.get_statistics()
+        assert stats["hits"] >= len(data["slots"])
+        assert stats["misses"] == 0
+        assert [s["token"]["serialNumber"] for s in data["slots"]] == [
+            s["token"]["serialNumber"] for s in c_data["slots"]
+        ]
+        for slot in c_data["slots"]:
+            assert len(slot["token"]["certificates"]) == 1
+
+    def test_library_monitor(self):
+        from queue import Queue
+        from time import sleep
+
+        from pkcs11_scanner import PKCS11LibraryMonitor
+
+        comm: Queue = Queue()
+        monitor = PKCS11LibraryMonitor([_pkcs11lib, "missing.so"], comm)
+        monitor.start()
+        try:
+            sleep(1)
+            assert monitor.get_health(_pkcs11lib)["state"] == "running"
+            assert monitor.get_health("missing.so")["state"] == "failed"
+        finally:
+            monitor.set_stop_event()
+            monitor.join()
+        assert monitor.get_health(_pkcs11lib)["state"] == "stopped"
+        event = comm.get_nowait()
+        assert event.get_library_path() == "missing.so"
+
+    @mark.asyncio
+    async def test_check_monitor(self):
+        from PyKCS11 import PyKCS11Lib
+
+        from pkcs11_scanner import (
+            PKCS11CheckMonitor,
+            PKCS11ErrorEvent,
+            PKCS11ScanEvent,
+            PKCS11SlotEvent,
+        )
+        from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+
+        library = PyKCS11Lib()
+        library.load(_pkcs11lib)
+        slot = library.getSlotList(tokenPresent=True)[0]
+        monitor = PKCS11CheckMonitor(_pkcs11lib, scanner_factory=PKCS11Scanner)
+        await monitor._on_slot_event(library, slot)
+        queue = monitor.get_queue()
+        assert isinstance(queue.get_nowait(), PKCS11SlotEvent)
+        event = queue.get_nowait()
+        assert isinstance(event, PKCS11ScanEvent)
+        assert event.get_scan().has_data()
+        # SoftHSM does not report slot events, polling reports errors
+        monitor.set_adaptive_polling(0.01, 0.05)
+        events = []
+        async for event in monitor:
+            events.append(event)
+            monitor.set_stop_event()
+        assert all(isinstance(e, PKCS11ErrorEvent) for e in events)
+
+    @mark.asyncio
+    async def test_uri_resolver(self):
+        from pkcs11_scanner import PKCS11URIResolver
+        from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+
+        scanner = PKCS11Scanner.from_library_path(_pkcs11lib)
+        resolver = PKCS11URIResolver(scanner, "1234")
+        await resolver.refresh()
+        data = await scanner.scan_from_library("1234")
+        token = data["slots"][0]["token"]
+        matches = resolver.lookup(token["uri"])
+        assert len(matches) == 1
+        assert matches[0].get_token()["serialNumber"] == token["serialNumber"]
+        key = token["private keys"][0]
+        matches = await resolver.resolve(key["uri"])
+        assert len(matches) == 1
+        obj = matches[0].get_object()
+        assert obj is not None and obj["id"] == key["id"]
+        assert len(await resolver.resolve(token["uri"] + ";id=%FF%FF")) == 0
+        statistics = resolver.get_statistics()
+        assert statistics["hits"] == 2
+        assert statistics["fallbacks"] == 1
+        scanner.close()
+
+    @mark.asyncio
+    async def test_fleet_scan(self):
+        from pkcs11_scanner import (
+            PKCS11CheckError,
+            PKCS11FleetScanner,
+            PKCS11Scan,
+        )
+
+        fleet = PKCS11FleetScanner(max_workers=2, timeout=60)
+        fleet.add_library(_pkcs11lib)
+        fleet.add_library("/nonexistent/libpkcs11.so")
+        events = await fleet.scan()
+        scan = events[0].get_event()
+        assert isinstance(scan, PKCS11Scan)
+        assert scan.get_library_path() == _pkcs11lib
+        for a in scan.get_token_labels():
+            tkn = scan.get_token_for_label(a)
+            assert len(tkn["certificates"]) == 1
+        assert isinstance(events[1].get_event(), PKCS11CheckError)
+        assert fleet.get_statistics()["failed"] == 1
+
+    @mark.asyncio
+    async def test_library_pool(self):
+        from pkcs11_scanner import PKCS11LibraryPool
+        from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+
+        pool = PKCS11LibraryPool(keep_login=True)
+        library = pool.acquire_library(_pkcs11lib)
+        assert pool.acquire_library(_pkcs11lib) is library
+        data = await PKCS11Scanner(library).scan_from_library("1234")
+        scanner = PKCS11Scanner(library)
+        scanner.set_library_pool(pool)
+        assert await scanner.scan_from_library("1234") == data
+        assert await scanner.scan_from_library("1234") == data
+        statistics = pool.get_statistics()
+        assert statistics["reused"] > 0
+        assert statistics["logins"] == len(data["slots"])
+        pool.invalidate(library)
+        assert pool.get_statistics()["idle"] == 0
+        pool.release_library(library)
+        pool.release_library(library)
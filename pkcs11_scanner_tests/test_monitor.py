@@ -0,0 +1,542 @@
+from asyncio import get_running_loop, sleep, wait_for
+from os import kill
+from os.path import exists
+from threading import Thread
+from threading import enumerate as enumerate_threads
+from time import monotonic
+from time import sleep as sleep_seconds
+
+from fake_library import FakeLibrary
+from pytest import approx, mark
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+def _use_library(monkeypatch, library: FakeLibrary):
+    monkeypatch.setattr(
+        "pkcs11_scanner.pkcs11_check_monitor._load_library",
+        lambda library_path: library,
+    )
+
+
+async def _wait_for(condition, timeout: float = 10):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await sleep(0.01)
+    raise AssertionError("Condition not met in {0} seconds".format(timeout))
+
+
+async def _settle(library: FakeLibrary):
+    # the poll after the last event only starts once the event is handled
+    await _wait_for(lambda: len(library.events) == 0)
+    polls = library.calls["C_WaitForSlotEvent"]
+    await _wait_for(lambda: library.calls["C_WaitForSlotEvent"] > polls)
+
+
+def _get_waiter() -> Thread | None:
+    for thread in enumerate_threads():
+        if thread.name == "PKCS11 slot event waiter":
+            return thread
+    return None
+
+
+def _get_slot_descriptions(sink: list) -> list[str]:
+    from pkcs11_cryptography_keys import SlotProperties
+
+    return [
+        dict(item.gen_tags())["slotDescription"]
+        for item in sink
+        if isinstance(item, SlotProperties)
+    ]
+
+
+def _is_killed(pid_file: str) -> bool:
+    with open(pid_file) as f:
+        pid = int(f.read())
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    return False
+
+
+def _get_changes(sink: list) -> list[tuple[int, str]]:
+    from pkcs11_scanner import PKCS11SlotChange
+
+    return [
+        (item.get_slot_id(), str(item.get_change_type()))
+        for item in sink
+        if isinstance(item, PKCS11SlotChange)
+    ]
+
+
+class TestMonitor:
+
+    @mark.asyncio
+    async def test_incremental_scan(self, monkeypatch):
+        from pkcs11_scanner import PKCS11CheckMonitor
+        from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+
+        library = FakeLibrary(slots=3)
+        _use_library(monkeypatch, library)
+        sink: list = []
+        monitor = PKCS11CheckMonitor("fake", 0.01, PKCS11Scanner)
+        monitor.set_sink(sink.append)
+        monitor.set_incremental_scan(send_delta=True)
+        task = get_running_loop().create_task(monitor.async_run())
+        try:
+            # the first event seeds the state of all slots
+            library.add_event(0)
+            await _settle(library)
+            assert _get_changes(sink) == [
+                (0, "added"),
+                (1, "added"),
+                (2, "added"),
+            ]
+            before = library.slot_calls.copy()
+            del sink[:]
+            # session counts and free memory differ, the token does not
+            library.add_event(1)
+            await _settle(library)
+            assert _get_changes(sink) == []
+            for slot in range(3):
+                rescans = (
+                    library.slot_calls[("C_FindObjects", slot)]
+                    - before[("C_FindObjects", slot)]
+                )
+                assert (rescans > 0) == (slot == 1)
+            library.remove_token(2)
+            await _settle(library)
+            library.insert_token(2)
+            await _settle(library)
+            assert _get_changes(sink) == [(2, "removed"), (2, "added")]
+        finally:
+            monitor.set_stop_event()
+            await wait_for(task, 10)
+
+    @mark.asyncio
+    async def test_blocking_wait_falls_back(self, monkeypatch):
+        from pkcs11_scanner import PKCS11CheckError, PKCS11CheckMonitor
+
+        library = FakeLibrary(slots=2, blocking=False)
+        _use_library(monkeypatch, library)
+        sink: list = []
+        monitor = PKCS11CheckMonitor("fake", 0.01)
+        monitor.set_sink(sink.append)
+        monitor.set_blocking_wait()
+        task = get_running_loop().create_task(monitor.async_run())
+        try:
+            await _wait_for(lambda: library.calls["C_WaitForSlotEvent"] > 0)
+            await _wait_for(lambda: _get_waiter() is None)
+            # the module refused to block, events are polled for
+            library.add_event(1)
+            await _settle(library)
+            assert _get_slot_descriptions(sink) == ["Slot 1"]
+            assert not any(isinstance(item, PKCS11CheckError) for item in sink)
+        finally:
+            monitor.set_stop_event()
+            await wait_for(task, 10)
+
+    @mark.asyncio
+    async def test_blocking_wait_stops(self, monkeypatch):
+        from pkcs11_scanner import PKCS11CheckMonitor
+
+        library = FakeLibrary(slots=1)
+        # the waiter blocks in the module until an event comes
+        library.block_seconds = 30
+        _use_library(monkeypatch, library)
+        monitor = PKCS11CheckMonitor("fake", 0.01)
+        monitor.set_sink(lambda item: None)
+        monitor.set_blocking_wait()
+        task = get_running_loop().create_task(monitor.async_run())
+        await _wait_for(lambda: library.calls["C_WaitForSlotEvent"] > 0)
+        waiter = _get_waiter()
+        assert waiter is not None
+        monitor.set_stop_event()
+        await wait_for(task, 1)
+        # the call in the module returns, the waiter does not wait again
+        library.add_event(None)
+        waiter.join(1)
+        assert not waiter.is_alive()
+        assert library.calls["C_WaitForSlotEvent"] == 1
+
+    @mark.asyncio
+    async def test_blocking_wait_events(self, monkeypatch):
+        from pkcs11_scanner import PKCS11CheckMonitor
+
+        library = FakeLibrary(slots=3)
+        _use_library(monkeypatch, library)
+        sink: list = []
+        monitor = PKCS11CheckMonitor("fake", 0.01)
+        monitor.set_sink(sink.append)
+        monitor.set_blocking_wait()
+        task = get_running_loop().create_task(monitor.async_run())
+        try:
+            await _wait_for(lambda: library.calls["C_WaitForSlotEvent"] > 0)
+            for slot in (0, 2, 1, 2):
+                library.add_event(slot)
+            await _settle(library)
+            # a few more waits, late duplicates would show up here
+            polls = library.calls["C_WaitForSlotEvent"]
+            await _wait_for(
+                lambda: library.calls["C_WaitForSlotEvent"] > polls + 2
+            )
+            assert _get_slot_descriptions(sink) == [
+                "Slot 0",
+                "Slot 2",
+                "Slot 1",
+                "Slot 2",
+            ]
+            assert monitor.get_statistics()["events"] == 4
+        finally:
+            monitor.set_stop_event()
+            await wait_for(task, 10)
+
+    @mark.asyncio
+    async def test_slot_events(self, monkeypatch):
+        from pkcs11_scanner import (
+            PKCS11CheckMonitor,
+            PKCS11CoalescingQueue,
+            PKCS11SlotEvent,
+        )
+
+        library = FakeLibrary(slots=3)
+        _use_library(monkeypatch, library)
+        comm = PKCS11CoalescingQueue()
+        monitor = PKCS11CheckMonitor("fake", 0.01)
+        monitor.set_sink(comm.put)
+        monitor.set_slot_events()
+        monitor.set_blocking_wait()
+        task = get_running_loop().create_task(monitor.async_run())
+        try:
+            await _wait_for(lambda: library.calls["C_WaitForSlotEvent"] > 0)
+            for slot in (0, 2, 0):
+                library.add_event(slot)
+            await _settle(library)
+        finally:
+            monitor.set_stop_event()
+            await wait_for(task, 10)
+        events = []
+        while not comm.empty():
+            events.append(comm.get_nowait())
+        # the second state of slot 0 replaced the first
+        assert all(isinstance(event, PKCS11SlotEvent) for event in events)
+        assert [event.get_slot_id() for event in events] == [2, 0]
+        assert [
+            event.get_slot_properties().get_slot_description()
+            for event in events
+        ] == ["Slot 2", "Slot 0"]
+        assert comm.get_statistics()["coalesced"] == 1
+
+    @mark.asyncio
+    async def test_adaptive_polling(self, monkeypatch):
+        from pkcs11_scanner import PKCS11CheckMonitor
+
+        clock = [0.0]
+        polls: list[float] = []
+
+        async def fake_sleep(seconds: float):
+            clock[0] += seconds
+            await sleep(0)
+
+        monkeypatch.setattr(
+            "pkcs11_scanner.pkcs11_check_monitor.async_sleep", fake_sleep
+        )
+        library = FakeLibrary(slots=1)
+        wait_for_slot_event = library.waitForSlotEvent
+
+        def timed_wait(flags=0):
+            polls.append(clock[0])
+            return wait_for_slot_event(flags)
+
+        library.waitForSlotEvent = timed_wait
+        _use_library(monkeypatch, library)
+        # four idle polls, an event and idle polls again
+        for slot in (None, None, None, None, 0, None, None):
+            library.add_event(slot)
+        monitor = PKCS11CheckMonitor("fake", 1)
+        monitor.set_sink(lambda item: None)
+        monitor.set_adaptive_polling(0.1, 0.8, 2)
+        task = get_running_loop().create_task(monitor.async_run())
+        try:
+            await _wait_for(lambda: len(polls) > 8)
+        finally:
+            monitor.set_stop_event()
+            await wait_for(task, 10)
+        intervals = [b - a for a, b in zip(polls, polls[1:])][:8]
+        assert intervals == approx([0.2, 0.4, 0.8, 0.8, 0.1, 0.2, 0.4, 0.8])
+
+    def test_adaptive_polling_values(self):
+        from pytest import raises
+
+        from pkcs11_scanner import PKCS11CheckMonitor
+
+        monitor = PKCS11CheckMonitor("fake", 1)
+        for min_seconds, max_seconds, factor in (
+            (0, 1, 2),
+            (-0.1, 1, 2),
+            (2, 1, 2),
+            (0.1, 1, 1),
+            (0.1, 1, 0.5),
+        ):
+            with raises(ValueError):
+                monitor.set_adaptive_polling(min_seconds, max_seconds, factor)
+        monitor.set_adaptive_polling(1, 1, 1.5)
+
+    @mark.asyncio
+    async def test_suppress_unchanged(self, monkeypatch):
+        from pkcs11_scanner import PKCS11CheckMonitor
+
+        library = FakeLibrary(slots=2)
+        _use_library(monkeypatch, library)
+        sink: list = []
+        monitor = PKCS11CheckMonitor("fake", 0.01)
+        monitor.set_sink(sink.append)
+        monitor.set_suppress_unchanged()
+        task = get_running_loop().create_task(monitor.async_run())
+        try:
+            for slot in (0, 0, 1, 1):
+                library.add_event(slot)
+            await _settle(library)
+            # the slot state changes with the token
+            library.remove_token(0)
+            await _settle(library)
+        finally:
+            monitor.set_stop_event()
+            await wait_for(task, 10)
+        assert _get_slot_descriptions(sink) == ["Slot 0", "Slot 1", "Slot 0"]
+        assert monitor.get_statistics() == {
+            "ticks": library.calls["C_WaitForSlotEvent"],
+            "events": 5,
+            "suppressed": 2,
+        }
+
+    def test_check_thread_hook(self, monkeypatch):
+        from queue import Queue
+
+        from pkcs11_cryptography_keys import SlotProperties
+
+        from pkcs11_scanner import PKCS11Scan
+        from pkcs11_scanner.pkcs11_check_n_scan_thread import (
+            PKCS11ChecknScanThread,
+        )
+        from pkcs11_scanner.pkcs11_check_thread import PKCS11CheckThread
+
+        class CheckThread(PKCS11CheckThread):
+            async def _on_token_present(self, library):
+                return PKCS11Scan({"slots": [{"slotDescription": "hook"}]})
+
+        for thread_class, description in (
+            (CheckThread, "hook"),
+            (PKCS11ChecknScanThread, "Slot 0"),
+        ):
+            library = FakeLibrary(slots=1)
+            _use_library(monkeypatch, library)
+            comm: Queue = Queue()
+            thread = thread_class("fake", comm, 0.01)
+            thread.start()
+            try:
+                library.add_event(0)
+                assert isinstance(comm.get(timeout=10), SlotProperties)
+                scan = comm.get(timeout=10)
+                assert isinstance(scan, PKCS11Scan)
+                slots = scan.to_dict()["slots"]
+                assert slots[0]["slotDescription"] == description
+            finally:
+                thread.set_stop_event()
+                thread.join(10)
+
+    @mark.asyncio
+    async def test_fleet_timeout(self, tmp_path):
+        from fake_library import fake_fleet_scanner
+
+        from pkcs11_scanner import (
+            PKCS11CheckError,
+            PKCS11FleetScanner,
+            PKCS11FleetTarget,
+            PKCS11Scan,
+        )
+
+        pid_file = str(tmp_path / "hang.pid")
+        targets = [
+            PKCS11FleetTarget("hang", environment={"FAKE_PID_FILE": pid_file}),
+            PKCS11FleetTarget("fake"),
+        ]
+        fleet = PKCS11FleetScanner(
+            targets,
+            max_workers=2,
+            timeout=3,
+            scanner_factory=fake_fleet_scanner,
+        )
+        events = [event async for event in fleet.gen_scan()]
+        results = {e.get_library_path(): e.get_event() for e in events}
+        assert isinstance(results["fake"], PKCS11Scan)
+        assert isinstance(results["hang"], PKCS11CheckError)
+        assert "timed out" in str(results["hang"])
+        assert fleet.get_statistics() == {
+            "scanned": 1,
+            "failed": 0,
+            "timed_out": 1,
+        }
+        assert _is_killed(pid_file)
+        # leaving the scan early kills the workers still running
+        pid_file = str(tmp_path / "abandoned.pid")
+        targets[0] = PKCS11FleetTarget(
+            "hang", environment={"FAKE_PID_FILE": pid_file}
+        )
+        fleet = PKCS11FleetScanner(
+            targets,
+            max_workers=2,
+            timeout=60,
+            scanner_factory=fake_fleet_scanner,
+        )
+        scan = fleet.gen_scan()
+        event = await wait_for(anext(scan), 30)
+        assert event.get_library_path() == "fake"
+        await _wait_for(lambda: exists(pid_file))
+        # the worker threads are not waited for, closing blocks the loop
+        start = monotonic()
+        await scan.aclose()
+        assert monotonic() - start < 5
+        await _wait_for(lambda: _is_killed(pid_file), 5)
+
+    def test_library_monitor_timeout(self, monkeypatch):
+        from queue import Empty, Queue
+
+        from pkcs11_cryptography_keys import SlotProperties
+
+        from pkcs11_scanner import (
+            PKCS11CallDeadlines,
+            PKCS11CheckError,
+            PKCS11LibraryMonitor,
+        )
+        from pkcs11_scanner.pkcs11_check_thread import PKCS11CheckThread
+
+        def check_factory(library_path, comm, refresh_seconds):
+            check = PKCS11CheckThread(library_path, comm, refresh_seconds)
+            check.set_call_deadlines(PKCS11CallDeadlines(call_seconds=0.1))
+            return check
+
+        def get_event(comm: Queue, event_type: type):
+            for _ in range(100):
+                event = comm.get(timeout=10).get_event()
+                if isinstance(event, event_type):
+                    return event
+            raise Empty()
+
+        library = FakeLibrary(slots=1)
+        library.hangs = {"C_WaitForSlotEvent"}
+        _use_library(monkeypatch, library)
+        comm: Queue = Queue()
+        monitor = PKCS11LibraryMonitor(
+            ["fake"], comm, 0.01, check_factory=check_factory
+        )
+        monitor.start()
+        try:
+            error = get_event(comm, PKCS11CheckError)
+            assert "C_WaitForSlotEvent" in str(error)
+            health = monitor.get_health("fake")
+            assert health is not None and health["state"] == "running"
+            # the watch goes on once the module answers again
+            library.hangs.clear()
+            polls = library.calls["C_WaitForSlotEvent"]
+            library.release.set()
+            # the event must not go to the call that hung
+            for _ in range(1000):
+                if library.calls["C_WaitForSlotEvent"] > polls + 1:
+                    break
+                sleep_seconds(0.01)
+            library.add_event(0)
+            assert isinstance(get_event(comm, SlotProperties), SlotProperties)
+        finally:
+            monitor.set_stop_event()
+            monitor.join(10)
+        health = monitor.get_health("fake")
+        assert health is not None and health["state"] == "stopped"
+        assert health["events"] == 1 and health["errors"] > 0
+
+    @mark.asyncio
+    async def test_single_step(self, monkeypatch):
+        from pkcs11_cryptography_keys import SlotProperties, TokenException
+        from pytest import raises
+
+        from pkcs11_scanner import (
+            PKCS11CallDeadlines,
+            PKCS11CheckMonitor,
+            PKCS11Scan,
+        )
+
+        async def no_scan(library):
+            return PKCS11Scan()
+
+        library = FakeLibrary(slots=1)
+        _use_library(monkeypatch, library)
+        sink: list = []
+        errors: list = []
+        monitor = PKCS11CheckMonitor("fake", 0.01)
+        monitor.set_sink(sink.append)
+        monitor.set_error_handler(errors.append)
+        monitor.set_call_deadlines(PKCS11CallDeadlines(call_seconds=0.1))
+        await monitor.open()
+        try:
+            assert not await monitor.step()
+            library.add_event(0)
+            assert await monitor.step()
+            assert isinstance(sink[0], SlotProperties)
+            # an empty scan of a present token ends the monitor
+            monitor.set_token_present_handler(no_scan)
+            library.add_event(0)
+            with raises(TokenException):
+                await monitor.step()
+            # a hung call is reported and the monitor goes on
+            library.hangs = {"C_WaitForSlotEvent"}
+            assert not await monitor.step()
+            assert len(errors) == 1 and "did not return" in errors[0]
+            monitor.set_stop_event()
+            assert monitor.is_stopped() and not await monitor.step()
+        finally:
+            library.release.set()
+            monitor.close()
+        monitor.clear_stop_event()
+        assert not monitor.is_stopped()
+
+    @mark.asyncio
+    async def test_events_on_running_loop(self, monkeypatch):
+        from threading import get_ident
+
+        from pkcs11_scanner import PKCS11CheckMonitor
+
+        library = FakeLibrary(slots=2)
+        _use_library(monkeypatch, library)
+        loop = get_running_loop()
+        loop_thread = get_ident()
+        slot_reads: list[int] = []
+        get_slot_info = library.getSlotInfo
+
+        def counted_slot_info(slot):
+            slot_reads.append(get_ident())
+            return get_slot_info(slot)
+
+        library.getSlotInfo = counted_slot_info
+        handled: list[bool] = []
+        sink: list[int] = []
+
+        async def on_token_present(library):
+            handled.append(get_running_loop() is loop)
+            return None
+
+        monitor = PKCS11CheckMonitor("fake", 0.01)
+        monitor.set_sink(lambda item: sink.append(get_ident()))
+        monitor.set_token_present_handler(on_token_present)
+        await monitor.open()
+        try:
+            for slot in (0, 1):
+                library.add_event(slot)
+                assert await monitor.step()
+        finally:
+            monitor.close()
+        # the handler runs on this loop, the slot reads in the executor
+        assert handled == [True, True]
+        assert sink == [loop_thread, loop_thread]
+        assert len(slot_reads) > 0 and loop_thread not in slot_reads
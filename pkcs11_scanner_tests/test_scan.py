@@ -0,0 +1,745 @@
+from pkcs11_cryptography_keys import KeyTypes
+
+
+def _scan_data():
+    slots = []
+    for i in range(3):
+        key_id = bytes([i])
+        slots.append(
+            {
+                "slotDescription": "Slot {0}".format(i),
+                "token": {
+                    "label": "Token {0}".format(i),
+                    "serialNumber": "SN{0}".format(i),
+                    "HW_slot": i == 1,
+                    "uri": "pkcs11:token=Token%20{0}".format(i),
+                    "private keys": [
+                        {
+                            "label": "key",
+                            "id": key_id,
+                            "type": "private",
+                            "key_type": KeyTypes.RSA,
+                            "uri": "pkcs11:token=Token%20{0};id=%{1}".format(
+                                i, key_id.hex()
+                            ),
+                        }
+                    ],
+                    "public keys": [],
+                    "certificates": [
+                        {"label": "key", "id": b"\x01", "type": "certificate"}
+                    ],
+                    "mechanisms": {},
+                },
+            }
+        )
+    return {"libraryDescription": "Test library", "slots": slots}
+
+
+class TestScan:
+
+    def test_label_lookups(self):
+        from pkcs11_scanner import PKCS11Scan
+
+        scan = PKCS11Scan(_scan_data())
+        assert list(scan.get_token_labels()) == [
+            "Token 0",
+            "Token 1",
+            "Token 2",
+        ]
+        assert list(scan.get_HW_token_labels()) == ["Token 1"]
+        assert scan.has_token_with_label("Token 2")
+        assert not scan.has_token_with_label("Token 3")
+        tkn = scan.get_token_for_label("Token 1")
+        assert tkn is not None and tkn["serialNumber"] == "SN1"
+        assert scan.get_token_for_label("Token 3") is None
+
+    def test_indexed_lookups(self):
+        from pkcs11_scanner import PKCS11Scan
+
+        scan = PKCS11Scan(_scan_data())
+        tkn = scan.get_token_for_serial("SN2")
+        assert tkn is not None and tkn["label"] == "Token 2"
+        assert scan.get_token_for_serial("SN3") is None
+        tokens = scan.get_tokens_for_key_id(b"\x01")
+        assert [t["label"] for t in tokens] == ["Token 0", "Token 1", "Token 2"]
+        objects = scan.get_objects_for_key_id(b"\x02")
+        assert [o["type"] for o in objects] == ["private"]
+        obj = scan.get_for_uri("pkcs11:token=Token%201;id=%01")
+        assert obj is not None and obj["id"] == b"\x01"
+        assert scan.get_for_uri("pkcs11:token=Token%201")["label"] == "Token 1"
+
+    def test_compact_records(self):
+        from gc import collect
+        from weakref import ref
+
+        from pkcs11_scanner import PKCS11LibraryRecord, PKCS11Scan
+
+        data = _scan_data()
+        mechanisms = {
+            "CKM_RSA_PKCS": {
+                "ulMinKeySize": 1024,
+                "ulMaxKeySize": 4096,
+                "flags": ["CKF_SIGN", "CKF_VERIFY"],
+            }
+        }
+        for s in data["slots"]:
+            s["token"]["mechanisms"] = dict(mechanisms)
+        record = PKCS11LibraryRecord.from_dict(data)
+        assert record.to_dict() == data
+        assert record.slots is not None
+        tokens = [s.token for s in record.slots if s.token is not None]
+        assert tokens[0].mechanisms is tokens[2].mechanisms
+        scan = PKCS11Scan(record)
+        assert scan.has_data()
+        assert scan.get_record() is record
+        tkn = scan.get_token_for_serial("SN1")
+        assert tkn is not None and tkn["mechanisms"] == mechanisms
+        assert list(scan.get_token_labels()) == [
+            "Token 0",
+            "Token 1",
+            "Token 2",
+        ]
+        assert list(scan.get_HW_token_labels()) == ["Token 1"]
+        tokens = scan.get_tokens_for_key_id(b"\x01")
+        assert [t["label"] for t in tokens] == ["Token 0", "Token 1", "Token 2"]
+        obj = scan.get_for_uri("pkcs11:token=Token%201;id=%01")
+        assert obj is not None and obj["type"] == "private"
+        # lookups walk the record, no dict copy is kept on the scan
+        assert scan._scan_data is record
+        assert scan.to_dict() == data and scan.to_dict() is not scan.to_dict()
+        assert PKCS11Scan(data).get_record().to_dict() == data
+        assert not PKCS11Scan(PKCS11LibraryRecord.from_dict({})).has_data()
+        # shared mechanism tables go away with the last record using them
+        table = ref(
+            PKCS11LibraryRecord.from_dict(data).slots[0].token.mechanisms
+        )
+        del record, scan
+        collect()
+        assert table() is None
+
+    def test_uri_builder(self):
+        from pkcs11_scanner import PKCS11Scan, PKCS11URIBuilder
+
+        data = _scan_data()
+        data["libraryVersion"] = (2, 6)
+        tkn = data["slots"][0]["token"]
+        tkn["label"] = "a/b;c"
+        tkn["private keys"][0]["id"] = b"\x0a\xff"
+        tkn["mechanisms"] = {"CKM_RSA_PKCS": {"flags": ["CKF_SIGN"]}}
+        builder = PKCS11URIBuilder()
+        lazy = builder.get_uri(data, tkn["certificates"][0])
+        builder.add_uris(data)
+        prefix = (
+            "pkcs11:library-description=Test%20library;library-version=2.6;"
+            "slot-description=Slot%200;token=a%2Fb%3Bc;serial=SN0"
+        )
+        assert tkn["uri"] == prefix
+        assert tkn["private keys"][0]["uri"] == (
+            prefix + ";object=key;id=%0A%FF;type=private"
+        )
+        assert tkn["certificates"][0]["uri"] == lazy
+        assert lazy == prefix + ";object=key;id=%01;type=cert"
+        assert "uri" not in tkn["mechanisms"]["CKM_RSA_PKCS"]
+        scan = PKCS11Scan(data)
+        assert scan.get_for_uri(prefix)["serialNumber"] == "SN0"
+        builder = PKCS11URIBuilder(["info", "slots"], {"pin-value": "12 34"})
+        assert builder.get_uri(data, tkn) == (
+            "pkcs11:token=a%2Fb%3Bc;serial=SN0?pin-value=12%2034"
+        )
+
+    def test_uri_lookup_cache(self):
+        from pkcs11_scanner import PKCS11URIBuilder
+
+        data = _scan_data()
+        builder = PKCS11URIBuilder()
+        gen_uris = builder.gen_uris
+        builds = []
+
+        def counted(data):
+            builds.append(data)
+            return gen_uris(data)
+
+        builder.gen_uris = counted
+        objects = [
+            obj
+            for s in data["slots"]
+            for obj in s["token"]["private keys"] + s["token"]["certificates"]
+        ]
+        uris = [builder.get_uri(data, obj) for obj in objects]
+        assert len(builds) == 1 and None not in uris
+        assert uris == [builder.get_uri(data, obj) for obj in objects]
+        assert len(builds) == 1
+        # an object added later is found after one rebuild
+        token = data["slots"][1]["token"]
+        token["public keys"].append({"label": "new", "type": "public"})
+        uri = builder.get_uri(data, token["public keys"][0])
+        assert uri is not None and uri.endswith(";object=new;type=public")
+        assert len(builds) == 2
+        token["label"] = "renamed"
+        builder.invalidate()
+        assert "token=renamed" in builder.get_uri(data, token)
+
+    def test_uri_parse(self):
+        from pytest import raises
+
+        from pkcs11_scanner import PKCS11URI, PKCS11URIBuilder
+
+        data = _scan_data()
+        tkn = data["slots"][0]["token"]
+        tkn["private keys"][0]["id"] = b"\x0a\xff"
+        builder = PKCS11URIBuilder(["info"], {"module-name": "a&b"})
+        uri = builder.get_uri(data, tkn["private keys"][0])
+        assert uri is not None
+        parsed = PKCS11URI.from_string(uri)
+        assert str(parsed) == uri
+        assert parsed.get("id") == b"\x0a\xff"
+        assert parsed.get("serial") == "SN0"
+        assert parsed.get_query() == {"module-name": "a&b"}
+        token_uri = builder.get_uri(data, tkn)
+        assert token_uri is not None
+        token_path = PKCS11URI.from_string(token_uri).get_path()
+        assert parsed.matches(token_path, ["object", "id", "type"])
+        assert not parsed.matches(token_path)
+        query = parsed.to_query()
+        assert query.get_key_id() == b"\x0a\xff"
+        assert query.get_token_serial() == "SN0"
+        with raises(ValueError):
+            PKCS11URI.from_string("pkcs11:token=a;token=b")
+        with raises(ValueError):
+            PKCS11URI.from_string("file:token=a")
+
+    def test_certificate_record(self):
+        import datetime
+        import pickle
+
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+        from cryptography.x509.oid import NameOID
+        from pkcs11_cryptography_keys import CertificateProperties
+
+        from pkcs11_scanner import PKCS11CertificateRecord
+        from pkcs11_scanner.pkcs11_certificate_record import (
+            decode_certificate,
+            read_key_usage,
+        )
+
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "User")])
+        certificate = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(1)
+            .not_valid_before(datetime.datetime(2024, 1, 1))
+            .not_valid_after(datetime.datetime(2034, 1, 1))
+            .add_extension(
+                x509.KeyUsage(
+                    digital_signature=True,
+                    content_commitment=True,
+                    key_encipherment=False,
+                    data_encipherment=False,
+                    key_agreement=True,
+                    key_cert_sign=False,
+                    crl_sign=False,
+                    encipher_only=False,
+                    decipher_only=True,
+                ),
+                critical=True,
+            )
+            .sign(key, hashes.SHA256())
+        )
+        der = certificate.public_bytes(serialization.Encoding.DER)
+        key_usage = read_key_usage(der)
+        assert (
+            key_usage
+            == CertificateProperties(
+                certificate
+            ).get_X509_key_usages_from_certificate()
+        )
+        assert key_usage is not None and key_usage["decipher_only"]
+        record = PKCS11CertificateRecord(der)
+        record["key_id"] = b"\x01"
+        assert record.has_conformant_key_usage({"digital_signature": True})
+        assert not record.has_conformant_key_usage({"crl_sign": True})
+        assert not record.is_decoded()
+        data = decode_certificate(der)
+        data["key_id"] = b"\x01"
+        assert record["subject"]["common_name"] == "User"
+        assert record == data
+        restored = pickle.loads(pickle.dumps(record))
+        assert not restored.is_decoded()
+        assert restored.to_dict() == data
+
+    def test_fingerprint_lookup(self):
+        import datetime
+
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+        from cryptography.x509.oid import NameOID
+
+        from pkcs11_scanner import (
+            PKCS11CertificateRecord,
+            PKCS11LibraryRecord,
+            PKCS11Scan,
+        )
+
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "User")])
+        certificate = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(1)
+            .not_valid_before(datetime.datetime(2024, 1, 1))
+            .not_valid_after(datetime.datetime(2034, 1, 1))
+            .sign(key, hashes.SHA256())
+        )
+        der = certificate.public_bytes(serialization.Encoding.DER)
+        fingerprint = certificate.fingerprint(hashes.SHA256())
+        # certificates as a scan without add_certificate reports them
+        data = _scan_data()
+        data["slots"][1]["token"]["certificates"] = [
+            {"key_id": b"\x01", "key_label": "key", "value": der}
+        ]
+        lazy = PKCS11CertificateRecord(der)
+        lazy["key_id"] = b"\x02"
+        data["slots"][2]["token"]["certificates"] = [lazy]
+        scan = PKCS11Scan(data)
+        assert scan.get_certificate_for_fingerprint(b"\x00" * 32) is None
+        # lazy records are hashed without decoding
+        assert not lazy.is_decoded()
+        for scan in (scan, PKCS11Scan.from_bytes(scan.to_bytes())):
+            cert = scan.get_certificate_for_fingerprint(fingerprint)
+            assert cert is not None and cert["key_id"] == b"\x01"
+            tkn = scan.get_token_for_fingerprint(fingerprint)
+            assert tkn is not None and tkn["label"] == "Token 1"
+        del data["slots"][1]["token"]["certificates"]
+        del data["slots"][2]
+        data["slots"][0]["token"]["certificates"] = [
+            {"key_id": b"\x03", "value": der}
+        ]
+        scan = PKCS11Scan(PKCS11LibraryRecord.from_dict(data))
+        cert = scan.get_certificate_for_fingerprint(fingerprint)
+        assert cert is not None and cert["key_id"] == b"\x03"
+
+    def test_serialization(self):
+        from io import BytesIO
+
+        from pkcs11_cryptography_keys import PKCS11KeyUsageAllNoDerive
+        from pytest import raises
+
+        from pkcs11_scanner import (
+            PKCS11Scan,
+            PKCS11ScanHistoryWriter,
+            gen_scan_history,
+        )
+
+        data = _scan_data()
+        data["libraryVersion"] = (2, 6)
+        tkn = data["slots"][0]["token"]
+        tkn["private keys"][0]["key_usage"] = PKCS11KeyUsageAllNoDerive()
+        tkn["mechanisms"] = {"CKM_RSA_PKCS": {"flags": ["CKF_SIGN"]}}
+        summary = {"calls": 3, "seconds": 0.5, "slots": {0: {"calls": 3}}}
+        scan = PKCS11Scan(data, summary, "/usr/lib/test.so")
+        for restored in (
+            PKCS11Scan.from_json(scan.to_json()),
+            PKCS11Scan.from_bytes(scan.to_bytes()),
+        ):
+            assert restored.to_dict() == data
+            assert restored.get_call_summary() == summary
+            assert restored.get_library_path() == "/usr/lib/test.so"
+        assert len(scan.to_bytes()) < len(scan.to_json())
+        with raises(ValueError):
+            PKCS11Scan.from_json(
+                scan.to_json().replace('"schema":1', '"schema":99')
+            )
+        with raises(ValueError):
+            PKCS11Scan.from_bytes(scan.to_bytes()[:-3])
+        for binary in (True, False):
+            f = BytesIO()
+            writer = PKCS11ScanHistoryWriter(f, binary)
+            for _ in range(3):
+                writer.write(scan)
+            writer.write(PKCS11Scan(_scan_data()))
+            f.seek(0)
+            history = list(gen_scan_history(f))
+            assert len(history) == 4
+            assert history[2].to_dict() == data
+            assert history[3].to_dict() == _scan_data()
+
+    def test_scan_diff(self):
+        from pkcs11_scanner import (
+            PKCS11Scan,
+            PKCS11ScanChangeTarget,
+            PKCS11ScanDiff,
+            PKCS11SlotChangeType,
+        )
+
+        old = _scan_data()
+        old["slots"][0]["token"]["mechanisms"] = {"CKM_RSA_PKCS": {}}
+        new = _scan_data()
+        new["slots"] = [new["slots"][2], new["slots"][0]]
+        tkn = new["slots"][1]["token"]
+        tkn["label"] = "Renamed"
+        tkn["private keys"][0]["label"] = "new key"
+        tkn["public keys"].append({"label": "pub", "id": b"\x00"})
+        tkn["mechanisms"] = {"CKM_ECDSA": {"flags": ["CKF_SIGN"]}}
+        diff = PKCS11Scan(old).diff(PKCS11Scan(new))
+        changes = {
+            (str(c.get_target()), str(c.get_change_type()))
+            for c in diff.get_changes()
+        }
+        assert changes == {
+            ("slot", "removed"),
+            ("token", "changed"),
+            ("object", "changed"),
+            ("object", "added"),
+            ("mechanism", "removed"),
+            ("mechanism", "added"),
+        }
+        obj = [
+            c
+            for c in diff.get_changes()
+            if c.get_target() == PKCS11ScanChangeTarget.object
+            and c.get_change_type() == PKCS11SlotChangeType.changed
+        ][0]
+        assert obj.get_data() == {"label": "new key"}
+        assert PKCS11Scan(old).apply(diff).to_dict() == new
+        assert old["slots"][0]["token"]["label"] == "Token 0"
+        restored = PKCS11ScanDiff.from_json(diff.to_json())
+        assert PKCS11Scan(old).apply(restored).to_dict() == new
+        assert PKCS11Scan(new).diff(PKCS11Scan(new)).is_empty()
+
+    def test_call_deadlines(self):
+        from threading import Event
+
+        from pytest import raises
+
+        from pkcs11_scanner import (
+            PKCS11CallDeadlines,
+            PKCS11CallTimeout,
+            PKCS11SlotHealth,
+        )
+
+        deadlines = PKCS11CallDeadlines(call_seconds=0.1)
+        release = Event()
+        assert deadlines.call("C_GetInfo", None, sum, [1, 2]) == 3
+        with raises(PKCS11CallTimeout):
+            deadlines.call("C_FindObjects", 1, release.wait, 10)
+        assert deadlines.is_blocked(1)
+        # a slot blocked in a call is refused without waiting again
+        with raises(PKCS11CallTimeout):
+            deadlines.call("C_GetTokenInfo", 1, sum, [1])
+        assert deadlines.call("C_GetTokenInfo", 2, sum, [1]) == 1
+        release.set()
+        statistics = deadlines.get_statistics()
+        assert statistics["timed_out"] == 1
+        assert statistics["refused"] == 1
+        deadlines.close()
+        health = PKCS11SlotHealth(min_backoff_seconds=60)
+        assert health.mark_degraded(1, "hung")["failures"] == 1
+        assert health.is_skipped(1)
+        assert not health.is_skipped(2)
+        assert health.mark_degraded(1, "hung")["retry_seconds"] > 60
+        health.mark_healthy(1)
+        assert health.get_degraded_slots() == {}
+
+    def test_coalescing_queue(self):
+        from pkcs11_cryptography_keys import SlotProperties
+
+        from pkcs11_scanner import (
+            PKCS11CheckError,
+            PKCS11CoalescingQueue,
+            PKCS11LibraryEvent,
+            PKCS11Scan,
+            PKCS11SlotEvent,
+        )
+
+        def slot(slot_id, flags, description="Slot"):
+            return PKCS11SlotEvent(
+                SlotProperties({"slotDescription": description}, flags),
+                slot_id,
+            )
+
+        comm = PKCS11CoalescingQueue(maxsize=4)
+        comm.put(PKCS11Scan(_scan_data()))
+        comm.put(slot(0, []))
+        comm.put(PKCS11CheckError("first"))
+        comm.put(slot(0, ["CKF_TOKEN_PRESENT"]))
+        comm.put(PKCS11CheckError("second"))
+        latest = PKCS11Scan(_scan_data())
+        comm.put(latest)
+        statistics = comm.get_statistics()
+        assert statistics["depth"] == 4
+        assert statistics["coalesced"] == 2
+        assert statistics["dropped"] == 0
+        assert str(comm.get_nowait()) == "first"
+        assert comm.get_nowait().get_slot_properties().is_token_present()
+        assert str(comm.get_nowait()) == "second"
+        assert comm.get_nowait() is latest
+        for i in range(4):
+            comm.task_done()
+        # slots are told apart by id, bare slot properties are not coalesced
+        comm.put(slot(1, []))
+        comm.put(slot(2, []))
+        comm.put(slot(1, [], "Slot 1").get_slot_properties())
+        comm.put(slot(1, [], "Slot 1").get_slot_properties())
+        assert comm.get_depth() == 4
+        assert comm.get_statistics()["coalesced"] == 2
+        for i in range(4):
+            comm.get_nowait()
+            comm.task_done()
+        comm.put(slot(1, [], "Slot 1"))
+        for i in range(5):
+            comm.put(PKCS11CheckError(str(i)))
+        # errors are dropped last and counted apart, the latest slot state
+        # is kept
+        assert comm.get_depth() == 4
+        statistics = comm.get_statistics()
+        assert statistics["dropped"] == 0
+        assert statistics["dropped_errors"] == 2
+        event = comm.get_nowait()
+        assert event.get_slot_id() == 1
+        assert event.get_slot_properties().get_slot_description() == "Slot 1"
+        comm.task_done()
+        for i in range(2, 5):
+            assert str(comm.get_nowait()) == str(i)
+            comm.task_done()
+        comm.join()
+        comm.put(PKCS11Scan(_scan_data()))
+        comm.put(PKCS11CheckError("kept"))
+        comm.put(PKCS11Scan(_scan_data()).to_dict())
+        comm.put(PKCS11CheckError("kept too"))
+        comm.put(PKCS11CheckError("kept as well"))
+        # other items go before errors
+        assert comm.get_statistics()["dropped"] == 1
+        for i in range(4):
+            comm.get_nowait()
+            comm.task_done()
+        comm.put(PKCS11LibraryEvent("a.so", PKCS11Scan(_scan_data())))
+        comm.put(PKCS11LibraryEvent("b.so", PKCS11Scan(_scan_data())))
+        comm.put(PKCS11LibraryEvent("a.so", latest))
+        assert comm.get_nowait().get_library_path() == "b.so"
+        assert comm.get_nowait().get_event() is latest
+        assert comm.empty()
+
+    def test_rejected_attributes(self):
+        from PyKCS11 import CKA_DERIVE, CKA_SIGN
+
+        from pkcs11_scanner.pkcs11_attribute_reader import (
+            PKCS11AttributeReader,
+        )
+
+        class Session(object):
+            def __init__(self):
+                self.templates = []
+
+            def getAttributeValue(self, key, template):
+                # PyKCS11 returns None for attributes the token rejects
+                self.templates.append(list(template))
+                return [None if a == CKA_DERIVE else 1 for a in template]
+
+        session = Session()
+        reader = PKCS11AttributeReader(session)
+        first = reader.read_attributes(1, "private")
+        second = reader.read_attributes(2, "private")
+        assert first == second
+        assert first[CKA_DERIVE] is None and first[CKA_SIGN] == 1
+        assert CKA_DERIVE in session.templates[0]
+        assert session.templates[1] == [
+            a for a in session.templates[0] if a != CKA_DERIVE
+        ]
+        reader.read_attributes(3, "public")
+        assert session.templates[2] == PKCS11AttributeReader.get_template(
+            "public"
+        )
+
+    def test_sensitive_attributes(self):
+        from PyKCS11 import CKA_ID, CKA_LABEL, CKA_SIGN, CKA_VALUE
+
+        from pkcs11_scanner.pkcs11_attribute_reader import (
+            PKCS11AttributeReader,
+        )
+
+        class Session(object):
+            def __init__(self):
+                self.templates = []
+
+            def getAttributeValue(self, key, template):
+                # the first key is sensitive, the others are not
+                self.templates.append(list(template))
+                return [
+                    None if key == 1 and a in (CKA_VALUE, CKA_SIGN) else key
+                    for a in template
+                ]
+
+        session = Session()
+        reader = PKCS11AttributeReader(session)
+        template = [CKA_LABEL, CKA_ID, CKA_VALUE]
+        assert reader.read_attributes(1, "private", template)[CKA_VALUE] is None
+        assert reader.read_attributes(2, "private", template)[CKA_VALUE] == 2
+        assert session.templates[1] == template
+        # an attribute once read is not taken as rejected for the class
+        reader = PKCS11AttributeReader(session)
+        assert reader.read_attributes(2, "private")[CKA_SIGN] == 2
+        assert reader.read_attributes(1, "private")[CKA_SIGN] is None
+        assert reader.read_attributes(3, "private")[CKA_SIGN] == 3
+
+    def test_mechanism_cache_file(self, tmp_path):
+        from os.path import exists
+
+        from pkcs11_scanner.pkcs11_mechanism_cache import PKCS11MechanismCache
+
+        cache_file = str(tmp_path / "mechanisms.json")
+        cache = PKCS11MechanismCache(cache_file=cache_file)
+        mechanisms = {"CKM_RSA_PKCS": {"ulMinKeySize": 1024, "flags": []}}
+        for i in range(3):
+            cache.put(
+                ("lib.so", "Maker", "Model {0}".format(i), (1, 0)), mechanisms
+            )
+        # the file is written once, when the scan is done
+        assert not exists(cache_file)
+        cache.flush()
+        assert exists(cache_file)
+        key = ("lib.so", "Maker", "Model 0", (1, 0))
+        cached = cache.get(key)
+        cached["CKM_RSA_PKCS"]["flags"].append("CKF_SIGN")
+        mechanisms["CKM_RSA_PKCS"]["ulMinKeySize"] = 0
+        assert cache.get(key) == {
+            "CKM_RSA_PKCS": {"ulMinKeySize": 1024, "flags": []}
+        }
+        loaded = PKCS11MechanismCache(cache_file=cache_file)
+        assert loaded.get_statistics()["size"] == 3
+        assert loaded.get(key) == cache.get(key)
+
+    def test_record_round_trip(self):
+        from asyncio import run
+
+        from fake_library import FakeLibrary
+        from PyKCS11 import CKA_LABEL
+
+        from pkcs11_scanner import PKCS11LibraryRecord
+        from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+
+        library = FakeLibrary(slots=2)
+        # a key without a label is scanned with a label of None
+        del library.tokens[1][0][CKA_LABEL]
+        data = run(PKCS11Scanner(library).scan_from_library())
+        obj = data["slots"][1]["token"]["private keys"][0]
+        assert "label" in obj and obj["label"] is None
+        record = PKCS11LibraryRecord.from_dict(data)
+        assert record.to_dict() == data
+        assert record.slots is not None and record.slots[1].token is not None
+        objects = record.slots[1].token.objects
+        assert objects is not None
+        # a value set later wins over the missing one
+        objects["private keys"][0].label = "key"
+        assert (
+            record.to_dict()["slots"][1]["token"]["private keys"][0]["label"]
+            == "key"
+        )
+
+    def test_query_post_filter(self):
+        from asyncio import run
+
+        from fake_library import FakeLibrary
+        from PyKCS11 import CKA_ID, CKA_LABEL
+
+        from pkcs11_scanner import PKCS11Query
+        from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+
+        library = FakeLibrary(slots=1, keys=3)
+        # the module finds every object of a class, whatever the label
+        library.ignored_attributes = {CKA_LABEL, CKA_ID}
+        scanner = PKCS11Scanner(library)
+        data = run(scanner.scan_from_library(query=PKCS11Query(label="key 1")))
+        token = data["slots"][0]["token"]
+        assert [o["label"] for o in token["private keys"]] == ["key 1"]
+        assert [o["label"] for o in token["public keys"]] == ["key 1"]
+        query = PKCS11Query(object_types=["private"], key_id=bytes([0, 2]))
+        data = run(scanner.scan_from_library(query=query))
+        token = data["slots"][0]["token"]
+        assert [o["id"] for o in token["private keys"]] == [bytes([0, 2])]
+
+    def test_scan_cache_file(self, tmp_path):
+        from asyncio import run
+        from os.path import exists
+
+        from fake_library import FakeLibrary
+
+        from pkcs11_scanner import PKCS11ScanCache
+        from pkcs11_scanner.pkcs11_scanner import PKCS11Scanner
+
+        class ScanCache(PKCS11ScanCache):
+            saves = 0
+
+            def save(self):
+                self.saves += 1
+                super().save()
+
+        async def stream(scanner: PKCS11Scanner) -> int:
+            return len([item async for item in scanner.gen_scan()])
+
+        cache_file = str(tmp_path / "scans.bin")
+        cache = ScanCache(cache_file=cache_file)
+        scanner = PKCS11Scanner(FakeLibrary(slots=3))
+        scanner.set_scan_cache(cache)
+        # streamed scans are written when the scanner is closed
+        assert run(stream(scanner)) > 0
+        assert cache.get_statistics()["size"] == 3
+        assert not exists(cache_file)
+        scanner.close()
+        assert exists(cache_file) and cache.saves == 1
+        cache.clear()
+        run(scanner.scan_from_library())
+        assert cache.saves == 2
+        # nothing changed since the last write
+        scanner.close()
+        assert cache.saves == 2
+        restored = PKCS11ScanCache(cache_file=cache_file)
+        assert restored.get_statistics()["size"] == 3
+        # every lookup gets its own copy
+        restored.put(("fake",), (1,), {"token": {"id": b"\x01"}})
+        found, slot = restored.lookup(("fake",), (1,))
+        assert found and slot == {"token": {"id": b"\x01"}}
+        slot["token"]["id"] = b"\x02"
+        assert restored.lookup(("fake",))[1] == {"token": {"id": b"\x01"}}
+        # a file that does not decode is an empty cache
+        with open(cache_file, "rb") as f:
+            raw = f.read()
+        for tampered in (raw[: len(raw) // 2], b"\x80\x04K\x01.", b""):
+            with open(cache_file, "wb") as f:
+                f.write(tampered)
+            assert PKCS11ScanCache(cache_file).get_statistics()["size"] == 0
+
+    def test_pooled_session_statistics(self):
+        from fake_library import FakeLibrary
+
+        from pkcs11_scanner import PKCS11CallStatistics, PKCS11LibraryPool
+        from pkcs11_scanner.pkcs11_instrumentation import instrument_library
+
+        pool = PKCS11LibraryPool()
+        library = FakeLibrary(slots=1)
+        first = PKCS11CallStatistics()
+        second = PKCS11CallStatistics()
+        session, _ = pool.acquire_session(instrument_library(library, first), 0)
+        session.findObjects([])
+        pool.release_session(session, False)
+        # the reused session reports to the scan that reuses it
+        session, _ = pool.acquire_session(
+            instrument_library(library, second), 0
+        )
+        session.findObjects([])
+        pool.release_session(session, False)
+        session, _ = pool.acquire_session(library, 0)
+        session.findObjects([])
+        pool.release_session(session, False)
+        assert pool.get_statistics()["reused"] == 2
+        assert library.calls["C_FindObjects"] == 3
+        for statistics in (first, second):
+            functions = statistics.get_statistics()["functions"]
+            assert functions["C_FindObjects"]["calls"] == 1